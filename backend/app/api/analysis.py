@@ -3,46 +3,58 @@ Endpoints para análisis financiero
 """
 
 from fastapi import APIRouter, HTTPException, Depends, Header
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
+from datetime import date
 import logging
 
-from app.models.financial_models import AnalysisRequest, AnalysisResponse, FinancialMetrics
+from app.models.financial_models import AnalysisRequest, AnalysisResponse, FinancialMetrics, TransactionType
 from app.services.data_service import DataService
-from app.services.gemini_service import GeminiService
+from app.services.data_registry import data_service_registry
+from app.services.date_index import resolve_date_range, months_in_range
+from app.services.gemini_service import GeminiService, gemini_service
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
-def get_data_service(empresa_id: Optional[str] = Header(None, alias="X-Empresa-ID")) -> DataService:
-    """Dependency para obtener el servicio de datos con empresa_id del header"""
+async def get_data_service(empresa_id: Optional[str] = Header(None, alias="X-Empresa-ID")) -> DataService:
+    """Dependency para obtener el servicio de datos compartido de la empresa del header"""
     # Si no hay empresa_id en header, usar default
-    empresa = empresa_id or "E001"
-    return DataService(empresa_id=empresa)
+    return await data_service_registry.get(empresa_id or "E001")
 
 def get_gemini_service() -> GeminiService:
-    """Dependency para obtener el servicio de Gemini"""
-    return GeminiService()
+    """Dependency con el servicio de Gemini compartido (ya inicializado)"""
+    return gemini_service
+
+def _resolve_range(period: str, start: Optional[date], end: Optional[date]) -> Tuple[str, Optional[date], Optional[date]]:
+    """Resolver el periodo con nombre o el rango explícito de la petición"""
+    try:
+        label = "custom" if (start or end) else period
+        return (label,) + resolve_date_range(period, start, end)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _range_fields(start: Optional[date], end: Optional[date]) -> Dict[str, Optional[str]]:
+    return {
+        "start_date": start.isoformat() if start else None,
+        "end_date": end.isoformat() if end else None
+    }
 
 @router.get("/cashflow")
 async def analyze_cashflow(
     period: str = "last_12_months",
+    start: Optional[date] = None,
+    end: Optional[date] = None,
     data_service: DataService = Depends(get_data_service)
 ) -> Dict[str, Any]:
     """Analizar flujo de caja"""
     try:
-        # Cargar datos si no están disponibles
-        if not data_service.cash_flow_history:
-            await data_service.load_financial_data()
-        
+        # El historial mensual se deriva del cubo agregado de la empresa
         if not data_service.cash_flow_history:
             raise HTTPException(status_code=404, detail="No hay datos de flujo de caja disponibles")
         
-        # Filtrar por período
-        filtered_data = data_service.cash_flow_history
-        if period == "last_6_months":
-            filtered_data = filtered_data[-6:]
-        elif period == "last_3_months":
-            filtered_data = filtered_data[-3:]
+        # Filtrar por período con el índice de fechas (sumas prefijo diarias)
+        period, start, end = _resolve_range(period, start, end)
+        filtered_data = data_service.date_index.monthly_cash_flow(start, end)
         
         # Calcular métricas de flujo de caja
         total_income = sum(cf.income for cf in filtered_data)
@@ -57,6 +69,7 @@ async def analyze_cashflow(
         
         return {
             "period": period,
+            **_range_fields(start, end),
             "total_income": total_income,
             "total_expenses": total_expenses,
             "net_cash_flow": total_income - total_expenses,
@@ -71,6 +84,8 @@ async def analyze_cashflow(
             ]
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error en análisis de flujo de caja: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error en análisis: {str(e)}")
@@ -78,6 +93,8 @@ async def analyze_cashflow(
 @router.get("/expenses")
 async def analyze_expenses(
     period: str = "last_12_months",
+    start: Optional[date] = None,
+    end: Optional[date] = None,
     data_service: DataService = Depends(get_data_service)
 ) -> Dict[str, Any]:
     """Analizar gastos por categoría"""
@@ -85,16 +102,9 @@ async def analyze_expenses(
         if not data_service.transactions:
             raise HTTPException(status_code=404, detail="No hay datos de transacciones disponibles")
         
-        # Filtrar gastos
-        expenses = [t for t in data_service.transactions if t.transaction_type.value == "expense"]
-        
-        # Agrupar por categoría
-        category_totals = {}
-        for expense in expenses:
-            category = expense.category.value
-            if category not in category_totals:
-                category_totals[category] = 0
-            category_totals[category] += expense.amount
+        # Gastos por categoría del período desde el índice de fechas (sin recorrer transacciones)
+        period, start, end = _resolve_range(period, start, end)
+        category_totals = data_service.date_index.category_totals(TransactionType.EXPENSE, start, end)
         
         # Calcular porcentajes
         total_expenses = sum(category_totals.values())
@@ -108,6 +118,7 @@ async def analyze_expenses(
         
         return {
             "period": period,
+            **_range_fields(start, end),
             "total_expenses": total_expenses,
             "category_breakdown": category_totals,
             "category_percentages": category_percentages,
@@ -120,6 +131,8 @@ async def analyze_expenses(
             ]
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error en análisis de gastos: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error en análisis: {str(e)}")
@@ -127,6 +140,8 @@ async def analyze_expenses(
 @router.get("/revenue")
 async def analyze_revenue(
     period: str = "last_12_months",
+    start: Optional[date] = None,
+    end: Optional[date] = None,
     data_service: DataService = Depends(get_data_service)
 ) -> Dict[str, Any]:
     """Analizar ingresos por categoría"""
@@ -134,26 +149,21 @@ async def analyze_revenue(
         if not data_service.transactions:
             raise HTTPException(status_code=404, detail="No hay datos de transacciones disponibles")
         
-        # Filtrar ingresos
-        revenues = [t for t in data_service.transactions if t.transaction_type.value == "income"]
-        
-        # Agrupar por categoría
-        category_totals = {}
-        for revenue in revenues:
-            category = revenue.category.value
-            if category not in category_totals:
-                category_totals[category] = 0
-            category_totals[category] += revenue.amount
+        # Ingresos por categoría del período desde el índice de fechas (sin recorrer transacciones)
+        period, start, end = _resolve_range(period, start, end)
+        date_index = data_service.date_index
+        category_totals = date_index.category_totals(TransactionType.INCOME, start, end)
         
         # Calcular métricas
         total_revenue = sum(category_totals.values())
-        avg_monthly_revenue = total_revenue / 12  # Asumiendo 12 meses
+        avg_monthly_revenue = total_revenue / max(months_in_range(start, end, date_index), 1)
         
         # Identificar categorías principales
         top_categories = sorted(category_totals.items(), key=lambda x: x[1], reverse=True)[:3]
         
         return {
             "period": period,
+            **_range_fields(start, end),
             "total_revenue": total_revenue,
             "average_monthly_revenue": avg_monthly_revenue,
             "category_breakdown": category_totals,
@@ -166,6 +176,8 @@ async def analyze_revenue(
             ]
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error en análisis de ingresos: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error en análisis: {str(e)}")
@@ -176,10 +188,7 @@ async def analyze_profitability(
 ) -> Dict[str, Any]:
     """Analizar rentabilidad general"""
     try:
-        # Cargar datos si no están disponibles
-        if not data_service.metrics:
-            await data_service.load_financial_data()
-        
+        # Las métricas se mantienen a partir del cubo agregado de la empresa
         if not data_service.metrics:
             raise HTTPException(status_code=404, detail="No hay métricas disponibles")
         
@@ -206,6 +215,8 @@ async def analyze_profitability(
             ]
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error en análisis de rentabilidad: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error en análisis: {str(e)}")
@@ -223,13 +234,19 @@ async def comprehensive_analysis(
             "metrics": data_service.metrics.dict() if data_service.metrics else {},
             "cash_flow": [cf.dict() for cf in data_service.cash_flow_history[-3:]],
             "expense_breakdown": data_service.metrics.expense_breakdown if data_service.metrics else {},
-            "revenue_breakdown": data_service.metrics.revenue_breakdown if data_service.metrics else {}
+            "revenue_breakdown": data_service.metrics.revenue_breakdown if data_service.metrics else {},
+            "category_statistics": {
+                "expenses": data_service.aggregates.category_statistics(TransactionType.EXPENSE),
+                "revenue": data_service.aggregates.category_statistics(TransactionType.INCOME)
+            }
         }
         
         # Generar análisis con IA
         analysis_text = await gemini_service.generate_simulation_analysis(
             {"name": f"Análisis {request.analysis_type}", "description": f"Análisis de {request.analysis_type}"},
-            context
+            context,
+            data_service.empresa_id,
+            cache_kind="analysis"
         )
         
         # Generar insights específicos
@@ -260,6 +277,8 @@ async def comprehensive_analysis(
             confidence=0.8
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error en análisis comprehensivo: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error en análisis: {str(e)}")
@@ -3,24 +3,43 @@ Endpoints para chat inteligente con IA
 """
 
 from fastapi import APIRouter, HTTPException, Depends, Header
-from typing import Dict, Any, List, Optional
+from fastapi.responses import StreamingResponse
+from typing import AsyncIterator, Dict, Any, List, Optional
+import json
 import logging
 
 from app.models.financial_models import ChatMessage, ChatResponse
 from app.services.data_service import DataService
-from app.services.gemini_service import GeminiService
+from app.services.data_registry import data_service_registry
+from app.services.gemini_service import GeminiService, gemini_service
 from app.services.elevenlabs_service import elevenlabs_service
+from app.services.snowflake_service import snowflake_service
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
-def get_data_service(empresa_id: Optional[str] = Header(None, alias="X-Empresa-ID")) -> DataService:
-    """Dependency para obtener el servicio de datos con empresa_id del header"""
-    empresa = empresa_id or "E001"
-    return DataService(empresa_id=empresa)
+async def get_data_service(empresa_id: Optional[str] = Header(None, alias="X-Empresa-ID")) -> DataService:
+    """Dependency para obtener el servicio de datos compartido de la empresa del header"""
+    # Si no hay empresa_id en header, usar default
+    return await data_service_registry.get(empresa_id or "E001")
 
 def get_gemini_service() -> GeminiService:
-    return GeminiService()
+    """Dependency con el servicio de Gemini compartido (ya inicializado)"""
+    return gemini_service
+
+def _financial_context(data_service: DataService) -> Dict[str, Any]:
+    """Contexto financiero que acompaña cada pregunta al modelo"""
+    return {
+        "metrics": data_service.metrics.dict() if data_service.metrics else {},
+        "cash_flow": [cf.dict() for cf in data_service.cash_flow_history[-3:]],
+        "expense_breakdown": data_service.metrics.expense_breakdown if data_service.metrics else {},
+        "revenue_breakdown": data_service.metrics.revenue_breakdown if data_service.metrics else {},
+        "total_transactions": len(data_service.transactions)
+    }
+
+def _sse(event: str, data: Any) -> str:
+    """Formatear un evento Server-Sent Events con datos JSON"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
 
 @router.post("/message")
 async def send_message(
@@ -31,21 +50,18 @@ async def send_message(
     """Enviar mensaje al asistente financiero"""
     try:
         # Preparar contexto financiero
-        context = {
-            "metrics": data_service.metrics.dict() if data_service.metrics else {},
-            "cash_flow": [cf.dict() for cf in data_service.cash_flow_history[-3:]],
-            "expense_breakdown": data_service.metrics.expense_breakdown if data_service.metrics else {},
-            "revenue_breakdown": data_service.metrics.revenue_breakdown if data_service.metrics else {},
-            "total_transactions": len(data_service.transactions)
-        }
+        context = _financial_context(data_service)
         
         # Procesar mensaje con IA
-        response = await gemini_service.analyze_financial_question(message, context)
+        response = await gemini_service.analyze_financial_question(message, context, data_service.empresa_id)
+        
+        # Auditoría en la cola write-behind (no agrega latencia a la respuesta)
+        snowflake_service.log_chat_interaction(data_service.empresa_id, message.message, response.content, context, response.confidence)
         
         # Generar audio con ElevenLabs si está disponible (opcional - no bloquear si falla)
         if elevenlabs_service.is_available and response.content:
             try:
-                audio_response = elevenlabs_service.create_audio_response(
+                audio_response = await elevenlabs_service.create_audio_response_async(
                     response.content, 
                     response_type="carlos"  # Voz específica de Maya (usar 'carlos' para manter el voice_id correcto)
                 )
@@ -61,6 +77,54 @@ async def send_message(
         logger.error(f"Error en chat: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error en chat: {str(e)}")
 
+@router.post("/stream")
+async def stream_message(
+    message: ChatMessage,
+    data_service: DataService = Depends(get_data_service),
+    gemini_service: GeminiService = Depends(get_gemini_service)
+) -> StreamingResponse:
+    """Enviar mensaje al asistente financiero y recibir la respuesta como Server-Sent Events
+
+    Eventos: `token` ({"text"}) por cada fragmento generado, `final` con la respuesta completa
+    (recomendaciones, confianza y visualizaciones, sin audio), `audio` si ElevenLabs está
+    disponible, y `done` al terminar. Un fallo a mitad del flujo se informa con `error`.
+    """
+    context = _financial_context(data_service)
+    empresa_id = data_service.empresa_id
+
+    async def events() -> AsyncIterator[str]:
+        try:
+            response: Optional[ChatResponse] = None
+            async for kind, payload in gemini_service.stream_financial_question(message, context, empresa_id):
+                if kind == "token":
+                    yield _sse("token", {"text": payload})
+                else:
+                    response = payload
+                    yield _sse("final", response.dict(exclude={"audio_data"}))
+            
+            # Auditoría en la cola write-behind (no agrega latencia a la respuesta)
+            snowflake_service.log_chat_interaction(empresa_id, message.message, response.content, context, response.confidence)
+            
+            # El audio llega después del texto y se sintetiza fuera del event loop
+            if elevenlabs_service.is_available and response.content:
+                try:
+                    audio_response = await elevenlabs_service.create_audio_response_async(response.content, response_type="carlos")
+                    if audio_response:
+                        yield _sse("audio", audio_response)
+                except Exception as audio_error:
+                    logger.warning(f"No se pudo generar audio: {str(audio_error)}")
+        except Exception as e:
+            logger.error(f"Error en chat (stream): {str(e)}")
+            yield _sse("error", {"detail": f"Error en chat: {str(e)}"})
+        yield _sse("done", {})
+
+    # Sin caché ni buffering de proxies para que cada fragmento llegue en cuanto se genera
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @router.get("/history")
 async def get_chat_history(
     user_id: str = None,
@@ -122,19 +186,13 @@ async def generate_audio_response(
             raise HTTPException(status_code=503, detail="Servicio de audio no disponible")
         
         # Preparar contexto financiero
-        context = {
-            "metrics": data_service.metrics.dict() if data_service.metrics else {},
-            "cash_flow": [cf.dict() for cf in data_service.cash_flow_history[-3:]],
-            "expense_breakdown": data_service.metrics.expense_breakdown if data_service.metrics else {},
-            "revenue_breakdown": data_service.metrics.revenue_breakdown if data_service.metrics else {},
-            "total_transactions": len(data_service.transactions)
-        }
+        context = _financial_context(data_service)
         
         # Procesar mensaje con IA
-        response = await gemini_service.analyze_financial_question(message, context)
+        response = await gemini_service.analyze_financial_question(message, context, data_service.empresa_id)
         
         # Generar audio
-        audio_response = elevenlabs_service.create_audio_response(
+        audio_response = await elevenlabs_service.create_audio_response_async(
             response.content, 
             response_type="carlos"
         )
@@ -9,18 +9,20 @@ from datetime import datetime, timedelta
 
 from app.models.financial_models import SimulationRequest, SimulationResult, SimulationScenario
 from app.services.data_service import DataService
-from app.services.gemini_service import GeminiService
+from app.services.data_registry import data_service_registry
+from app.services.gemini_service import GeminiService, gemini_service
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
-def get_data_service(empresa_id: Optional[str] = Header(None, alias="X-Empresa-ID")) -> DataService:
-    """Dependency para obtener el servicio de datos con empresa_id del header"""
-    empresa = empresa_id or "E001"
-    return DataService(empresa_id=empresa)
+async def get_data_service(empresa_id: Optional[str] = Header(None, alias="X-Empresa-ID")) -> DataService:
+    """Dependency para obtener el servicio de datos compartido de la empresa del header"""
+    # Si no hay empresa_id en header, usar default
+    return await data_service_registry.get(empresa_id or "E001")
 
 def get_gemini_service() -> GeminiService:
-    return GeminiService()
+    """Dependency con el servicio de Gemini compartido (ya inicializado)"""
+    return gemini_service
 
 @router.post("/scenario")
 async def create_simulation(
@@ -41,7 +43,7 @@ async def create_simulation(
         simulation_data = await _run_simulation(request.scenario, base_data, request.scenario.duration_months)
         
         # Generar análisis con IA
-        analysis = await gemini_service.generate_simulation_analysis(request.scenario.dict(), base_data)
+        analysis = await gemini_service.generate_simulation_analysis(request.scenario.dict(), base_data, data_service.empresa_id)
         
         # Calcular métricas clave
         key_metrics = _calculate_key_metrics(simulation_data)
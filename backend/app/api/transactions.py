@@ -2,47 +2,110 @@
 Endpoints para gestión de transacciones financieras
 """
 
-from fastapi import APIRouter, HTTPException, Depends, Header
+from fastapi import APIRouter, HTTPException, Depends, Header, Request, Response
 from typing import Dict, Any, List, Optional
+import os
 import logging
-from datetime import datetime
+import pandas as pd
+from datetime import datetime, date
 
 from app.models.financial_models import FinancialTransaction, TransactionType, CategoryType
 from app.services.data_service import DataService
+from app.services.data_registry import data_service_registry
 from app.services.snowflake_service import snowflake_service
+from app.services.ledger_ingestion import IngestionReport, iter_upload_batches, validate_transaction_frame
+from app.services.pagination import PageCursor, MEMORY_SOURCE, WAREHOUSE_SOURCE
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
-def get_data_service(empresa_id: Optional[str] = Header(None, alias="X-Empresa-ID")) -> DataService:
-    """Dependency para obtener el servicio de datos con empresa_id del header"""
-    empresa = empresa_id or "E001"
-    return DataService(empresa_id=empresa)
+# Tamaño máximo de página del listado de transacciones
+MAX_PAGE_SIZE = int(os.getenv("TRANSACTIONS_MAX_PAGE_SIZE", "500"))
+# Máximo de altas/cambios/bajas por solicitud de mutación en bloque
+MAX_MUTATIONS = int(os.getenv("TRANSACTIONS_MAX_MUTATIONS", "50000"))
+
+async def get_data_service(empresa_id: Optional[str] = Header(None, alias="X-Empresa-ID")) -> DataService:
+    """Dependency para obtener el servicio de datos compartido de la empresa del header"""
+    # Si no hay empresa_id en header, usar default
+    return await data_service_registry.get(empresa_id or "E001")
 
 @router.get("/")
 async def get_transactions(
+    response: Response,
     limit: int = 10,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    category: Optional[CategoryType] = None,
+    transaction_type: Optional[TransactionType] = None,
     empresa_id: Optional[str] = Header(None, alias="X-Empresa-ID")
 ) -> List[Dict[str, Any]]:
-    """Obtener últimas transacciones"""
+    """Obtener transacciones paginadas por cursor (más recientes primero)
+
+    Los cursores de la página siguiente (más antigua) y anterior se devuelven en los
+    headers X-Next-Cursor y X-Prev-Cursor; el cuerpo sigue siendo la lista de transacciones.
+    """
     try:
         empresa = empresa_id or "E001"
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        if start and end and start > end:
+            raise HTTPException(status_code=400, detail="El rango de fechas es inválido: start es posterior a end")
+        try:
+            after_cursor = PageCursor.decode(after) if after else None
+            before_cursor = PageCursor.decode(before) if before else None
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        cursor = after_cursor or before_cursor
         
-        # Si hay conexión a Snowflake, obtener de ahí
-        if snowflake_service.connection:
-            transactions = snowflake_service.get_transactions(empresa)
-            return transactions[-limit:] if transactions else []
+        # Con Snowflake y sin datos ya en memoria, paginar en el warehouse (LIMIT en SQL)
+        use_warehouse = snowflake_service.is_connected and (
+            (cursor is not None and cursor.source == WAREHOUSE_SOURCE)
+            or (cursor is None and data_service_registry.peek(empresa) is None)
+        )
+        if use_warehouse:
+            page = await snowflake_service.list_transactions_page_async(
+                empresa,
+                limit,
+                after=(after_cursor.day, str(after_cursor.transaction_id)) if after_cursor else None,
+                before=(before_cursor.day, str(before_cursor.transaction_id)) if before_cursor else None,
+                start=start,
+                end=end,
+                category=category.value if category else None,
+                transaction_type=transaction_type.value if transaction_type else None
+            )
+            # Sin filas en el warehouse (p. ej. tabla cruda sin materializar): usar la memoria
+            if page is not None and (page[0] or cursor is not None):
+                rows, has_more = page
+                backward = before_cursor is not None and after_cursor is None
+                if rows and (has_more or backward):
+                    response.headers["X-Next-Cursor"] = PageCursor(WAREHOUSE_SOURCE, date.fromisoformat(rows[-1]["date"][:10]), rows[-1]["id"]).encode()
+                if rows and (has_more if backward else cursor is not None):
+                    response.headers["X-Prev-Cursor"] = PageCursor(WAREHOUSE_SOURCE, date.fromisoformat(rows[0]["date"][:10]), rows[0]["id"]).encode()
+                return rows
         
-        # Si no, usar DataService
-        data_service = DataService(empresa_id=empresa)
-        if not data_service.transactions:
-            await data_service.load_financial_data()
+        if cursor is not None and (cursor.source != MEMORY_SOURCE or not isinstance(cursor.transaction_id, int)):
+            raise HTTPException(status_code=400, detail="El cursor no corresponde a la fuente de datos actual; vuelva a la primera página")
         
-        # Obtener últimas transacciones
-        transactions = data_service.transactions[-limit:] if len(data_service.transactions) > limit else data_service.transactions
-        transactions.reverse()  # Más reciente primero
+        # DataService compartido de la empresa: búsqueda binaria sobre el índice (fecha, id)
+        data_service = await data_service_registry.get(empresa)
+        transactions, next_cursor, prev_cursor = data_service.list_transactions(
+            limit,
+            after=after_cursor,
+            before=before_cursor,
+            start=start,
+            end=end,
+            category=category,
+            transaction_type=transaction_type
+        )
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor.encode()
+        if prev_cursor:
+            response.headers["X-Prev-Cursor"] = prev_cursor.encode()
         
-        return [t.dict() if hasattr(t, 'dict') else t for t in transactions]
+        return [t.dict() for t in transactions]
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error obteniendo transacciones: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error obteniendo transacciones: {str(e)}")
@@ -50,14 +113,27 @@ async def get_transactions(
 @router.post("/")
 async def create_transaction(
     transaction: Dict[str, Any],
-    empresa_id: Optional[str] = Header(None, alias="X-Empresa-ID")
+    data_service: DataService = Depends(get_data_service)
 ) -> Dict[str, Any]:
     """Crear nueva transacción"""
     try:
-        empresa = empresa_id or "E001"
+        empresa = data_service.empresa_id
+        
+        try:
+            new_transaction = FinancialTransaction(
+                date=transaction.get('date'),
+                amount=transaction.get('amount'),
+                description=transaction.get('description') or '',
+                category=transaction.get('category'),
+                transaction_type=transaction.get('transaction_type'),
+                created_at=datetime.now()
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Transacción inválida: {str(e)}")
         
         # Insertar en Snowflake si está disponible
-        if snowflake_service.connection:
+        source_id = None
+        if snowflake_service.is_connected:
             transaction_data = {
                 'pyme_id': empresa,
                 'date': transaction.get('date'),
@@ -67,51 +143,174 @@ async def create_transaction(
                 'transaction_type': transaction.get('transaction_type')
             }
             
-            success = snowflake_service.insert_transaction(transaction_data)
-            if success:
+            source_id = await snowflake_service.insert_transaction_async(transaction_data)
+            if source_id:
                 logger.info(f"✅ Transacción insertada en Snowflake para empresa {empresa}")
             else:
                 logger.warning(f"⚠️ No se pudo insertar en Snowflake, pero continuando...")
         
+        # Actualizar datos en memoria y métricas de forma incremental
+        created = data_service.add_transaction(new_transaction, source_id=source_id)
+        data_service_registry.refresh_memory(empresa)
+        
         return {
             "success": True,
             "message": "Transacción creada exitosamente",
-            "transaction": transaction
+            "transaction": created.dict()
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error creando transacción: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error creando transacción: {str(e)}")
 
+@router.post("/bulk")
+async def bulk_create_transactions(
+    request: Request,
+    format: Optional[str] = None,
+    data_service: DataService = Depends(get_data_service)
+) -> Dict[str, Any]:
+    """Carga masiva de transacciones desde un cuerpo NDJSON o CSV (procesado por lotes)"""
+    try:
+        empresa = data_service.empresa_id
+        content_type = request.headers.get("content-type", "")
+        upload_format = (format or ("csv" if "csv" in content_type else "ndjson")).lower()
+        if upload_format not in ("ndjson", "csv"):
+            raise HTTPException(status_code=400, detail="Formato no soportado: use ndjson o csv")
+        
+        report = IngestionReport(source=f"bulk:{empresa}")
+        batches = []
+        rows_seen = rejected_seen = 0  # Los contadores incluyen líneas mal formadas del lote
+        async for batch in iter_upload_batches(request.stream(), upload_format, report):
+            valid = validate_transaction_frame(batch, report)
+            
+            # Un solo write_pandas por lote, en el executor de Snowflake
+            source_ids = None
+            if snowflake_service.is_connected and not valid.empty:
+                source_ids = await snowflake_service.insert_transactions_async(empresa, valid)
+                if not source_ids:
+                    logger.warning(f"⚠️ No se pudo cargar el lote {len(batches) + 1} en Snowflake, pero continuando...")
+            
+            data_service.add_transactions_frame(valid, source_ids=source_ids)
+            batches.append({
+                "batch": len(batches) + 1,
+                "rows": report.rows_read - rows_seen,
+                "accepted": len(valid),
+                "rejected": report.rows_rejected - rejected_seen,
+                "loaded_to_snowflake": bool(source_ids)
+            })
+            rows_seen, rejected_seen = report.rows_read, report.rows_rejected
+        
+        report.done = True
+        data_service_registry.refresh_memory(empresa)
+        summary = report.to_dict()
+        
+        return {
+            "success": report.rows_accepted > 0 or report.rows_read == 0,
+            "message": f"{report.rows_accepted} transacciones cargadas, {report.rows_rejected} rechazadas",
+            "format": upload_format,
+            "total_rows": report.rows_read,
+            "total_accepted": report.rows_accepted,
+            "total_rejected": report.rows_rejected,
+            "batches": batches,
+            "errors": summary["errors"],
+            "errors_truncated": summary["errors_truncated"]
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error en carga masiva de transacciones: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error en carga masiva: {str(e)}")
+
+@router.post("/mutations")
+async def mutate_transactions(
+    mutations: Dict[str, Any],
+    data_service: DataService = Depends(get_data_service)
+) -> Dict[str, Any]:
+    """Altas/cambios (`upserts`) y bajas (`deletes`) en bloque: un MERGE en Snowflake y un solo paso en memoria"""
+    try:
+        empresa = data_service.empresa_id
+        upserts = mutations.get("upserts") or []
+        deletes = [str(transaction_id) for transaction_id in mutations.get("deletes") or []]
+        if not isinstance(upserts, list) or not (upserts or deletes):
+            raise HTTPException(status_code=400, detail="Se requiere al menos una mutación en 'upserts' o 'deletes'")
+        if len(upserts) + len(deletes) > MAX_MUTATIONS:
+            raise HTTPException(status_code=400, detail=f"Máximo {MAX_MUTATIONS} mutaciones por solicitud")
+        
+        # Validar todo antes de tocar el warehouse o la memoria
+        report = IngestionReport(source=f"mutations:{empresa}")
+        frame = pd.DataFrame(upserts)
+        valid = validate_transaction_frame(frame, report) if upserts else frame
+        if report.rows_rejected:
+            raise HTTPException(status_code=400, detail={"message": "Hay upserts inválidos", "errors": report.to_dict()["errors"]})
+        
+        requested_ids = [row.get("id") for row in upserts]
+        local_ids, source_ids = data_service.resolve_transaction_ids(requested_ids)
+        delete_local_ids, delete_source_ids = data_service.resolve_transaction_ids(deletes)
+        # Ids numéricos = ids locales, que deben existir; los de Snowflake pueden no estar en memoria
+        missing = [
+            str(requested) for requested, local in zip(requested_ids + deletes, local_ids + delete_local_ids)
+            if requested is not None and str(requested).isdigit() and local is None
+        ]
+        if missing:
+            raise HTTPException(status_code=404, detail=f"Transacciones no encontradas: {', '.join(missing[:20])}")
+        touched = [local for local in local_ids + delete_local_ids if local is not None]
+        if len(touched) != len(set(touched)):
+            raise HTTPException(status_code=400, detail="Una transacción aparece más de una vez en la solicitud")
+        
+        # Un solo MERGE desde staging en el executor de Snowflake
+        loaded_source_ids = None
+        if snowflake_service.is_connected:
+            loaded_source_ids = await snowflake_service.apply_transaction_mutations_async(
+                empresa,
+                valid.assign(transaction_id=source_ids),
+                [source_id for source_id in delete_source_ids if source_id]
+            )
+            if loaded_source_ids is None:
+                logger.warning(f"⚠️ No se pudieron aplicar las mutaciones en Snowflake, pero continuando...")
+        
+        counts = data_service.apply_mutations(
+            valid,
+            local_ids,
+            [local for local in delete_local_ids if local is not None],
+            source_ids=loaded_source_ids
+        )
+        data_service_registry.refresh_memory(empresa)
+        
+        return {
+            "success": True,
+            "message": f"{counts['inserted']} creadas, {counts['updated']} actualizadas, {counts['deleted']} eliminadas",
+            **counts,
+            "applied_to_snowflake": loaded_source_ids is not None
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error aplicando mutaciones: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error aplicando mutaciones: {str(e)}")
+
 @router.delete("/{transaction_id}")
 async def delete_transaction(
-    transaction_id: int,
-    empresa_id: Optional[str] = Header(None, alias="X-Empresa-ID")
+    transaction_id: str,
+    data_service: DataService = Depends(get_data_service)
 ) -> Dict[str, Any]:
-    """Eliminar transacción"""
+    """Eliminar transacción (por id local o por transaction_id de Snowflake del listado paginado)"""
     try:
-        empresa = empresa_id or "E001"
+        empresa = data_service.empresa_id
+        (local_id,), (source_id,) = data_service.resolve_transaction_ids([transaction_id])
         
-        # Eliminar de Snowflake si está disponible
-        if snowflake_service.connection:
-            try:
-                cursor = snowflake_service.connection.cursor()
-                
-                cursor.execute("""
-                    DELETE FROM transactions 
-                    WHERE transaction_id = ? AND pyme_id = ?
-                """, (transaction_id, empresa))
-                cursor.close()
-                snowflake_service.connection.commit()
-                
-                logger.info(f"✅ Transacción {transaction_id} eliminada de Snowflake")
-            except Exception as e:
-                logger.error(f"❌ Error eliminando de Snowflake: {e}")
+        # Eliminar de Snowflake si está disponible y la fila tiene id allí
+        if snowflake_service.is_connected and source_id:
+            await snowflake_service.delete_transaction_async(empresa, source_id)
+        
+        # Descontar de los datos en memoria y métricas de forma incremental
+        removed = local_id is not None and data_service.remove_transaction(local_id)
+        data_service_registry.refresh_memory(empresa)
         
         return {
             "success": True,
-            "message": f"Transacción {transaction_id} eliminada"
+            "message": f"Transacción {transaction_id} eliminada" if removed else f"Transacción {transaction_id} no encontrada en memoria"
         }
     except Exception as e:
         logger.error(f"Error eliminando transacción: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error eliminando transacción: {str(e)}")
-
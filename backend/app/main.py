@@ -13,7 +13,9 @@ from contextlib import asynccontextmanager
 
 from app.api import analysis, simulations, chat, transactions
 from app.services.data_service import DataService
-from app.services.gemini_service import GeminiService
+from app.services.data_registry import data_service_registry
+from app.services.snowflake_service import snowflake_service
+from app.services.gemini_service import gemini_service
 from app.models.financial_models import FinancialData, SimulationRequest, ChatMessage
 
 # Cargar variables de entorno (busca en el directorio actual primero)
@@ -21,23 +23,24 @@ load_dotenv()  # Busca .env en el directorio actual (backend)
 
 # Servicios globales
 data_service = None
-gemini_service = None
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Inicializar servicios al startup"""
-    global data_service, gemini_service
+    global data_service
     
     try:
         print("🚀 Iniciando servicios...")
         
-        # Inicializar servicios
-        data_service = DataService()
-        gemini_service = GeminiService()
+        # Resolver y probar el modelo de Gemini en segundo plano (una sola vez por proceso)
+        gemini_service.start()
         
         print("📊 Cargando datos financieros...")
-        # Cargar datos iniciales
-        await data_service.load_financial_data()
+        # Cargar datos iniciales de la empresa por defecto en el registro compartido
+        data_service = await data_service_registry.get(os.getenv("DEFAULT_EMPRESA_ID", "E001"))
+        
+        # Sincronización incremental periódica con Snowflake (0 la desactiva)
+        data_service_registry.start_background_refresh(float(os.getenv("SNOWFLAKE_SYNC_INTERVAL_SECONDS", "300")))
         
         print("✅ Servicios inicializados correctamente")
         
@@ -45,13 +48,13 @@ async def lifespan(app: FastAPI):
         print(f"❌ Error durante la inicialización: {str(e)}")
         # Continuar sin datos si hay error
         data_service = None
-        gemini_service = None
     
     yield
     
     # Cleanup al shutdown
-    if data_service:
-        await data_service.close()
+    await data_service_registry.close()
+    await gemini_service.close()
+    snowflake_service.disconnect()
 
 # Crear aplicación FastAPI
 app = FastAPI(
@@ -75,6 +78,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Prev-Cursor"],
 )
 
 # Incluir routers
@@ -105,8 +109,11 @@ async def health_check():
         "status": "healthy",
         "services": {
             "data_service": data_service is not None,
-            "gemini_service": gemini_service is not None
-        }
+            "gemini_service": gemini_service.is_available
+        },
+        "gemini": gemini_service.stats(),
+        "data_registry": data_service_registry.stats(),
+        "snowflake": snowflake_service.stats()
     }
 
 @app.get("/api/data/summary")
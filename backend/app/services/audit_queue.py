@@ -0,0 +1,218 @@
+"""
+Cola write-behind para escrituras de auditoría en Snowflake
+Los registros (conversaciones de chat, simulaciones) se encolan sin bloquear la solicitud y
+un hilo propio los escribe en lotes por tamaño o tiempo, con reintentos y archivo de derrame
+"""
+
+import json
+import time
+import queue
+import logging
+import threading
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class AuditWriteQueue:
+    """Agrupa registros por tipo y los escribe con `writer(tipo, registros)` desde un hilo de fondo
+
+    `writer` debe lanzar una excepción si la escritura falla. Tras agotar los reintentos
+    los registros se derraman a un archivo JSONL local y se reintentan más tarde.
+    """
+
+    def __init__(
+        self,
+        writer: Callable[[str, List[Dict[str, Any]]], None],
+        batch_size: int = 500,
+        flush_interval: float = 2.0,
+        max_depth: int = 10000,
+        max_retries: int = 3,
+        backoff_seconds: float = 0.5,
+        spill_path: Optional[Path] = None,
+        spill_retry_seconds: float = 60.0
+    ):
+        self.writer = writer
+        self.batch_size = max(int(batch_size), 1)
+        self.flush_interval = flush_interval
+        self.max_retries = max(int(max_retries), 1)
+        self.backoff_seconds = backoff_seconds
+        self.spill_path = Path(spill_path) if spill_path else None
+        self.spill_retry_seconds = spill_retry_seconds
+        self._queue: "queue.Queue[Tuple[str, Dict[str, Any]]]" = queue.Queue(maxsize=max(int(max_depth), 1))
+        self._spill_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+        self._next_spill_retry = 0.0
+        self.enqueued = 0
+        self.written = 0
+        self.failed_batches = 0
+        self.spilled = 0
+        self.last_flush: Optional[datetime] = None
+
+    def start(self) -> None:
+        """Arrancar el hilo de escritura (idempotente)"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="snowflake-audit", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Vaciar la cola (escribiendo o derramando) y detener el hilo"""
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def enqueue(self, kind: str, record: Dict[str, Any]) -> bool:
+        """Encolar un registro sin bloquear; si la cola está llena va directo al archivo de derrame"""
+        self.enqueued += 1
+        try:
+            self._queue.put_nowait((kind, record))
+            return True
+        except queue.Full:
+            self._spill([(kind, record)])
+            return False
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def _run(self) -> None:
+        while not (self._stopping.is_set() and self._queue.empty()):
+            try:
+                batch = self._collect()
+                if batch:
+                    self._write(batch)
+                elif not self._stopping.is_set() and time.monotonic() >= self._next_spill_retry:
+                    self._replay_spill()
+            except Exception as e:
+                # El hilo no debe morir: sin él nada vuelve a escribir la cola ni el derrame
+                logger.error(f"❌ Error en la cola de auditoría: {e}")
+                time.sleep(min(self.flush_interval, 1.0))
+
+    def _collect(self) -> List[Tuple[str, Dict[str, Any]]]:
+        """Esperar el primer registro y juntar más hasta llenar el lote o cumplir el intervalo"""
+        batch: List[Tuple[str, Dict[str, Any]]] = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                # Al detenerse no se espera: solo se drena lo pendiente
+                batch.append(self._queue.get(timeout=0 if self._stopping.is_set() else min(remaining, 0.5)))
+            except queue.Empty:
+                if self._stopping.is_set():
+                    break
+        return batch
+
+    def _write(self, batch: List[Tuple[str, Dict[str, Any]]]) -> None:
+        """Escribir un lote agrupado por tipo, reintentando con backoff exponencial"""
+        grouped: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        for kind, record in batch:
+            grouped[kind].append(record)
+
+        for kind, records in grouped.items():
+            delay = self.backoff_seconds
+            for attempt in range(1, self.max_retries + 1):
+                try:
+                    self.writer(kind, records)
+                    self.written += len(records)
+                    self.last_flush = datetime.now()
+                    break
+                except Exception as e:
+                    if attempt == self.max_retries or self._stopping.is_set():
+                        self.failed_batches += 1
+                        logger.error(f"❌ Lote de auditoría '{kind}' no escrito ({len(records)} registros): {e}")
+                        self._spill([(kind, record) for record in records])
+                        # Sin warehouse no tiene sentido reintentar el derrame de inmediato
+                        self._next_spill_retry = time.monotonic() + self.spill_retry_seconds
+                        break
+                    logger.warning(f"⚠️ Escritura de auditoría falló (intento {attempt}/{self.max_retries}): {e}")
+                    time.sleep(delay)
+                    delay *= 2
+
+    def _spill(self, records: List[Tuple[str, Dict[str, Any]]]) -> None:
+        """Anexar registros al archivo de derrame (o descartarlos si no hay archivo configurado)"""
+        if self.spill_path is None:
+            logger.warning(f"⚠️ {len(records)} registros de auditoría descartados (sin archivo de derrame)")
+            return
+        try:
+            with self._spill_lock:
+                self.spill_path.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.spill_path, "a", encoding="utf-8") as spill:
+                    for kind, record in records:
+                        spill.write(json.dumps({"kind": kind, "record": record}, default=str) + "\n")
+            self.spilled += len(records)
+        except OSError as e:
+            logger.error(f"❌ No se pudo escribir el archivo de derrame de auditoría: {e}")
+
+    def _replay_spill(self) -> None:
+        """Reenviar lo derramado; si vuelve a fallar, el resto se derrama de nuevo sin reintentar"""
+        self._next_spill_retry = time.monotonic() + self.spill_retry_seconds
+        if self.spill_path is None:
+            return
+        replay_path = self.spill_path.with_suffix(self.spill_path.suffix + ".replay")
+        with self._spill_lock:
+            # Un reenvío interrumpido (p. ej. por un reinicio) se retoma antes de tomar el derrame nuevo
+            if not replay_path.exists():
+                if not self.spill_path.exists():
+                    return
+                self.spill_path.replace(replay_path)
+        
+        entries: List[Tuple[str, Dict[str, Any]]] = []
+        corrupt: List[str] = []
+        with open(replay_path, encoding="utf-8", errors="replace") as spill:
+            for line in spill:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                    entries.append((entry["kind"], entry["record"]))
+                except (ValueError, KeyError, TypeError):
+                    # Línea truncada (p. ej. por un corte durante la escritura) o corrupta
+                    corrupt.append(line if line.endswith("\n") else line + "\n")
+        if corrupt:
+            self._quarantine(corrupt)
+        
+        failed_before = self.failed_batches
+        for start in range(0, len(entries), self.batch_size):
+            batch = entries[start:start + self.batch_size]
+            if self.failed_batches > failed_before:
+                self._spill(batch)
+            else:
+                self._write(batch)
+        replay_path.unlink(missing_ok=True)
+        if self.failed_batches == failed_before:
+            logger.info(f"🔄 {len(entries)} registros de auditoría derramados reenviados a Snowflake")
+
+    def _quarantine(self, lines: List[str]) -> None:
+        """Apartar líneas ilegibles del derrame en un archivo .bad para revisión manual"""
+        bad_path = self.spill_path.with_suffix(self.spill_path.suffix + ".bad")
+        logger.warning(f"⚠️ {len(lines)} líneas ilegibles del derrame de auditoría apartadas en {bad_path}")
+        try:
+            with open(bad_path, "a", encoding="utf-8") as bad:
+                bad.writelines(lines)
+        except OSError as e:
+            logger.error(f"❌ No se pudieron apartar las líneas ilegibles del derrame: {e}")
+    
+    def stats(self) -> Dict[str, Any]:
+        spill_records = 0
+        if self.spill_path is not None and self.spill_path.exists():
+            with self._spill_lock, open(self.spill_path, "rb") as spill:
+                spill_records = sum(1 for _ in spill)
+        return {
+            "depth": self.depth,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "failed_batches": self.failed_batches,
+            "spilled": self.spilled,
+            "spill_file_records": spill_records,
+            "last_flush": self.last_flush.isoformat() if self.last_flush else None
+        }
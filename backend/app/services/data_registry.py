@@ -0,0 +1,137 @@
+"""
+Registro de servicios de datos por empresa
+Mantiene un DataService de larga vida por X-Empresa-ID con expulsión LRU/TTL y límite de memoria
+"""
+
+import asyncio
+import os
+import threading
+import logging
+import weakref
+from typing import Any, Dict, Optional
+
+from app.services.data_service import DataService
+from app.services.lru_cache import LRUTTLCache
+from app.services.snowflake_service import snowflake_service
+
+logger = logging.getLogger(__name__)
+
+
+class DataServiceRegistry:
+    """Registro a nivel de proceso que comparte un DataService cargado por empresa"""
+
+    def __init__(
+        self,
+        max_empresas: int = 64,
+        ttl_seconds: Optional[float] = 3600,
+        max_memory_mb: Optional[float] = 512
+    ):
+        self._services = LRUTTLCache(
+            max_entries=max_empresas,
+            ttl_seconds=ttl_seconds,
+            max_weight=int(max_memory_mb * 1024 * 1024) if max_memory_mb else None,
+            weigher=lambda service: service.estimate_memory_bytes(),
+            on_evict=self._on_evict
+        )
+        # X-Empresa-ID lo controla el cliente: cada lock vive solo mientras alguna petición lo usa
+        self._load_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+        self._locks_guard = threading.Lock()
+        self._refresher: Optional[asyncio.Task] = None
+
+    async def get(self, empresa_id: str) -> DataService:
+        """Obtener el servicio de la empresa, creándolo y cargándolo una sola vez"""
+        service = self._services.get(empresa_id)
+        if service is not None and service.data_loaded:
+            return service
+
+        async with self._load_lock(empresa_id):
+            # Otra petición pudo completar la carga mientras esperábamos el lock
+            service = self._services.get(empresa_id)
+            if service is None:
+                service = DataService(empresa_id=empresa_id)
+            if not service.data_loaded:
+                await service.load_financial_data()
+            self._services.set(empresa_id, service)
+            logger.info(f"📦 DataService registrado para empresa {empresa_id}")
+            return service
+
+    def peek(self, empresa_id: str) -> Optional[DataService]:
+        """Obtener el servicio si ya está registrado, sin crearlo"""
+        return self._services.peek(empresa_id)
+
+    def refresh_memory(self, empresa_id: str) -> None:
+        """Recalcular la memoria usada por una empresa tras cambios en sus datos"""
+        self._services.reweigh(empresa_id)
+
+    def invalidate(self, empresa_id: str) -> None:
+        """Descartar el servicio de una empresa para forzar una recarga"""
+        service = self._services.pop(empresa_id)
+        if service is not None:
+            self._schedule_close(service)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self._services.stats()
+        stats["empresas"] = [empresa_id for empresa_id, _ in self._services.items()]
+        return stats
+
+    def start_background_refresh(self, interval_seconds: float) -> None:
+        """Sincronizar periódicamente las empresas registradas con Snowflake (delta por marca de agua)"""
+        if interval_seconds <= 0 or self._refresher is not None:
+            return
+        self._refresher = asyncio.get_running_loop().create_task(self._refresh_loop(interval_seconds))
+
+    async def _refresh_loop(self, interval_seconds: float) -> None:
+        while True:
+            await asyncio.sleep(interval_seconds)
+            # Materializar primero lo nuevo de ROW_DATA_EMPRESA para que la sincronización lo vea
+            try:
+                await snowflake_service.refresh_ledger_async()
+            except Exception as e:
+                logger.error(f"Error refrescando la tabla materializada: {e}")
+            for empresa_id, service in self._services.items():
+                try:
+                    if await service.sync_from_snowflake():
+                        self.refresh_memory(empresa_id)
+                except Exception as e:
+                    logger.error(f"Error sincronizando empresa {empresa_id}: {e}")
+
+    async def close(self) -> None:
+        """Cerrar todos los servicios registrados"""
+        if self._refresher is not None:
+            self._refresher.cancel()
+            self._refresher = None
+        for _, service in self._services.items():
+            await service.close()
+        self._services.clear()
+
+    def _load_lock(self, empresa_id: str) -> asyncio.Lock:
+        with self._locks_guard:
+            lock = self._load_locks.get(empresa_id)
+            if lock is None:
+                lock = asyncio.Lock()
+                self._load_locks[empresa_id] = lock
+            return lock
+
+    def _on_evict(self, empresa_id: str, service: DataService) -> None:
+        logger.info(f"♻️ DataService de empresa {empresa_id} expulsado del registro")
+        self._schedule_close(service)
+
+    def _schedule_close(self, service: DataService) -> None:
+        try:
+            asyncio.get_running_loop().create_task(service.close())
+        except RuntimeError:
+            # Sin event loop activo (p. ej. desde un hilo): no hay recursos asíncronos pendientes
+            pass
+
+
+def _optional_float(name: str, default: str) -> Optional[float]:
+    value = float(os.getenv(name, default))
+    return value if value > 0 else None
+
+
+# Instancia global del registro
+data_service_registry = DataServiceRegistry(
+    max_empresas=int(os.getenv("DATA_CACHE_MAX_EMPRESAS", "64")),
+    ttl_seconds=_optional_float("DATA_CACHE_TTL_SECONDS", "3600"),
+    max_memory_mb=_optional_float("DATA_CACHE_MAX_MB", "512")
+)
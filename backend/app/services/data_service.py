@@ -6,29 +6,51 @@ Maneja la carga, procesamiento y análisis de datos financieros desde Excel, Sno
 import pandas as pd
 import numpy as np
 from datetime import datetime, date, timedelta
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 import sqlite3
 import os
+import time
 from pathlib import Path
 import logging
+import asyncio
 
 from app.models.financial_models import (
     FinancialTransaction, FinancialMetrics, CashFlowData, 
     TransactionType, CategoryType
 )
-from app.services.snowflake_service import snowflake_service
+from app.services.snowflake_service import snowflake_service, WarehouseLoad
+from app.services.transaction_store import (
+    TransactionStore, CATEGORY_CODES, TYPE_CODES, date_to_day, day_to_date, days_from_datetimes
+)
+from app.services.aggregates import FinancialAggregates
+from app.services.date_index import DateRangeIndex
+from app.services.pagination import KeysetIndex, PageCursor, MEMORY_SOURCE
+from app.services.ledger_ingestion import IngestionReport
+from app.services.ledger_cache import ledger_cache
 
 logger = logging.getLogger(__name__)
 
-# Caché global por empresa
-_data_cache: Dict[str, Dict[str, Any]] = {}
+# Estimación de memoria por periodo del historial de flujo de caja
+_CASH_FLOW_MEMORY_BYTES = 512
+# Cada cuánto se comparan los ids locales con los vigentes en Snowflake para aplicar bajas (0 = en cada sincronización)
+SNOWFLAKE_RECONCILE_INTERVAL_SECONDS = float(os.getenv("SNOWFLAKE_RECONCILE_INTERVAL_SECONDS", "900"))
 
 class DataService:
     def __init__(self, db_path: str = "asesor_pyme.db", use_snowflake: bool = True, empresa_id: str = None):
         self.db_path = db_path
         self.data_path = Path("data")
         self.empresa_id = empresa_id or os.getenv("DEFAULT_EMPRESA_ID", "E001")
-        self.transactions: List[FinancialTransaction] = []
+        self.transactions = TransactionStore()
+        self.aggregates = FinancialAggregates()
+        self._keyset_index: Optional[KeysetIndex] = None
+        self.source_ids: Dict[int, str] = {}  # id local -> transaction_id en Snowflake
+        self.ingestion_reports: Dict[str, IngestionReport] = {}  # Avance de la ingesta por archivo
+        # Sincronización incremental: marca de agua (máximo updated_at) por tabla tipada y
+        # última reconciliación de bajas contra los ids vigentes en el warehouse
+        self.sync_watermarks: Dict[str, datetime] = {}
+        self.last_sync: Optional[datetime] = None
+        self._last_reconcile = 0.0
+        self._sync_lock = asyncio.Lock()
         self.metrics: Optional[FinancialMetrics] = None
         self.cash_flow_history: List[CashFlowData] = []
         self.use_snowflake = use_snowflake
@@ -37,30 +59,23 @@ class DataService:
         self.use_sample_data = os.getenv("USE_SAMPLE_DATA", "true").lower() == "true"  # TRUE por defecto
         self.skip_excel_loading = os.getenv("SKIP_EXCEL_LOADING", "true").lower() == "true"  # TRUE por defecto
         
-        # Verificar si ya tenemos datos en caché para esta empresa
-        if self.empresa_id in _data_cache:
-            cached_data = _data_cache[self.empresa_id]
-            self.transactions = cached_data.get('transactions', [])
-            self.metrics = cached_data.get('metrics')
-            self.cash_flow_history = cached_data.get('cash_flow_history', [])
-            self.data_loaded = True
-            print(f"📊 Datos cargados desde caché para empresa {self.empresa_id}: {len(self.transactions)} transacciones")
-        
         # SIEMPRE usar datos de ejemplo por defecto (rápido y eficiente)
         # No intentar conectar con Snowflake ni cargar Excel a menos que se especifique explícitamente
         if self.use_sample_data:
             logger.info("📊 Modo de datos de ejemplo activado - omitiendo Snowflake y Excel")
             self.use_snowflake = False
+        
+    async def _connect_snowflake(self):
+        """Conectar con Snowflake SOLO si el usuario lo solicita explícitamente (sin bloquear el event loop)"""
+        if self.use_sample_data or not self.use_snowflake or self.snowflake_connected:
+            return
+        # El pool y el DDL se crean una sola vez por proceso
+        self.snowflake_connected = await snowflake_service.ensure_connected_async()
+        if self.snowflake_connected:
+            logger.info("✅ Snowflake habilitado y conectado")
         else:
-            # Intentar conectar con Snowflake SOLO si el usuario lo solicita explícitamente
-            if self.use_snowflake:
-                self.snowflake_connected = snowflake_service.connect()
-                if self.snowflake_connected:
-                    snowflake_service.create_tables()
-                    logger.info("✅ Snowflake habilitado y conectado")
-                else:
-                    logger.warning("⚠️ Snowflake no disponible, usando datos de ejemplo por defecto")
-                    self.use_sample_data = True
+            logger.warning("⚠️ Snowflake no disponible, usando datos de ejemplo por defecto")
+            self.use_sample_data = True
         
     async def load_financial_data(self):
         """Cargar datos financieros de manera eficiente (solo una vez)"""
@@ -69,6 +84,8 @@ class DataService:
             return
             
         try:
+            await self._connect_snowflake()
+            
             # Si está en modo de datos de ejemplo, cargar directamente
             if self.use_sample_data:
                 print("📊 Modo rápido: Cargando datos de ejemplo...")
@@ -78,12 +95,13 @@ class DataService:
                 # Intentar Snowflake primero
                 if self.use_snowflake and self.snowflake_connected:
                     print("📊 Cargando datos desde Snowflake...")
-                    # Usar E001 como default (tiene datos reales en ROW_DATA_EMPRESA)
-                    # TODO: Debería venir del JWT del usuario logueado
-                    empresa_id = os.getenv("DEFAULT_EMPRESA_ID", "E001")
-                    snowflake_transactions = snowflake_service.get_transactions(empresa_id)
-                    if snowflake_transactions:
-                        self.transactions = [FinancialTransaction(**t) for t in snowflake_transactions]
+                    # Lotes Arrow directo al almacén columnar, sin dicts ni modelos por fila
+                    loaded = await snowflake_service.load_transaction_store_async(self.empresa_id)
+                    if loaded and loaded.store:
+                        self.transactions, self.source_ids = loaded.store, loaded.source_ids
+                        self.sync_watermarks = dict(loaded.watermarks)
+                        self.last_sync = datetime.now()
+                        self._last_reconcile = time.monotonic()
                         print(f"✅ Cargados {len(self.transactions)} transacciones desde Snowflake")
                     else:
                         print("⚠️ No se encontraron datos en Snowflake")
@@ -101,28 +119,19 @@ class DataService:
                     self.transactions = self._load_sample_data()
 
             # Procesar datos
-            self.transactions.sort(key=lambda t: t.date)
-            self.metrics = self._calculate_metrics()
-            self.cash_flow_history = self._calculate_cash_flow_history()
-            
-            # Guardar en caché
-            _data_cache[self.empresa_id] = {
-                'transactions': self.transactions,
-                'metrics': self.metrics,
-                'cash_flow_history': self.cash_flow_history
-            }
+            self.transactions.sort_by_date()
+            self._rebuild_aggregates()
             
-            # Marcar como cargado
+            # Marcar como cargado (el registro por empresa conserva esta instancia)
             self.data_loaded = True
-            print(f"✅ Datos financieros cargados exitosamente: {len(self.transactions)} transacciones (caché actualizado)")
+            print(f"✅ Datos financieros cargados exitosamente: {len(self.transactions)} transacciones")
 
         except Exception as e:
             logger.error(f"Error al cargar datos financieros: {e}")
             # Fallback garantizado a datos de ejemplo
             print("📊 Error crítico, usando datos de ejemplo como fallback...")
             self.transactions = self._load_sample_data()
-            self.metrics = self._calculate_metrics()
-            self.cash_flow_history = self._calculate_cash_flow_history()
+            self._rebuild_aggregates()
             self.data_loaded = True
             print(f"✅ Fallback exitoso: {len(self.transactions)} transacciones de ejemplo")
     
@@ -130,25 +139,31 @@ class DataService:
         """Carga datos desde Excel y los migra a Snowflake si está conectado."""
         empresa_data = await self._load_excel_data("finanzas_empresa.xlsx")
         if empresa_data:
-            self.transactions.extend(empresa_data)
+            self.transactions.extend_from(empresa_data)
             print(f"✅ Cargados {len(empresa_data)} transacciones de empresa desde Excel")
             if self.use_snowflake and self.snowflake_connected:
-                snowflake_service.insert_transactions([t.dict() for t in empresa_data])
+                await snowflake_service.insert_transactions_async(self.empresa_id, empresa_data.to_frame())
         
         personal_data = await self._load_excel_data("finanzas_personales.xlsx")
         if personal_data:
-            pyme_personal_data = [
-                t for t in personal_data if t.transaction_type == TransactionType.EXPENSE and t.category != CategoryType.OTHER
-            ]
-            self.transactions.extend(pyme_personal_data)
-            print(f"✅ Cargados {len(pyme_personal_data)} transacciones personales relevantes para PyME desde Excel")
+            # Solo gastos con categoría de negocio (máscara vectorizada sobre las columnas)
+            relevant = (
+                (personal_data.types == TYPE_CODES[TransactionType.EXPENSE.value])
+                & (personal_data.categories != CATEGORY_CODES[CategoryType.OTHER.value])
+            )
+            self.transactions.extend_from(personal_data, relevant)
+            print(f"✅ Cargados {int(relevant.sum())} transacciones personales relevantes para PyME desde Excel")
             if self.use_snowflake and self.snowflake_connected:
-                snowflake_service.insert_transactions([t.dict() for t in pyme_personal_data])
+                await snowflake_service.insert_transactions_async(self.empresa_id, personal_data.to_frame()[relevant])
+        # Las filas se anexaron en bloque: reordenar y reconstruir los agregados una sola vez
+        self.transactions.sort_by_date()
+        self._rebuild_aggregates()
+        return True
     
-    def _load_sample_data(self) -> List[FinancialTransaction]:
+    def _load_sample_data(self) -> TransactionStore:
         """Carga datos de ejemplo si no hay datos disponibles."""
         today = date.today()
-        return [
+        return TransactionStore.from_transactions([
             FinancialTransaction(id=1, date=today.replace(day=1) - timedelta(days=30), amount=5000.0, description="Ventas Enero", category=CategoryType.SALES, transaction_type=TransactionType.INCOME, user_id="demo_user"),
             FinancialTransaction(id=2, date=today.replace(day=1) - timedelta(days=25), amount=1500.0, description="Alquiler Enero", category=CategoryType.OPERATING_EXPENSES, transaction_type=TransactionType.EXPENSE, user_id="demo_user"),
             FinancialTransaction(id=3, date=today.replace(day=1) - timedelta(days=20), amount=2000.0, description="Salarios Enero", category=CategoryType.PERSONNEL, transaction_type=TransactionType.EXPENSE, user_id="demo_user"),
@@ -169,99 +184,283 @@ class DataService:
             FinancialTransaction(id=18, date=today - timedelta(days=300), amount=1900.0, description="Alquiler Mayo", category=CategoryType.OPERATING_EXPENSES, transaction_type=TransactionType.EXPENSE, user_id="demo_user"),
             FinancialTransaction(id=19, date=today - timedelta(days=330), amount=2600.0, description="Salarios Mayo", category=CategoryType.PERSONNEL, transaction_type=TransactionType.EXPENSE, user_id="demo_user"),
             FinancialTransaction(id=20, date=today - timedelta(days=360), amount=10000.0, description="Ventas Junio", category=CategoryType.SALES, transaction_type=TransactionType.INCOME, user_id="demo_user"),
-        ]
+        ])
+    
+    def _rebuild_aggregates(self):
+        """Reconstruir en bloque los agregados incrementales y las vistas derivadas"""
+        self.aggregates = FinancialAggregates.from_store(self.transactions)
+        self._refresh_derived()
+    
+    def _refresh_derived(self):
+        """Actualizar métricas e historial a partir de los agregados (sin recorrer transacciones)"""
+        self.metrics = self._calculate_metrics()
+        self.cash_flow_history = self._calculate_cash_flow_history()
     
     def _calculate_metrics(self) -> FinancialMetrics:
-        """Calcula las métricas financieras a partir de las transacciones."""
-        if not self.transactions:
-            return FinancialMetrics()
-        
-        df = pd.DataFrame([t.dict() for t in self.transactions])
-        df['date'] = pd.to_datetime(df['date'])
-        df['month'] = df['date'].dt.to_period('M')
-        
-        # Asegurarse de que 'amount' es numérico
-        df['amount'] = pd.to_numeric(df['amount'], errors='coerce').fillna(0)
-        
-        # Filtrar por el último año para métricas principales
-        one_year_ago = datetime.now() - timedelta(days=365)
-        df_last_year = df[df['date'] >= one_year_ago]
-        
-        total_income = df_last_year[df_last_year['transaction_type'] == TransactionType.INCOME]['amount'].sum()
-        total_expenses = df_last_year[df_last_year['transaction_type'] == TransactionType.EXPENSE]['amount'].sum()
-        net_profit = total_income - total_expenses
-        profit_margin = (net_profit / total_income * 100) if total_income > 0 else 0
-        
-        # Cash Flow (simplificado: ingresos - gastos del último mes)
-        last_month_start = (datetime.now().replace(day=1) - timedelta(days=1)).replace(day=1)
-        df_last_month = df[(df['date'] >= last_month_start)]
-        cash_in = df_last_month[df_last_month['transaction_type'] == TransactionType.INCOME]['amount'].sum()
-        cash_out = df_last_month[df_last_month['transaction_type'] == TransactionType.EXPENSE]['amount'].sum()
-        current_cash_flow = cash_in - cash_out
-        
-        # Tendencia de flujo de caja (comparar con el mes anterior)
-        two_months_ago_start = (last_month_start.replace(day=1) - timedelta(days=1)).replace(day=1)
-        df_two_months_ago = df[(df['date'] >= two_months_ago_start) & (df['date'] < last_month_start)]
-        prev_cash_in = df_two_months_ago[df_two_months_ago['transaction_type'] == TransactionType.INCOME]['amount'].sum()
-        prev_cash_out = df_two_months_ago[df_two_months_ago['transaction_type'] == TransactionType.EXPENSE]['amount'].sum()
-        prev_cash_flow = prev_cash_in - prev_cash_out
-        
-        cash_flow_trend = "stable"
-        if current_cash_flow > prev_cash_flow:
-            cash_flow_trend = "positive"
-        elif current_cash_flow < prev_cash_flow:
-            cash_flow_trend = "negative"
-        
-        # Desglose de gastos - convertir valores a strings para asegurar compatibilidad
-        expense_breakdown = df_last_year[df_last_year['transaction_type'] == TransactionType.EXPENSE].groupby('category')['amount'].sum().to_dict()
-        expense_breakdown = {str(k): float(v) for k, v in expense_breakdown.items()}
-        
-        revenue_breakdown = df_last_year[df_last_year['transaction_type'] == TransactionType.INCOME].groupby('category')['amount'].sum().to_dict()
-        revenue_breakdown = {str(k): float(v) for k, v in revenue_breakdown.items()}
-        
-        return FinancialMetrics(
-            total_revenue=total_income,
-            total_expenses=total_expenses,
-            net_profit=net_profit,
-            profit_margin=profit_margin,
-            operating_margin=profit_margin,  # Usar profit_margin como operating_margin por ahora
-            cash_flow_trend=cash_flow_trend,
-            expense_breakdown=expense_breakdown,
-            revenue_breakdown=revenue_breakdown
-        )
+        """Calcula las métricas financieras a partir de los agregados por día."""
+        return self.aggregates.metrics()
     
     def _calculate_cash_flow_history(self) -> List[CashFlowData]:
-        """Calcula el historial de flujo de caja mensual."""
-        if not self.transactions:
-            return []
-        
-        df = pd.DataFrame([t.dict() for t in self.transactions])
-        df['date'] = pd.to_datetime(df['date'])
-        df['amount'] = pd.to_numeric(df['amount'], errors='coerce').fillna(0)
-        df['month'] = df['date'].dt.to_period('M')
-        
-        monthly_data = []
-        cumulative_balance = 0
-        for month, group in df.groupby('month'):
-            income = group[group['transaction_type'] == TransactionType.INCOME]['amount'].sum()
-            expenses = group[group['transaction_type'] == TransactionType.EXPENSE]['amount'].sum()
-            net_cash_flow = income - expenses
-            cumulative_balance += net_cash_flow
-            monthly_data.append(CashFlowData(
-                period=str(month),
-                income=income,
-                expenses=expenses,
-                net_cash_flow=net_cash_flow,
-                cumulative_balance=cumulative_balance
-            ))
-        
-        # Ordenar por mes
-        monthly_data.sort(key=lambda x: datetime.strptime(x.period, '%Y-%m'))
-        
-        return monthly_data
+        """Calcula el historial de flujo de caja mensual a partir de los agregados por mes."""
+        return self.aggregates.cash_flow_history()
+    
+    @property
+    def date_index(self) -> DateRangeIndex:
+        """Índice por fechas, mantenido por los agregados (sin recorrer el almacén tras cada escritura)"""
+        return self.aggregates.date_index
+    
+    @property
+    def keyset_index(self) -> KeysetIndex:
+        """Llaves (fecha, id) para paginar por cursor, reconstruidas solo si hubo escrituras"""
+        if self._keyset_index is None or self._keyset_index.version != self.transactions.version:
+            self._keyset_index = KeysetIndex(self.transactions)
+        return self._keyset_index
+    
+    def list_transactions(
+        self,
+        limit: int,
+        after: Optional[PageCursor] = None,
+        before: Optional[PageCursor] = None,
+        start: Optional[date] = None,
+        end: Optional[date] = None,
+        category: Optional[CategoryType] = None,
+        transaction_type: Optional[TransactionType] = None
+    ) -> Tuple[List[FinancialTransaction], Optional[PageCursor], Optional[PageCursor]]:
+        """Página de transacciones (más recientes primero) con cursores a la siguiente y la anterior"""
+        positions, older_exists, newer_exists = self.keyset_index.page(
+            self.transactions,
+            limit,
+            after=after,
+            before=before,
+            start=start,
+            end=end,
+            category_code=CATEGORY_CODES[category.value] if category is not None else None,
+            type_code=TYPE_CODES[transaction_type.value] if transaction_type is not None else None
+        )
+        # Solo se materializan las filas de la página
+        page = [self.transactions.materialize(int(position)) for position in positions]
+        next_cursor = PageCursor(MEMORY_SOURCE, page[-1].date, page[-1].id) if page and older_exists else None
+        prev_cursor = PageCursor(MEMORY_SOURCE, page[0].date, page[0].id) if page and newer_exists else None
+        return page, next_cursor, prev_cursor
+    
+    def add_transaction(self, transaction: FinancialTransaction, source_id: Optional[str] = None) -> FinancialTransaction:
+        """Agregar una transacción y actualizar métricas de forma incremental"""
+        transaction_id = self.transactions.insert_sorted(transaction)
+        self.aggregates.add(
+            date_to_day(transaction.date),
+            transaction.amount,
+            CATEGORY_CODES[CategoryType(transaction.category).value],
+            TYPE_CODES[TransactionType(transaction.transaction_type).value]
+        )
+        if source_id:
+            self.source_ids[transaction_id] = source_id
+        self._refresh_derived()
+        return transaction.model_copy(update={"id": transaction_id})
+    
+    def add_transactions_frame(self, frame: pd.DataFrame, source_ids: Optional[List[str]] = None) -> np.ndarray:
+        """Agregar un lote validado (esquema de TransactionStore.to_frame) y actualizar agregados en bloque"""
+        if frame.empty:
+            return np.empty(0, dtype=np.int64)
+        days = days_from_datetimes(frame["date"])
+        categories = frame["category"].cat.codes.to_numpy().astype(np.uint8)
+        types = frame["transaction_type"].cat.codes.to_numpy().astype(np.uint8)
+        amounts = frame["amount"].to_numpy(dtype=np.float64)
+        ids = self.transactions.extend_columns(
+            days=days,
+            amounts=amounts,
+            categories=categories,
+            types=types,
+            descriptions=frame["description"].astype(str).to_numpy()
+        )
+        self.transactions.sort_by_date()
+        self.aggregates.add_many(days, amounts, categories, types)
+        if source_ids:
+            self.source_ids.update(zip(ids.tolist(), source_ids))
+        self._refresh_derived()
+        return ids
+    
+    def resolve_transaction_ids(self, transaction_ids: List[Any]) -> Tuple[List[Optional[int]], List[Optional[str]]]:
+        """Traducir ids del API (id local o transaction_id de Snowflake) a (id local, id en Snowflake)
+
+        Un id ausente (None) o un id local inexistente se devuelven como None en ambos lados.
+        Una fila local sin id en Snowflake (datos de ejemplo, tabla cruda, solo en memoria)
+        devuelve None como id de origen: nunca se usa el id local como transaction_id.
+        """
+        present = set(self.transactions.ids.tolist()) if transaction_ids else set()
+        local_by_source: Optional[Dict[str, int]] = None
+        local_ids: List[Optional[int]] = []
+        source_ids: List[Optional[str]] = []
+        for transaction_id in transaction_ids:
+            text = str(transaction_id)
+            if transaction_id is None:
+                local_ids.append(None)
+                source_ids.append(None)
+            elif text.isdigit():
+                local_id = int(text)
+                if local_id in present:
+                    local_ids.append(local_id)
+                    source_ids.append(self.source_ids.get(local_id))
+                else:
+                    local_ids.append(None)
+                    source_ids.append(None)
+            else:
+                if local_by_source is None:
+                    local_by_source = {source: local for local, source in self.source_ids.items()}
+                local_ids.append(local_by_source.get(text))
+                source_ids.append(text)
+        return local_ids, source_ids
+    
+    def apply_mutations(
+        self,
+        upserts: pd.DataFrame,
+        upsert_ids: List[Optional[int]],
+        delete_ids: List[int],
+        source_ids: Optional[List[str]] = None
+    ) -> Dict[str, int]:
+        """Aplicar altas/cambios y bajas en un solo paso sobre el almacén y los agregados
+
+        `upserts` trae el esquema de TransactionStore.to_frame(); `upsert_ids` indica el id
+        local que reemplaza cada fila (None = alta). Todo se calcula antes de mutar y no hay
+        puntos de espera, así que ningún lector observa un estado intermedio.
+        """
+        store = self.transactions
+        updated_ids = np.array([local_id for local_id in upsert_ids if local_id is not None], dtype=np.int64)
+        touched = np.isin(store.ids, np.concatenate([updated_ids, np.asarray(delete_ids, dtype=np.int64)]))
+        
+        # Descontar primero las filas que se reemplazan o eliminan
+        if touched.any():
+            self.aggregates.remove_many(store.days[touched], store.amounts[touched], store.categories[touched], store.types[touched])
+        deleted = int(np.isin(store.ids[touched], np.asarray(delete_ids, dtype=np.int64)).sum())
+        store.remove(store.ids[touched].tolist())
+        for local_id in delete_ids:
+            self.source_ids.pop(local_id, None)
+        
+        if not upserts.empty:
+            days = days_from_datetimes(upserts["date"])
+            categories = upserts["category"].cat.codes.to_numpy().astype(np.uint8)
+            types = upserts["transaction_type"].cat.codes.to_numpy().astype(np.uint8)
+            amounts = upserts["amount"].to_numpy(dtype=np.float64)
+            descriptions = upserts["description"].astype(str).to_numpy()
+            is_update = np.array([local_id is not None for local_id in upsert_ids], dtype=bool)
+            ids = np.empty(len(upserts), dtype=np.int64)
+            for rows, kept_ids in ((is_update, updated_ids), (~is_update, None)):
+                if rows.any():
+                    ids[rows] = store.extend_columns(days[rows], amounts[rows], categories[rows], types[rows], descriptions[rows], ids=kept_ids)
+            self.aggregates.add_many(days, amounts, categories, types)
+            if source_ids:
+                self.source_ids.update(zip(ids.tolist(), source_ids))
+        
+        store.sort_by_date()
+        self._refresh_derived()
+        return {
+            "inserted": int(len(upsert_ids) - len(updated_ids)),
+            "updated": int(len(updated_ids)),
+            "deleted": deleted
+        }
     
-    async def _load_excel_data(self, filename: str) -> Optional[List[FinancialTransaction]]:
-        """Cargar datos desde archivo Excel"""
+    def apply_warehouse_changes(self, changes: WarehouseLoad) -> int:
+        """Fusionar filas nuevas o modificadas del warehouse, reemplazando por transaction_id
+
+        La ventana de relectura de la sincronización vuelve a traer filas ya aplicadas: las
+        idénticas a la copia local se omiten. Devuelve las filas realmente fusionadas.
+        """
+        incoming = changes.store
+        if not incoming:
+            return 0
+        store = self.transactions
+        local_by_source = {source_id: local_id for local_id, source_id in self.source_ids.items()}
+        incoming_local = np.array(
+            [local_by_source.get(changes.source_ids[i], -1) for i in incoming.ids.tolist()], dtype=np.int64
+        )
+        known = np.flatnonzero(incoming_local >= 0)
+        apply = np.ones(len(incoming), dtype=bool)
+        if len(known) and store:
+            order = np.argsort(store.ids, kind="stable")
+            positions = order[np.minimum(np.searchsorted(store.ids, incoming_local[known], sorter=order), len(order) - 1)]
+            local_descriptions = np.asarray(store.vocabulary, dtype=object)[store.description_codes[positions]]
+            incoming_descriptions = np.asarray(incoming.vocabulary, dtype=object)[incoming.description_codes[known]]
+            unchanged = (
+                (store.ids[positions] == incoming_local[known])
+                & (store.days[positions] == incoming.days[known])
+                & (store.amounts[positions] == incoming.amounts[known])
+                & (store.categories[positions] == incoming.categories[known])
+                & (store.types[positions] == incoming.types[known])
+                & (local_descriptions == incoming_descriptions)
+            )
+            apply[known[unchanged]] = False
+        if not apply.any():
+            return 0
+        
+        replaced = incoming_local[apply & (incoming_local >= 0)].tolist()
+        if replaced:
+            mask = np.isin(store.ids, replaced)
+            self.aggregates.remove_many(store.days[mask], store.amounts[mask], store.categories[mask], store.types[mask])
+            store.remove(replaced)
+            for local_id in replaced:
+                self.source_ids.pop(local_id, None)
+        
+        new_ids = store.extend_from(incoming, apply)
+        self.source_ids.update(zip(new_ids.tolist(), (changes.source_ids[i] for i in incoming.ids[apply].tolist())))
+        store.sort_by_date()
+        self.aggregates.add_many(incoming.days[apply], incoming.amounts[apply], incoming.categories[apply], incoming.types[apply])
+        self._refresh_derived()
+        return int(apply.sum())
+    
+    async def sync_from_snowflake(self) -> int:
+        """Traer lo nuevo o modificado de cada tabla tipada y, periódicamente, quitar lo borrado
+
+        Devuelve las filas fusionadas más las eliminadas.
+        """
+        if not self.snowflake_connected or not self.sync_watermarks:
+            return 0
+        async with self._sync_lock:
+            changed = 0
+            changes = await snowflake_service.fetch_transaction_changes_async(self.empresa_id, dict(self.sync_watermarks))
+            if changes is not None:
+                changed += self.apply_warehouse_changes(changes)
+                self.sync_watermarks.update(changes.watermarks)
+                self.last_sync = datetime.now()
+            if time.monotonic() - self._last_reconcile >= SNOWFLAKE_RECONCILE_INTERVAL_SECONDS:
+                changed += await self._reconcile_deletions()
+            if changed:
+                logger.info(f"🔄 {changed} transacciones sincronizadas para empresa {self.empresa_id}")
+            return changed
+    
+    async def _reconcile_deletions(self) -> int:
+        """Quitar las filas cuyo transaction_id ya no existe en el warehouse
+
+        Solo se consideran las filas con id de origen presentes antes de la consulta: las que
+        se agreguen mientras tanto ya están confirmadas en Snowflake o aún no tienen id.
+        """
+        known = set(self.source_ids.values())
+        remote = await snowflake_service.fetch_transaction_ids_async(self.empresa_id, list(self.sync_watermarks))
+        if remote is None:
+            return 0
+        self._last_reconcile = time.monotonic()
+        gone = known - remote
+        if not gone:
+            return 0
+        delete_ids = [local_id for local_id, source_id in self.source_ids.items() if source_id in gone]
+        return self.apply_mutations(pd.DataFrame(), [], delete_ids)["deleted"]
+    
+    def remove_transaction(self, transaction_id: int) -> bool:
+        """Eliminar una transacción y descontarla de los agregados"""
+        index = self.transactions.index_of(transaction_id)
+        if index is None:
+            return False
+        self.aggregates.remove(
+            int(self.transactions.days[index]),
+            float(self.transactions.amounts[index]),
+            int(self.transactions.categories[index]),
+            int(self.transactions.types[index])
+        )
+        self.transactions.remove([transaction_id])
+        self.source_ids.pop(transaction_id, None)
+        self._refresh_derived()
+        return True
+    
+    async def _load_excel_data(self, filename: str) -> Optional[TransactionStore]:
+        """Cargar datos desde archivo Excel/CSV (caché en disco o ingesta por bloques, fuera del event loop)"""
         file_path = self.data_path / filename
         
         print(f"🔍 Verificando archivo: {file_path}")
@@ -272,118 +471,35 @@ class DataService:
         
         try:
             print(f"📖 Leyendo archivo Excel: {filename}")
-            # Leer archivo Excel
-            df = pd.read_excel(file_path)
-            print(f"✅ Archivo leído exitosamente. Filas: {len(df)}, Columnas: {list(df.columns)}")
-            
-            if len(df) == 0:
-                print(f"⚠️ Archivo {filename} está vacío")
-                return None
-            
-            transactions = []
-            print(f"🔄 Procesando {len(df)} filas...")
-            for i, row in df.iterrows():
-                try:
-                    # Mapear columnas del Excel a nuestro modelo
-                    transaction = self._map_excel_row_to_transaction(row, filename)
-                    if transaction:
-                        transactions.append(transaction)
-                    if i % 100 == 0 and i > 0:  # Log cada 100 filas
-                        print(f"   Procesadas {i+1} filas...")
-                except Exception as e:
-                    print(f"⚠️ Error procesando fila {i}: {str(e)}")
-                    continue
-            
-            print(f"✅ Procesamiento completado. Transacciones válidas: {len(transactions)}")
-            return transactions if len(transactions) > 0 else None
+            report = IngestionReport(source=filename)
+            self.ingestion_reports[filename] = report
+            # La caché de libros procesados evita re-parsear si el archivo y las reglas no cambiaron
+            store, report, from_cache = await asyncio.to_thread(
+                ledger_cache.load_or_ingest, file_path, on_progress=self._log_ingestion_progress, report=report
+            )
+            self.ingestion_reports[filename] = report
+            if from_cache:
+                print(f"⚡ {filename} cargado desde la caché de libros procesados")
+            print(
+                f"✅ Procesamiento completado. Filas: {report.rows_read}, "
+                f"válidas: {report.rows_accepted}, rechazadas: {report.rows_rejected}"
+            )
+            if report.rows_rejected:
+                logger.warning(f"{report.rows_rejected} filas rechazadas en {filename}: {report.errors[:5]}")
+            return store
             
         except Exception as e:
             print(f"❌ Error al leer {filename}: {str(e)}")
             logger.error(f"Error al leer {filename}: {str(e)}")
             return None
     
-    def _map_excel_row_to_transaction(self, row: pd.Series, filename: str) -> Optional[FinancialTransaction]:
-        """Mapear fila de Excel a transacción financiera"""
-        try:
-            # Detectar columnas comunes en archivos financieros
-            amount_col = self._find_column(row, ['amount', 'monto', 'valor', 'importe'])
-            date_col = self._find_column(row, ['date', 'fecha', 'fecha_transaccion'])
-            desc_col = self._find_column(row, ['description', 'descripcion', 'concepto', 'detalle'])
-            category_col = self._find_column(row, ['category', 'categoria', 'tipo'])
-            
-            if not all([amount_col, date_col, desc_col]):
-                return None
-            
-            # Determinar tipo de transacción basado en el monto y descripción
-            amount = float(row[amount_col])
-            description = str(row[desc_col]).lower()
-            
-            if amount > 0:
-                transaction_type = TransactionType.INCOME
-            else:
-                transaction_type = TransactionType.EXPENSE
-                amount = abs(amount)
-            
-            # Mapear categoría
-            category = self._map_category(row.get(category_col, ''), description)
-            
-            # Parsear fecha
-            date_value = self._parse_date(row[date_col])
-            
-            return FinancialTransaction(
-                date=date_value,
-                amount=amount,
-                description=str(row[desc_col]),
-                category=category,
-                transaction_type=transaction_type,
-                created_at=datetime.now()
-            )
-            
-        except Exception as e:
-            logger.error(f"Error al mapear fila: {str(e)}")
-            return None
-    
-    def _find_column(self, row: pd.Series, possible_names: List[str]) -> Optional[str]:
-        """Encontrar columna por nombres posibles"""
-        for name in possible_names:
-            if name in row.index:
-                return name
-        return None
-    
-    def _map_category(self, category: str, description: str) -> CategoryType:
-        """Mapear categoría de texto a enum"""
-        category_lower = category.lower()
-        desc_lower = description.lower()
-        
-        if any(word in desc_lower for word in ['venta', 'ventas', 'sales', 'ingreso']):
-            return CategoryType.SALES
-        elif any(word in desc_lower for word in ['salario', 'empleado', 'personal', 'nómina']):
-            return CategoryType.PERSONNEL
-        elif any(word in desc_lower for word in ['marketing', 'publicidad', 'promocion']):
-            return CategoryType.MARKETING
-        elif any(word in desc_lower for word in ['equipo', 'maquinaria', 'computadora']):
-            return CategoryType.EQUIPMENT
-        elif any(word in desc_lower for word in ['luz', 'agua', 'telefono', 'internet']):
-            return CategoryType.UTILITIES
-        else:
-            return CategoryType.OTHER
-    
-    def _parse_date(self, date_value) -> date:
-        """Parsear fecha desde diferentes formatos"""
-        if isinstance(date_value, date):
-            return date_value
-        elif isinstance(date_value, datetime):
-            return date_value.date()
-        elif isinstance(date_value, str):
-            try:
-                return datetime.strptime(date_value, '%Y-%m-%d').date()
-            except:
-                try:
-                    return datetime.strptime(date_value, '%d/%m/%Y').date()
-                except:
-                    return date.today()
-        else:
-            return date.today()
+    def _log_ingestion_progress(self, report: IngestionReport):
+        """Registrar el avance de la ingesta (se llama desde el hilo lector después de cada bloque)"""
+        if report.done:
+            return
+        progress = report.progress
+        percent = f" ({progress * 100:.0f}%)" if progress is not None else ""
+        print(f"   Procesadas {report.rows_read} filas{percent}...")
     
     def _is_business_relevant(self, transaction: FinancialTransaction) -> bool:
         """Determinar si una transacción personal es relevante para el negocio"""
@@ -527,24 +643,30 @@ class DataService:
             ),
         ]
         
-        self.transactions = sample_transactions
-        await self._calculate_metrics()
-        await self._generate_cash_flow_history()
+        self.transactions = TransactionStore.from_transactions(sample_transactions)
+        self._rebuild_aggregates()
     
     async def get_data_summary(self) -> Dict[str, Any]:
         """Obtener resumen de datos disponibles"""
         return {
             "total_transactions": len(self.transactions),
             "date_range": {
-                "start": min(t.date for t in self.transactions) if self.transactions else None,
-                "end": max(t.date for t in self.transactions) if self.transactions else None
+                "start": day_to_date(self.transactions.days.min()) if self.transactions else None,
+                "end": day_to_date(self.transactions.days.max()) if self.transactions else None
             },
             "metrics_available": self.metrics is not None,
             "cash_flow_periods": len(self.cash_flow_history),
             "data_sources": ["finanzas_empresa.xlsx", "finanzas_personales.xlsx"],
+            "ingestion": {name: report.to_dict() for name, report in self.ingestion_reports.items()},
             "last_updated": datetime.now().isoformat()
         }
     
+    def estimate_memory_bytes(self) -> int:
+        """Estimar la memoria ocupada por los datos de la empresa"""
+        index_bytes = self.aggregates.date_index_nbytes
+        index_bytes += self._keyset_index.keys.nbytes if self._keyset_index is not None else 0
+        return self.transactions.nbytes + index_bytes + len(self.cash_flow_history) * _CASH_FLOW_MEMORY_BYTES
+    
     async def close(self):
         """Cerrar conexiones y limpiar recursos"""
         pass
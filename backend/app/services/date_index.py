@@ -0,0 +1,215 @@
+"""
+Índice por rango de fechas sobre el almacén de transacciones
+Sumas prefijo diarias (tipo × categoría) para responder consultas start/end arbitrarias:
+totales en O(log n) y desgloses en O(k) sin recorrer transacciones
+"""
+
+import os
+import re
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.models.financial_models import CashFlowData, TransactionType
+from app.services.aggregates import AggregateCube, CubeSlice, month_label
+from app.services.transaction_store import CATEGORIES, TRANSACTION_TYPES, TYPE_CODES, date_to_day, day_to_date
+
+_SHAPE = (len(TRANSACTION_TYPES), len(CATEGORIES))
+_INCOME = TYPE_CODES[TransactionType.INCOME.value]
+_EXPENSE = TYPE_CODES[TransactionType.EXPENSE.value]
+_LAST_N_MONTHS = re.compile(r"^last_(\d+)_months$")
+
+# Mes en que inicia el año fiscal (1 = enero)
+FISCAL_YEAR_START_MONTH = int(os.getenv("FISCAL_YEAR_START_MONTH", "1"))
+
+
+class DateRangeIndex:
+    """Índice ordenado de días con sumas prefijo de conteo, monto y monto al cuadrado
+
+    Se construye desde el cubo diario de FinancialAggregates (O(días), sin recorrer
+    transacciones) y los agregados lo actualizan in situ con cada escritura.
+    """
+
+    def __init__(self, cube: AggregateCube):
+        self.days = np.asarray(cube.keys, dtype=np.int64)
+        if len(self.days):
+            per_day_counts = np.stack([cube.counts[day] for day in cube.keys])
+            per_day_sums = np.stack([cube.sums[day] for day in cube.keys])
+            per_day_sumsq = np.stack([cube.sumsq[day] for day in cube.keys])
+        else:
+            per_day_counts = np.zeros((0,) + _SHAPE, dtype=np.int64)
+            per_day_sums = np.zeros((0,) + _SHAPE, dtype=np.float64)
+            per_day_sumsq = np.zeros((0,) + _SHAPE, dtype=np.float64)
+        self._counts = _prefix(per_day_counts)
+        self._sums = _prefix(per_day_sums)
+        self._sumsq = _prefix(per_day_sumsq)
+
+    def apply(self, days: np.ndarray, types: np.ndarray, categories: np.ndarray, amounts: np.ndarray, sign: int) -> None:
+        """Sumar (o descontar) un lote de transacciones cuyos días ya están en el índice"""
+        days = np.atleast_1d(np.asarray(days, dtype=np.int64))
+        positions = np.minimum(np.searchsorted(self.days, days), max(len(self.days) - 1, 0))
+        # Días ausentes del índice (no están en el cubo) se ignoran, igual que en el cubo
+        known = self.days[positions] == days if len(self.days) else np.zeros(len(days), dtype=bool)
+        amounts = np.atleast_1d(np.asarray(amounts, dtype=np.float64))[known]
+        cells = (positions[known], np.atleast_1d(types)[known], np.atleast_1d(categories)[known])
+        for prefix, values in ((self._counts, sign), (self._sums, sign * amounts), (self._sumsq, sign * amounts * amounts)):
+            # Deltas por día propagados a todas las sumas prefijo posteriores
+            delta = np.zeros((len(self.days),) + _SHAPE, dtype=prefix.dtype)
+            np.add.at(delta, cells, values)
+            prefix[1:] += np.cumsum(delta, axis=0)
+
+    @property
+    def nbytes(self) -> int:
+        return self.days.nbytes + self._counts.nbytes + self._sums.nbytes + self._sumsq.nbytes
+
+    @property
+    def first_day(self) -> Optional[int]:
+        return int(self.days[0]) if len(self.days) else None
+
+    @property
+    def last_day(self) -> Optional[int]:
+        return int(self.days[-1]) if len(self.days) else None
+
+    def _bounds(self, start_day: Optional[int], end_day: Optional[int]) -> Tuple[int, int]:
+        """Posiciones en las sumas prefijo para el rango [start_day, end_day] (inclusivo)"""
+        lo = 0 if start_day is None else int(np.searchsorted(self.days, start_day, side="left"))
+        hi = len(self.days) if end_day is None else int(np.searchsorted(self.days, end_day, side="right"))
+        return lo, max(lo, hi)
+
+    def slice(self, start: Optional[date] = None, end: Optional[date] = None) -> CubeSlice:
+        """Medidas tipo × categoría del rango de fechas"""
+        lo, hi = self._bounds(_day_or_none(start), _day_or_none(end))
+        return CubeSlice(
+            self._counts[hi] - self._counts[lo],
+            self._sums[hi] - self._sums[lo],
+            self._sumsq[hi] - self._sumsq[lo]
+        )
+
+    def total(self, transaction_type: TransactionType, start: Optional[date] = None, end: Optional[date] = None) -> float:
+        """Total de un tipo de transacción en el rango, en O(log n)"""
+        lo, hi = self._bounds(_day_or_none(start), _day_or_none(end))
+        code = TYPE_CODES[transaction_type.value]
+        return float(self._sums[hi][code].sum() - self._sums[lo][code].sum())
+
+    def category_totals(self, transaction_type: TransactionType, start: Optional[date] = None, end: Optional[date] = None) -> Dict[str, float]:
+        """Desglose por categoría de un tipo de transacción en el rango, en O(k)"""
+        return self.slice(start, end).category_totals(TYPE_CODES[transaction_type.value])
+
+    def count(self, start: Optional[date] = None, end: Optional[date] = None) -> int:
+        lo, hi = self._bounds(_day_or_none(start), _day_or_none(end))
+        return int(self._counts[hi].sum() - self._counts[lo].sum())
+
+    def monthly_cash_flow(self, start: Optional[date] = None, end: Optional[date] = None) -> List[CashFlowData]:
+        """Flujo de caja por mes dentro del rango; el saldo acumulado incluye lo previo al rango"""
+        if not len(self.days):
+            return []
+        start_day = _day_or_none(start)
+        end_day = _day_or_none(end)
+        first = max(start_day, self.first_day) if start_day is not None else self.first_day
+        last = min(end_day, self.last_day) if end_day is not None else self.last_day
+        if first > last:
+            return []
+
+        lo, _ = self._bounds(first, None)
+        cumulative_balance = float(self._sums[lo][_INCOME].sum() - self._sums[lo][_EXPENSE].sum())
+
+        # Límites de cada mes del rango, recortados a [first, last]
+        first_month = np.datetime64(first, "D").astype("datetime64[M]")
+        last_month = np.datetime64(last, "D").astype("datetime64[M]")
+        months = np.arange(first_month, last_month + 1)
+        month_starts = np.maximum(months.astype("datetime64[D]").astype(np.int64), first)
+        positions = np.searchsorted(self.days, np.append(month_starts, last + 1), side="left")
+
+        history = []
+        for i, month in enumerate(months):
+            lo, hi = positions[i], positions[i + 1]
+            if self._counts[hi].sum() == self._counts[lo].sum():
+                continue
+            income = float(self._sums[hi][_INCOME].sum() - self._sums[lo][_INCOME].sum())
+            expenses = float(self._sums[hi][_EXPENSE].sum() - self._sums[lo][_EXPENSE].sum())
+            cumulative_balance += income - expenses
+            history.append(CashFlowData(
+                period=month_label(int(month.astype(np.int64)) + 1970 * 12),
+                income=income,
+                expenses=expenses,
+                net_cash_flow=income - expenses,
+                cumulative_balance=cumulative_balance
+            ))
+        return history
+
+
+def resolve_date_range(
+    period: str = "last_12_months",
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    today: Optional[date] = None
+) -> Tuple[Optional[date], Optional[date]]:
+    """Traducir un periodo con nombre o un rango explícito a fechas (inclusivas)
+
+    Periodos: last_N_months, this_month, last_month, this_quarter, last_quarter,
+    year_to_date, last_year, fiscal_year_to_date, last_fiscal_year y all.
+    Un start/end explícito tiene prioridad sobre el periodo.
+    """
+    if start or end:
+        if start and end and start > end:
+            raise ValueError("La fecha inicial debe ser anterior a la final")
+        return start, end
+
+    today = today or date.today()
+    match = _LAST_N_MONTHS.match(period)
+    if match:
+        months = int(match.group(1))
+        if months < 1:
+            raise ValueError(f"Periodo no válido: {period}")
+        return _add_months(today.replace(day=1), -(months - 1)), today
+    if period == "all":
+        return None, None
+    if period == "this_month":
+        return today.replace(day=1), today
+    if period == "last_month":
+        first = _add_months(today.replace(day=1), -1)
+        return first, today.replace(day=1) - timedelta(days=1)
+    if period in ("this_quarter", "last_quarter"):
+        quarter_start = today.replace(month=3 * ((today.month - 1) // 3) + 1, day=1)
+        if period == "this_quarter":
+            return quarter_start, today
+        return _add_months(quarter_start, -3), quarter_start - timedelta(days=1)
+    if period == "year_to_date":
+        return today.replace(month=1, day=1), today
+    if period == "last_year":
+        return date(today.year - 1, 1, 1), date(today.year - 1, 12, 31)
+    if period in ("fiscal_year_to_date", "last_fiscal_year"):
+        fiscal_start = today.replace(month=FISCAL_YEAR_START_MONTH, day=1)
+        if fiscal_start > today:
+            fiscal_start = fiscal_start.replace(year=fiscal_start.year - 1)
+        if period == "fiscal_year_to_date":
+            return fiscal_start, today
+        return fiscal_start.replace(year=fiscal_start.year - 1), fiscal_start - timedelta(days=1)
+    raise ValueError(f"Periodo no válido: {period}")
+
+
+def months_in_range(start: Optional[date], end: Optional[date], index: DateRangeIndex) -> int:
+    """Número de meses calendario que cubre el rango (acotado a los datos si está abierto)"""
+    first = start or (day_to_date(index.first_day) if index.first_day is not None else None)
+    last = end or (day_to_date(index.last_day) if index.last_day is not None else None)
+    if first is None or last is None or first > last:
+        return 0
+    return (last.year - first.year) * 12 + last.month - first.month + 1
+
+
+def _prefix(per_day: np.ndarray) -> np.ndarray:
+    """Sumas prefijo con una fila inicial en cero: prefix[i] = suma de los primeros i días"""
+    prefix = np.zeros((len(per_day) + 1,) + per_day.shape[1:], dtype=per_day.dtype)
+    np.cumsum(per_day, axis=0, out=prefix[1:])
+    return prefix
+
+
+def _add_months(value: date, months: int) -> date:
+    month_index = value.year * 12 + value.month - 1 + months
+    return value.replace(year=month_index // 12, month=month_index % 12 + 1)
+
+
+def _day_or_none(value: Optional[date]) -> Optional[int]:
+    return date_to_day(value) if value is not None else None
+
@@ -4,6 +4,8 @@ Convierte respuestas del chat en audio natural usando IA
 """
 
 import os
+import asyncio
+import hashlib
 import logging
 from typing import Optional, Dict, Any
 import requests
@@ -13,11 +15,16 @@ from elevenlabs import Voice, VoiceSettings, generate, set_api_key
 from elevenlabs.api import Voices
 from dotenv import load_dotenv
 
+from app.services.single_flight import SingleFlight
+
 # Cargar variables de entorno
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# Síntesis idénticas en curso (mismo texto y tipo de voz) comparten una sola llamada
+tts_flights = SingleFlight("elevenlabs")
+
 class ElevenLabsService:
     """Servicio para síntesis de voz con ElevenLabs"""
     
@@ -202,6 +209,13 @@ class ElevenLabsService:
             logger.error(f"❌ Error creando respuesta de audio: {e}")
             return None
     
+    async def create_audio_response_async(self, chat_response: str, response_type: str = "general") -> Optional[Dict[str, Any]]:
+        """Crear respuesta de audio fuera del event loop, coalesciendo síntesis idénticas concurrentes"""
+        if not self.is_available:
+            return None
+        key = (response_type, hashlib.sha256(chat_response.encode("utf-8")).hexdigest())
+        return await tts_flights.do(key, lambda: asyncio.to_thread(self.create_audio_response, chat_response, response_type))
+    
     def get_voice_preview(self, voice_id: str, sample_text: str = "Hola, soy Maya, tu asesora financiera de Banorte") -> Optional[bytes]:
         """Generar preview de voz"""
         if not self.is_available:
@@ -11,81 +11,252 @@ except ImportError:
     print("⚠️ google-generativeai no disponible, usando respuestas simuladas")
 import os
 import json
+import time
+import asyncio
 import logging
-from typing import Dict, List, Any, Optional
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Any, Optional, Tuple
 from datetime import datetime
 
 from app.models.financial_models import ChatMessage, ChatResponse, FinancialMetrics
 from app.services.snowflake_service import snowflake_service
+from app.services.response_cache import response_cache
+from app.services.single_flight import SingleFlight
 
 logger = logging.getLogger(__name__)
 
+
+class ConcurrencyLimiter:
+    """Cupos de llamadas simultáneas al LLM: uno global y otro por empresa"""
+    
+    def __init__(self, global_limit: int, per_key_limit: int):
+        self.per_key_limit = max(int(per_key_limit), 1)
+        self._global = asyncio.Semaphore(max(int(global_limit), 1))
+        self._per_key: Dict[str, asyncio.Semaphore] = {}
+        self._users: Dict[str, int] = {}
+    
+    @asynccontextmanager
+    async def slot(self, key: str) -> AsyncIterator[None]:
+        """Ocupar un cupo de la empresa y luego uno global (así una empresa en espera no bloquea a las demás)"""
+        semaphore = self._per_key.get(key)
+        if semaphore is None:
+            semaphore = self._per_key[key] = asyncio.Semaphore(self.per_key_limit)
+        self._users[key] = self._users.get(key, 0) + 1
+        try:
+            async with semaphore, self._global:
+                yield
+        finally:
+            # Liberar el semáforo de la empresa cuando nadie lo usa
+            self._users[key] -= 1
+            if not self._users[key]:
+                del self._users[key]
+                del self._per_key[key]
+    
+    def stats(self) -> Dict[str, Any]:
+        return {"active_empresas": len(self._users), "waiting_or_running": sum(self._users.values())}
+
+
+# Compartidos por todas las instancias del servicio
+llm_limiter = ConcurrencyLimiter(
+    global_limit=int(os.getenv("GEMINI_MAX_CONCURRENCY", "8")),
+    per_key_limit=int(os.getenv("GEMINI_MAX_CONCURRENCY_PER_EMPRESA", "2"))
+)
+# Llamadas idénticas en curso (misma llave de caché) comparten una sola generación
+llm_flights = SingleFlight("gemini")
+# Tiempo máximo por llamada (incluye la espera de cupo); al vencer se responde en modo simulado
+GEMINI_DEADLINE_SECONDS = float(os.getenv("GEMINI_DEADLINE_SECONDS", "20"))
+
+# Modelos en orden de preferencia: gemini-2.0-flash (rápido y estable) y luego los 2.5
+GEMINI_MODEL_CANDIDATES = ["gemini-2.0-flash", "gemini-2.5-flash", "gemini-2.5-pro"]
+# Tiempo máximo de la prueba de cada modelo y espera mínima entre re-resoluciones tras fallas
+GEMINI_PROBE_TIMEOUT_SECONDS = float(os.getenv("GEMINI_PROBE_TIMEOUT_SECONDS", "10"))
+GEMINI_RESOLVE_RETRY_SECONDS = float(os.getenv("GEMINI_RESOLVE_RETRY_SECONDS", "60"))
+
 class GeminiService:
+    """Servicio de aplicación: configura la API una vez y resuelve el modelo en segundo plano"""
+    
     def __init__(self):
         self.api_key = os.getenv("GEMINI_API_KEY")
         self.model = None
+        self.model_name: Optional[str] = None
         self.is_available = False
+        self.configured = False
+        self._resolver: Optional[asyncio.Task] = None
+        self._last_resolve = 0.0
         
         # Verificar si Gemini está disponible
         if not GEMINI_AVAILABLE:
             logger.warning("⚠️ google-generativeai no disponible, usando respuestas simuladas")
-            self.is_available = False
             return
             
         if not self.api_key:
             logger.warning("GEMINI_API_KEY no configurada, usando modo simulado")
-            self.api_key = "demo_key"
+            return
         
         try:
             genai.configure(api_key=self.api_key)
-            # Probar con modelos disponibles: gemini-2.0-flash (rápido y estable)
-            try:
-                self.model = genai.GenerativeModel('gemini-2.0-flash')
-                self.is_available = True
-                logger.info("✅ Gemini API configurada correctamente (gemini-2.0-flash)")
-            except Exception as e1:
-                logger.warning(f"gemini-2.0-flash no disponible ({e1}), intentando gemini-2.5-flash")
-                # Si no funciona, intentar con gemini-2.5-flash
-                try:
-                    self.model = genai.GenerativeModel('gemini-2.5-flash')
-                    self.is_available = True
-                    logger.info("✅ Gemini API configurada correctamente (gemini-2.5-flash)")
-                except Exception as e2:
-                    logger.warning(f"gemini-2.5-flash no disponible ({e2}), intentando gemini-2.5-pro")
-                    # Si no funciona, intentar con gemini-2.5-pro
-                    try:
-                        self.model = genai.GenerativeModel('gemini-2.5-pro')
-                        self.is_available = True
-                        logger.info("✅ Gemini API configurada correctamente (gemini-2.5-pro)")
-                    except Exception as e3:
-                        logger.error(f"Ningún modelo de Gemini disponible ({e3}), usando modo simulado")
-                        self.is_available = False
+            self.configured = True
         except Exception as e:
             logger.error(f"Error al configurar Gemini: {str(e)}")
-            self.is_available = False
     
-    async def analyze_financial_question(self, message: ChatMessage, context: Dict[str, Any]) -> ChatResponse:
-        """Analizar pregunta financiera usando Gemini"""
+    def start(self) -> None:
+        """Resolver y probar el modelo al arrancar, sin demorar el startup (mientras tanto, modo simulado)"""
+        self._schedule_resolve(force=True)
+    
+    async def close(self) -> None:
+        if self._resolver is not None and not self._resolver.done():
+            self._resolver.cancel()
+        self._resolver = None
+    
+    def _schedule_resolve(self, force: bool = False) -> None:
+        """Re-resolver el modelo en segundo plano (una sola tarea a la vez y con espera mínima entre intentos)"""
+        if not self.configured or (self._resolver is not None and not self._resolver.done()):
+            return
+        if not force and time.monotonic() - self._last_resolve < GEMINI_RESOLVE_RETRY_SECONDS:
+            return
+        self._last_resolve = time.monotonic()
+        self._resolver = asyncio.get_running_loop().create_task(self._resolve_model())
+    
+    async def _resolve_model(self) -> bool:
+        """Recorrer la cadena de modelos y quedarse con el primero que responde a una prueba liviana"""
+        for name in GEMINI_MODEL_CANDIDATES:
+            try:
+                model = genai.GenerativeModel(name)
+                # count_tokens valida la llave y el modelo sin generar contenido
+                await asyncio.wait_for(model.count_tokens_async("ping"), timeout=GEMINI_PROBE_TIMEOUT_SECONDS)
+            except Exception as e:
+                logger.warning(f"{name} no disponible ({e!r}), intentando el siguiente modelo")
+                continue
+            self.model, self.model_name, self.is_available = model, name, True
+            logger.info(f"✅ Gemini API configurada correctamente ({name})")
+            return True
+        
+        self.is_available = False
+        logger.error("Ningún modelo de Gemini disponible, usando modo simulado")
+        return False
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "available": self.is_available,
+            "model": self.model_name,
+            "resolving": self._resolver is not None and not self._resolver.done(),
+            "limiter": llm_limiter.stats(),
+            "single_flight": llm_flights.stats(),
+            "cache": response_cache.stats()
+        }
+    
+    async def _generate(self, prompt: str, empresa_id: Optional[str]) -> str:
+        """Llamar a Gemini con el cliente async, dentro de los cupos y con tiempo límite (TimeoutError al vencer)"""
+        async def call() -> str:
+            async with llm_limiter.slot(empresa_id or "default"):
+                response = await self.model.generate_content_async(prompt)
+                return response.text
+        return await asyncio.wait_for(call(), timeout=GEMINI_DEADLINE_SECONDS)
+    
+    async def analyze_financial_question(self, message: ChatMessage, context: Dict[str, Any], empresa_id: Optional[str] = None) -> ChatResponse:
+        """Analizar pregunta financiera usando Gemini (las preguntas repetidas con el mismo contexto salen de la caché)"""
         try:
-            if not self.is_available:
-                return await self._simulate_response(message, context)
-            
             # Preparar contexto financiero
             financial_context = self._prepare_financial_context(context)
+            cache_key = response_cache.key("chat", empresa_id, message.message, financial_context)
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                return ChatResponse(**cached)
+            
+            if not self.is_available:
+                self._schedule_resolve()
+                return await self._simulate_response(message, context)
             
             # Crear prompt estructurado
             prompt = self._create_analysis_prompt(message.message, financial_context)
             
-            # Generar respuesta con Gemini
-            response = self.model.generate_content(prompt)
+            async def answer() -> Dict[str, Any]:
+                # Generar respuesta con Gemini (sin bloquear el event loop)
+                response_text = await self._generate(prompt, empresa_id)
+                
+                # Procesar respuesta (solo se cachean respuestas reales del modelo)
+                response = self._process_gemini_response(response_text, message.message).dict(exclude={"audio_data"})
+                response_cache.set(cache_key, response)
+                return response
             
-            # Procesar respuesta
-            return self._process_gemini_response(response.text, message.message)
+            # Cada llamador recibe su propia copia (p. ej. /message le agrega el audio)
+            return ChatResponse(**await llm_flights.do(cache_key, answer))
             
+        except asyncio.TimeoutError:
+            logger.warning(f"⏱️ Gemini excedió {GEMINI_DEADLINE_SECONDS}s, usando respuesta simulada")
+            return await self._simulate_response(message, context)
         except Exception as e:
             logger.error(f"Error en análisis con Gemini: {str(e)}")
+            self._schedule_resolve()
             return await self._simulate_response(message, context)
-    
+
+    async def stream_financial_question(self, message: ChatMessage, context: Dict[str, Any], empresa_id: Optional[str] = None) -> AsyncIterator[Tuple[str, Any]]:
+        """Analizar pregunta financiera en streaming: emite ("token", texto) por fragmento y al final ("final", ChatResponse)
+
+        El tiempo límite aplica a cada fragmento (el primero incluye la espera de cupo). Si vence o falla
+        antes del primer fragmento se emite la respuesta simulada completa; si ocurre a mitad de la
+        respuesta se cierra con el texto recibido hasta ese momento. Un acierto de caché se emite completo.
+        """
+        financial_context = self._prepare_financial_context(context)
+        cache_key = response_cache.key("chat", empresa_id, message.message, financial_context)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            response = ChatResponse(**cached)
+            yield "token", response.content
+            yield "final", response
+            return
+
+        if not self.is_available:
+            self._schedule_resolve()
+            simulated = await self._simulate_response(message, context)
+            yield "token", simulated.content
+            yield "final", simulated
+            return
+
+        prompt = self._create_analysis_prompt(message.message, financial_context)
+
+        async def chunks() -> AsyncIterator[str]:
+            async with llm_limiter.slot(empresa_id or "default"):
+                response = await self.model.generate_content_async(prompt, stream=True)
+                async for chunk in response:
+                    try:
+                        text = chunk.text
+                    except ValueError:
+                        # Fragmento sin texto (p. ej. solo metadatos de seguridad)
+                        continue
+                    if text:
+                        yield text
+
+        parts: List[str] = []
+        complete = False
+        stream = chunks()
+        try:
+            while True:
+                try:
+                    text = await asyncio.wait_for(stream.__anext__(), timeout=GEMINI_DEADLINE_SECONDS)
+                except StopAsyncIteration:
+                    complete = True
+                    break
+                parts.append(text)
+                yield "token", text
+        except asyncio.TimeoutError:
+            logger.warning(f"⏱️ Gemini no envió texto en {GEMINI_DEADLINE_SECONDS}s ({len(parts)} fragmentos recibidos)")
+        except Exception as e:
+            logger.error(f"Error en streaming con Gemini: {str(e)}")
+            self._schedule_resolve()
+        finally:
+            await stream.aclose()
+
+        if not parts:
+            simulated = await self._simulate_response(message, context)
+            yield "token", simulated.content
+            yield "final", simulated
+            return
+        response = self._process_gemini_response("".join(parts), message.message)
+        if complete:
+            response_cache.set(cache_key, response.dict(exclude={"audio_data"}))
+        yield "final", response
+
     def _prepare_financial_context(self, context: Dict[str, Any]) -> str:
         """Preparar contexto financiero para el prompt"""
         context_str = "CONTEXTO FINANCIERO ACTUAL:\n\n"
@@ -294,10 +465,32 @@ Para determinar si puedes contratar un nuevo empleado, necesito considerar vario
                 confidence=0.9
             )
     
-    async def generate_simulation_analysis(self, scenario: Dict[str, Any], base_data: Dict[str, Any]) -> str:
-        """Generar análisis de simulación usando Gemini"""
+    async def generate_simulation_analysis(
+        self,
+        scenario: Dict[str, Any],
+        base_data: Dict[str, Any],
+        empresa_id: Optional[str] = None,
+        cache_kind: str = "simulation"
+    ) -> str:
+        """Generar análisis de simulación usando Gemini (cacheado por escenario y datos base)
+
+        `cache_kind` separa en la caché a los llamadores que envían datos base distintos: la
+        huella se sigue por (tipo, empresa) y compartirla haría que se invaliden entre sí.
+        """
         try:
+            scenario_text = json.dumps(
+                {key: scenario.get(key) for key in ("name", "description", "parameters")},
+                sort_keys=True, ensure_ascii=False, default=str
+            )
+            cache_key = response_cache.key(
+                cache_kind, empresa_id, scenario_text, json.dumps(base_data, sort_keys=True, default=str)
+            )
+            cached = response_cache.get(cache_key)
+            if cached is not None:
+                return cached
+            
             if not self.is_available:
+                self._schedule_resolve()
                 return self._simulate_simulation_analysis(scenario, base_data)
             
             prompt = f"""
@@ -321,11 +514,19 @@ Proporciona:
 Responde en español de manera clara y práctica.
 """
             
-            response = self.model.generate_content(prompt)
-            return response.text
+            async def analyze() -> str:
+                analysis = await self._generate(prompt, empresa_id)
+                response_cache.set(cache_key, analysis)
+                return analysis
             
+            return await llm_flights.do(cache_key, analyze)
+            
+        except asyncio.TimeoutError:
+            logger.warning(f"⏱️ Análisis de simulación excedió {GEMINI_DEADLINE_SECONDS}s, usando análisis simulado")
+            return self._simulate_simulation_analysis(scenario, base_data)
         except Exception as e:
             logger.error(f"Error en análisis de simulación: {str(e)}")
+            self._schedule_resolve()
             return self._simulate_simulation_analysis(scenario, base_data)
     
     def _simulate_simulation_analysis(self, scenario: Dict[str, Any], base_data: Dict[str, Any]) -> str:
@@ -351,3 +552,6 @@ Basándome en los datos financieros actuales, este escenario tendría el siguien
 - Preparar plan de contingencia
 - Establecer métricas de seguimiento
 """
+
+# Instancia global del servicio
+gemini_service = GeminiService()
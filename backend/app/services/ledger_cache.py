@@ -0,0 +1,153 @@
+"""
+Caché persistente de libros contables ya procesados
+Guarda las columnas del almacén (archivos .npy) junto con el vocabulario y un manifiesto,
+indexados por hash de contenido, mtime y versión de las reglas de mapeo. Las cargas
+posteriores mapean las columnas en memoria en lugar de volver a parsear el Excel.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+from app.services.ledger_ingestion import (
+    COLUMN_ALIASES, CATEGORY_KEYWORDS, DATE_FORMATS, IngestionReport, ingest_ledger
+)
+from app.services.transaction_store import TransactionStore
+
+logger = logging.getLogger(__name__)
+
+# Se incrementa cuando cambia el formato de los archivos de la caché
+CACHE_FORMAT_VERSION = 1
+_HASH_BLOCK_BYTES = 1024 * 1024
+
+
+def mapping_version() -> str:
+    """Huella de las reglas de mapeo/categorización; si cambian, la caché se invalida"""
+    rules = {
+        "format": CACHE_FORMAT_VERSION,
+        "aliases": COLUMN_ALIASES,
+        "keywords": [(category.value, words) for category, words in CATEGORY_KEYWORDS],
+        "date_formats": list(DATE_FORMATS),
+    }
+    return hashlib.sha256(json.dumps(rules, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+
+
+def file_content_hash(file_path: Path) -> str:
+    """SHA-256 del contenido del archivo, leído por bloques"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as handle:
+        for block in iter(lambda: handle.read(_HASH_BLOCK_BYTES), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class LedgerCache:
+    """Caché en disco de almacenes columnares por archivo fuente"""
+
+    def __init__(self, cache_dir: Optional[str] = None):
+        self.cache_dir = Path(cache_dir or os.getenv("LEDGER_CACHE_DIR", "data/.ledger_cache"))
+        self.enabled = os.getenv("LEDGER_CACHE_ENABLED", "true").lower() == "true"
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_dir(self, file_path: Path) -> Path:
+        # Una entrada por archivo fuente (ruta absoluta); el manifiesto decide si sigue vigente
+        name = hashlib.sha1(str(Path(file_path).resolve()).encode("utf-8")).hexdigest()[:12]
+        return self.cache_dir / f"{Path(file_path).stem}-{name}"
+
+    def load(self, file_path: Path) -> Optional[Tuple[TransactionStore, IngestionReport]]:
+        """Devolver el almacén cacheado (memoria mapeada) si la fuente y las reglas no cambiaron"""
+        entry = self._entry_dir(file_path)
+        manifest_path = entry / "manifest.json"
+        if not self.enabled or not manifest_path.exists():
+            return None
+        try:
+            manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+            if manifest.get("mapping_version") != mapping_version():
+                logger.info(f"♻️ Reglas de mapeo cambiaron, se invalida la caché de {file_path}")
+                return None
+
+            stat = Path(file_path).stat()
+            if (manifest.get("size"), manifest.get("mtime_ns")) != (stat.st_size, stat.st_mtime_ns):
+                # mtime o tamaño distintos: solo es válida si el contenido es idéntico
+                if file_content_hash(file_path) != manifest.get("content_hash"):
+                    return None
+                manifest["size"], manifest["mtime_ns"] = stat.st_size, stat.st_mtime_ns
+                self._write_json(manifest_path, manifest)
+
+            # copy-on-write: el almacén puede mutar sin tocar los archivos de la caché
+            columns = {name: np.load(entry / f"{name}.npy", mmap_mode="c") for name in manifest["columns"]}
+            vocabulary = json.loads((entry / "vocabulary.json").read_text(encoding="utf-8"))
+            return TransactionStore.from_columns(columns, vocabulary), IngestionReport.from_dict(manifest["report"])
+        except Exception as e:
+            logger.warning(f"⚠️ Caché de libro no válida para {file_path}: {e}")
+            return None
+
+    def save(self, file_path: Path, store: TransactionStore, report: IngestionReport) -> None:
+        """Escribir el almacén procesado de forma atómica (directorio temporal + rename)"""
+        if not self.enabled:
+            return
+        entry = self._entry_dir(file_path)
+        staging = entry.with_name(f"{entry.name}.tmp-{os.getpid()}")
+        try:
+            shutil.rmtree(staging, ignore_errors=True)
+            staging.mkdir(parents=True)
+            columns = store.column_arrays()
+            for name, values in columns.items():
+                np.save(staging / f"{name}.npy", np.ascontiguousarray(values))
+            self._write_json(staging / "vocabulary.json", store.vocabulary)
+
+            stat = Path(file_path).stat()
+            self._write_json(staging / "manifest.json", {
+                "source": str(file_path),
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "content_hash": file_content_hash(file_path),
+                "mapping_version": mapping_version(),
+                "columns": list(columns),
+                "rows": len(store),
+                "report": report.to_dict()
+            })
+            shutil.rmtree(entry, ignore_errors=True)
+            os.replace(staging, entry)
+            logger.info(f"💾 Libro {file_path} guardado en caché ({len(store)} transacciones)")
+        except Exception as e:
+            shutil.rmtree(staging, ignore_errors=True)
+            logger.warning(f"⚠️ No se pudo guardar la caché de {file_path}: {e}")
+
+    def load_or_ingest(
+        self,
+        file_path: Path,
+        on_progress: Optional[Callable[[IngestionReport], None]] = None,
+        report: Optional[IngestionReport] = None
+    ) -> Tuple[Optional[TransactionStore], IngestionReport, bool]:
+        """Cargar desde la caché o procesar el archivo y guardarlo; devuelve (almacén, reporte, desde_caché)"""
+        cached = self.load(file_path)
+        if cached is not None:
+            self.hits += 1
+            return cached[0], cached[1], True
+
+        self.misses += 1
+        store, report = ingest_ledger(file_path, on_progress=on_progress, report=report)
+        if store is not None:
+            self.save(file_path, store, report)
+        return store, report, False
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, "hits": self.hits, "misses": self.misses, "cache_dir": str(self.cache_dir)}
+
+    @staticmethod
+    def _write_json(path: Path, payload: Any) -> None:
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        tmp.write_text(json.dumps(payload, ensure_ascii=False, default=str), encoding="utf-8")
+        os.replace(tmp, path)
+
+
+# Instancia global del servicio
+ledger_cache = LedgerCache()
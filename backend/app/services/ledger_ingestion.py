@@ -0,0 +1,468 @@
+"""
+Ingesta vectorizada de libros contables (Excel y CSV)
+Resuelve el mapeo de columnas una vez por archivo, categoriza con coincidencias de texto
+vectorizadas, parsea fechas en bloque y construye el almacén columnar sin iterar filas.
+Los archivos se leen por bloques de tamaño fijo para acotar la memoria pico.
+"""
+
+import io
+import os
+import re
+import json
+import codecs
+import logging
+from datetime import date
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from app.models.financial_models import CategoryType, TransactionType
+from app.services.transaction_store import (
+    TransactionStore, CATEGORIES, TRANSACTION_TYPES, CATEGORY_CODES, TYPE_CODES, days_from_datetimes
+)
+
+logger = logging.getLogger(__name__)
+
+# Nombres posibles de cada columna del libro contable
+COLUMN_ALIASES: Dict[str, List[str]] = {
+    "amount": ["amount", "monto", "valor", "importe"],
+    "date": ["date", "fecha", "fecha_transaccion"],
+    "description": ["description", "descripcion", "concepto", "detalle"],
+    "category": ["category", "categoria", "tipo"],
+}
+REQUIRED_COLUMNS = ("amount", "date", "description")
+
+# Campos de una transacción explícita (carga masiva por API)
+TRANSACTION_FIELDS = ("date", "amount", "description", "category", "transaction_type")
+
+# Palabras clave por categoría, en orden de prioridad (la primera coincidencia gana)
+CATEGORY_KEYWORDS: List[Tuple[CategoryType, List[str]]] = [
+    (CategoryType.SALES, ["venta", "ventas", "sales", "ingreso"]),
+    (CategoryType.PERSONNEL, ["salario", "empleado", "personal", "nómina"]),
+    (CategoryType.MARKETING, ["marketing", "publicidad", "promocion"]),
+    (CategoryType.EQUIPMENT, ["equipo", "maquinaria", "computadora"]),
+    (CategoryType.UTILITIES, ["luz", "agua", "telefono", "internet"]),
+]
+
+DATE_FORMATS = ("%Y-%m-%d", "%d/%m/%Y")
+
+# Normalización de categoría/tipo de las filas del warehouse (tabla cruda o transactions)
+WAREHOUSE_CATEGORY_ALIASES: Dict[str, CategoryType] = {
+    **{category.value: category for category in CategoryType},
+    **{alias: CategoryType.SALES for alias in ["venta", "ventas"]},
+    **{alias: CategoryType.PERSONNEL for alias in ["personal", "nomina", "nómina"]},
+    **{alias: CategoryType.MARKETING for alias in ["publicidad", "promocion"]},
+    **{alias: CategoryType.EQUIPMENT for alias in ["equipo", "inventario", "maquinaria"]},
+    **{alias: CategoryType.UTILITIES for alias in ["servicios", "publicos", "luz", "agua"]},
+    **{alias: CategoryType.OPERATING_EXPENSES for alias in ["costos", "gastos operativos", "operating", "infraestructur"]},
+}
+WAREHOUSE_DEFAULT_CATEGORY = CategoryType.OPERATING_EXPENSES
+WAREHOUSE_TYPE_ALIASES: Dict[str, TransactionType] = {
+    **{transaction_type.value: transaction_type for transaction_type in TransactionType},
+    **{alias: TransactionType.INCOME for alias in ["ingreso", "i"]},
+    **{alias: TransactionType.EXPENSE for alias in ["gasto", "e"]},
+    "inversion": TransactionType.INVESTMENT,
+}
+WAREHOUSE_DEFAULT_TYPE = TransactionType.EXPENSE
+
+# Filas por bloque al leer libros grandes
+LEDGER_CHUNK_ROWS = int(os.getenv("LEDGER_CHUNK_ROWS", "5000"))
+# Filas por lote en la carga masiva por API (cada lote es un write_pandas)
+BULK_BATCH_ROWS = int(os.getenv("BULK_BATCH_ROWS", "5000"))
+
+_CATEGORY_PATTERNS = [
+    (CATEGORY_CODES[category.value], "|".join(re.escape(word) for word in words))
+    for category, words in CATEGORY_KEYWORDS
+]
+_INCOME = TYPE_CODES[TransactionType.INCOME.value]
+_EXPENSE = TYPE_CODES[TransactionType.EXPENSE.value]
+_MAX_REPORTED_ERRORS = 1000
+
+
+class IngestionReport:
+    """Resumen de una ingesta: filas aceptadas, rechazadas y errores por fila"""
+
+    def __init__(self, source: str):
+        self.source = source
+        self.rows_read = 0
+        self.rows_accepted = 0
+        self.rows_rejected = 0
+        self.dates_defaulted = 0
+        self.errors: List[Dict[str, Any]] = []
+        self.column_mapping: Dict[str, Optional[str]] = {}
+        self.rows_total: Optional[int] = None  # Filas de datos del archivo, si se conocen
+        self.bytes_total: Optional[int] = None
+        self.bytes_read = 0
+        self.chunks = 0
+        self.done = False
+
+    @property
+    def progress(self) -> Optional[float]:
+        """Avance de 0 a 1 (por filas si se conoce el total, si no por bytes leídos)"""
+        if self.done:
+            return 1.0
+        if self.rows_total:
+            return min(self.rows_read / self.rows_total, 1.0)
+        if self.bytes_total:
+            return min(self.bytes_read / self.bytes_total, 1.0)
+        return None
+
+    def reject(self, rows: Sequence[int], reason: str) -> None:
+        """Registrar filas rechazadas (se guardan hasta un máximo de errores detallados)"""
+        self.rows_rejected += len(rows)
+        room = _MAX_REPORTED_ERRORS - len(self.errors)
+        self.errors.extend({"row": int(row), "error": reason} for row in list(rows)[:max(room, 0)])
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "IngestionReport":
+        """Reconstruir un reporte guardado (p. ej. en la caché de libros procesados)"""
+        report = cls(source=data.get("source", ""))
+        for field in ("rows_read", "rows_accepted", "rows_rejected", "dates_defaulted", "rows_total", "chunks", "done"):
+            if field in data:
+                setattr(report, field, data[field])
+        report.errors = list(data.get("errors", []))
+        report.column_mapping = dict(data.get("column_mapping", {}))
+        return report
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "source": self.source,
+            "rows_read": self.rows_read,
+            "rows_accepted": self.rows_accepted,
+            "rows_rejected": self.rows_rejected,
+            "dates_defaulted": self.dates_defaulted,
+            "rows_total": self.rows_total,
+            "chunks": self.chunks,
+            "progress": self.progress,
+            "done": self.done,
+            "column_mapping": self.column_mapping,
+            "errors": self.errors,
+            "errors_truncated": self.rows_rejected > len(self.errors)
+        }
+
+
+def resolve_column_mapping(columns: Sequence[Any]) -> Dict[str, Optional[str]]:
+    """Encontrar una sola vez qué columna del archivo corresponde a cada campo"""
+    normalized = {str(column).strip().lower(): column for column in columns}
+    mapping = {}
+    for field, aliases in COLUMN_ALIASES.items():
+        mapping[field] = next((normalized[alias] for alias in aliases if alias in normalized), None)
+    return mapping
+
+
+def categorize(descriptions: pd.Series) -> np.ndarray:
+    """Asignar códigos de categoría por palabras clave, de forma vectorizada"""
+    lowered = descriptions.astype(str).str.lower()
+    conditions = [lowered.str.contains(pattern, regex=True).to_numpy() for _, pattern in _CATEGORY_PATTERNS]
+    codes = [code for code, _ in _CATEGORY_PATTERNS]
+    return np.select(conditions, codes, default=CATEGORY_CODES[CategoryType.OTHER.value]).astype(np.uint8)
+
+
+def parse_dates(values: pd.Series, today: Optional[date] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Parsear fechas en bloque; devuelve (días int32, máscara de fechas no reconocidas)
+
+    Las fechas no reconocidas toman el día de hoy, igual que el parser fila por fila anterior.
+    """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        parsed = pd.to_datetime(values)
+    else:
+        is_temporal = values.map(lambda value: isinstance(value, (date, pd.Timestamp)))
+        parsed = pd.to_datetime(values.where(is_temporal), errors="coerce")
+        texts = values.where(~is_temporal).astype(str).str.strip()
+        for date_format in DATE_FORMATS:
+            missing = parsed.isna() & ~is_temporal
+            if not missing.any():
+                break
+            parsed = parsed.fillna(pd.to_datetime(texts.where(missing), format=date_format, errors="coerce"))
+    defaulted = parsed.isna().to_numpy()
+    fallback = pd.Timestamp(today or date.today())
+    return days_from_datetimes(parsed.fillna(fallback)), defaulted
+
+
+def ingest_frame(
+    frame: pd.DataFrame,
+    mapping: Dict[str, Optional[str]],
+    store: TransactionStore,
+    report: IngestionReport,
+    row_offset: int = 0
+) -> int:
+    """Validar y normalizar un bloque de filas y anexarlo al almacén; devuelve filas aceptadas"""
+    report.rows_read += len(frame)
+    if frame.empty:
+        return 0
+    row_numbers = np.arange(row_offset, row_offset + len(frame))
+
+    amounts = pd.to_numeric(frame[mapping["amount"]], errors="coerce").to_numpy(dtype=np.float64)
+    valid = np.isfinite(amounts) & (amounts != 0)
+    report.reject(row_numbers[~np.isfinite(amounts)], "monto no numérico")
+    report.reject(row_numbers[np.isfinite(amounts) & (amounts == 0)], "monto igual a cero")
+    if not valid.any():
+        return 0
+
+    frame = frame.loc[valid]
+    amounts = amounts[valid]
+    descriptions = frame[mapping["description"]].astype(str)
+    days, defaulted = parse_dates(frame[mapping["date"]])
+    report.dates_defaulted += int(defaulted.sum())
+
+    # Positivo = ingreso; negativo = gasto (se guarda el valor absoluto)
+    types = np.where(amounts > 0, _INCOME, _EXPENSE).astype(np.uint8)
+    store.extend_columns(
+        days=days,
+        amounts=np.abs(amounts),
+        categories=categorize(descriptions),
+        types=types,
+        descriptions=descriptions.to_numpy()
+    )
+    accepted = int(valid.sum())
+    report.rows_accepted += accepted
+    return accepted
+
+
+def validate_transaction_frame(frame: pd.DataFrame, report: IngestionReport) -> pd.DataFrame:
+    """Validar en bloque transacciones explícitas (date, amount, category, transaction_type...)
+
+    A diferencia de los libros contables, el tipo viene explícito y el monto debe ser > 0.
+    Sin categoría se usa la categorización por palabras clave de la descripción.
+    Los errores usan el índice del DataFrame como número de fila. Devuelve solo las
+    filas válidas con el esquema de `TransactionStore.to_frame()`.
+    """
+    report.rows_read += len(frame)
+    row_numbers = frame.index.to_numpy()
+    frame = frame.reindex(columns=list(TRANSACTION_FIELDS))
+    valid = np.ones(len(frame), dtype=bool)
+
+    def reject(mask: np.ndarray, reason: str) -> None:
+        nonlocal valid
+        report.reject(row_numbers[mask & valid], reason)
+        valid &= ~mask
+
+    amounts = pd.to_numeric(frame["amount"], errors="coerce").to_numpy(dtype=np.float64)
+    reject(~np.isfinite(amounts), "monto no numérico")
+    reject(np.isfinite(amounts) & (amounts <= 0), "el monto debe ser mayor que cero")
+
+    types = frame["transaction_type"].astype("string").str.strip().str.lower()
+    type_codes = types.map(TYPE_CODES).to_numpy(dtype=np.float64, na_value=np.nan)
+    reject(np.isnan(type_codes), "transaction_type no válido")
+
+    descriptions = frame["description"].fillna("").astype(str)
+    categories = frame["category"].astype("string").str.strip().str.lower()
+    category_codes = categories.map(CATEGORY_CODES).to_numpy(dtype=np.float64, na_value=np.nan)
+    # Sin categoría: por palabras clave; categoría desconocida: se rechaza
+    keyword_codes = categorize(descriptions)
+    category_codes = np.where(categories.isna().to_numpy(), keyword_codes, category_codes)
+    reject(np.isnan(category_codes), "category no válida")
+
+    days, unparsed = parse_dates(frame["date"])
+    reject(unparsed, "fecha no válida")
+
+    report.rows_accepted += int(valid.sum())
+    return pd.DataFrame({
+        "date": pd.to_datetime(days[valid], unit="D"),
+        "amount": amounts[valid],
+        "category": pd.Categorical.from_codes(category_codes[valid].astype(np.int8), categories=[c.value for c in CATEGORIES]),
+        "transaction_type": pd.Categorical.from_codes(type_codes[valid].astype(np.int8), categories=[t.value for t in TRANSACTION_TYPES]),
+        "description": descriptions.to_numpy()[valid],
+    })
+
+
+async def iter_upload_batches(
+    body: AsyncIterator[bytes],
+    upload_format: str,
+    report: IngestionReport,
+    batch_size: int = BULK_BATCH_ROWS
+) -> AsyncIterator[pd.DataFrame]:
+    """Partir un cuerpo NDJSON o CSV en lotes de `batch_size` filas mientras llega por la red
+
+    Cada lote se indexa con el número de fila del cuerpo. Solo un lote de líneas vive
+    en memoria a la vez. Las líneas NDJSON mal formadas se rechazan aquí.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    header: Optional[str] = None
+    lines: List[str] = []
+    row = 0
+
+    def build_batch() -> pd.DataFrame:
+        nonlocal row
+        first_row = row
+        row += len(lines)
+        if upload_format == "csv":
+            frame = pd.read_csv(io.StringIO("\n".join([header] + lines)), dtype=str, keep_default_na=False, na_values=[""])
+            frame.index = np.arange(first_row, first_row + len(frame))
+            return frame
+        records = []
+        for offset, line in enumerate(lines):
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("se esperaba un objeto JSON")
+                records.append(record)
+            except ValueError:
+                # Se cuenta como leída y rechazada; el resto del lote sigue
+                report.rows_read += 1
+                report.reject([first_row + offset], "línea JSON no válida")
+                records.append(None)
+        # Las líneas inválidas se descartan sin alterar la numeración de las demás
+        frame = pd.DataFrame.from_records([r for r in records if r is not None], columns=list(TRANSACTION_FIELDS))
+        frame.index = [first_row + i for i, r in enumerate(records) if r is not None]
+        return frame
+
+    async for chunk in body:
+        report.bytes_read += len(chunk)
+        pending += decoder.decode(chunk)
+        *complete, pending = pending.split("\n")
+        for line in complete:
+            line = line.strip()
+            if not line:
+                continue
+            if upload_format == "csv" and header is None:
+                header = line
+                continue
+            lines.append(line)
+            if len(lines) >= batch_size:
+                yield build_batch()
+                lines = []
+    pending = (pending + decoder.decode(b"", final=True)).strip()
+    if pending:
+        if upload_format == "csv" and header is None:
+            header = pending
+        else:
+            lines.append(pending)
+    if lines:
+        yield build_batch()
+
+
+def append_warehouse_batch(batch: pd.DataFrame, store: TransactionStore) -> Tuple[np.ndarray, np.ndarray, int]:
+    """Normalizar un lote del warehouse con búsquedas vectorizadas y anexarlo al almacén
+
+    Espera las columnas transaction_id, transaction_date, amount, description, category y
+    transaction_type (en cualquier capitalización). Devuelve (ids locales, transaction_id de
+    origen, filas descartadas por monto o fecha inválidos).
+    """
+    batch = batch.rename(columns=str.lower)
+    category_codes = {alias: CATEGORY_CODES[category.value] for alias, category in WAREHOUSE_CATEGORY_ALIASES.items()}
+    type_codes = {alias: TYPE_CODES[transaction_type.value] for alias, transaction_type in WAREHOUSE_TYPE_ALIASES.items()}
+
+    categories = (
+        batch["category"].astype("string").str.strip().str.lower().map(category_codes)
+        .fillna(CATEGORY_CODES[WAREHOUSE_DEFAULT_CATEGORY.value]).to_numpy(dtype=np.uint8)
+    )
+    types = (
+        batch["transaction_type"].astype("string").str.strip().str.lower().map(type_codes)
+        .fillna(TYPE_CODES[WAREHOUSE_DEFAULT_TYPE.value]).to_numpy(dtype=np.uint8)
+    )
+    amounts = pd.to_numeric(batch["amount"], errors="coerce").to_numpy(dtype=np.float64)
+    dates = pd.to_datetime(batch["transaction_date"], errors="coerce")
+
+    # Mismas reglas que FinancialTransaction: monto > 0 y fecha válida
+    valid = np.isfinite(amounts) & (amounts > 0) & dates.notna().to_numpy()
+    dropped = int((~valid).sum())
+    if not valid.all():
+        categories, types, amounts = categories[valid], types[valid], amounts[valid]
+        batch, dates = batch.loc[valid], dates[valid]
+
+    ids = store.extend_columns(
+        days=days_from_datetimes(dates),
+        amounts=amounts,
+        categories=categories,
+        types=types,
+        descriptions=batch["description"].fillna("").astype(str).to_numpy()
+    )
+    return ids, batch["transaction_id"].astype(str).to_numpy(), dropped
+
+
+def iter_ledger_chunks(
+    file_path: Path,
+    report: IngestionReport,
+    chunk_size: int = LEDGER_CHUNK_ROWS
+) -> Iterator[pd.DataFrame]:
+    """Leer un libro XLSX o CSV por bloques de `chunk_size` filas sin cargarlo completo"""
+    file_path = Path(file_path)
+    report.bytes_total = file_path.stat().st_size
+    suffix = file_path.suffix.lower()
+    if suffix == ".csv":
+        yield from _iter_csv_chunks(file_path, report, chunk_size)
+    elif suffix in (".xlsx", ".xlsm"):
+        yield from _iter_xlsx_chunks(file_path, report, chunk_size)
+    else:
+        # Formatos sin lector por filas (p. ej. .xls): lectura completa como antes
+        frame = pd.read_excel(file_path)
+        report.rows_total = len(frame)
+        report.bytes_read = report.bytes_total
+        for start in range(0, len(frame), chunk_size):
+            yield frame.iloc[start:start + chunk_size]
+
+
+def _iter_csv_chunks(file_path: Path, report: IngestionReport, chunk_size: int) -> Iterator[pd.DataFrame]:
+    with open(file_path, "rb") as handle:
+        for chunk in pd.read_csv(handle, chunksize=chunk_size, encoding="utf-8-sig"):
+            report.bytes_read = handle.tell()
+            yield chunk
+
+
+def _iter_xlsx_chunks(file_path: Path, report: IngestionReport, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """Recorrer la hoja activa en modo solo lectura (openpyxl no materializa el libro)"""
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        sheet = workbook.active
+        rows = sheet.iter_rows(values_only=True)
+        header = next((row for row in rows if any(value is not None for value in row)), None)
+        if header is None:
+            return
+        width = len(header)
+        columns = [str(value) if value is not None else f"column_{i}" for i, value in enumerate(header)]
+        if sheet.max_row:
+            report.rows_total = max(sheet.max_row - 1, 0)
+
+        buffer: List[Tuple[Any, ...]] = []
+        for row in rows:
+            if len(row) != width:
+                row = tuple(row[:width]) + (None,) * (width - len(row))
+            buffer.append(row)
+            if len(buffer) >= chunk_size:
+                yield pd.DataFrame.from_records(buffer, columns=columns)
+                buffer = []
+        if buffer:
+            yield pd.DataFrame.from_records(buffer, columns=columns)
+        report.bytes_read = report.bytes_total or 0
+    finally:
+        workbook.close()
+
+
+def ingest_ledger(
+    file_path: Path,
+    chunk_size: int = LEDGER_CHUNK_ROWS,
+    on_progress: Optional[Callable[[IngestionReport], None]] = None,
+    report: Optional[IngestionReport] = None
+) -> Tuple[Optional[TransactionStore], IngestionReport]:
+    """Construir el almacén columnar de un libro XLSX/CSV bloque a bloque
+
+    Solo un bloque de filas crudas vive en memoria a la vez; el almacén crece con las
+    filas aceptadas ya normalizadas. `on_progress` se invoca después de cada bloque.
+    """
+    report = report or IngestionReport(source=str(file_path))
+    store = TransactionStore(capacity=chunk_size)
+    mapping: Optional[Dict[str, Optional[str]]] = None
+    for chunk in iter_ledger_chunks(file_path, report, chunk_size):
+        if mapping is None:
+            mapping = resolve_column_mapping(chunk.columns)
+            report.column_mapping = mapping
+            missing = [field for field in REQUIRED_COLUMNS if mapping[field] is None]
+            if missing:
+                report.rows_read = report.rows_total or len(chunk)
+                report.reject(range(report.rows_read), f"columnas requeridas no encontradas: {', '.join(missing)}")
+                report.done = True
+                return None, report
+        ingest_frame(chunk, mapping, store, report, row_offset=report.rows_read)
+        report.chunks += 1
+        if on_progress:
+            on_progress(report)
+    report.done = True
+    if on_progress:
+        on_progress(report)
+    return (store if len(store) else None), report
@@ -0,0 +1,179 @@
+"""
+Caché en memoria con expulsión LRU, expiración por TTL y límite de peso
+Segura para acceso concurrente desde hilos y desde el event loop
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class LRUTTLCache:
+    """Caché LRU con TTL opcional y límite de memoria aproximado"""
+
+    def __init__(
+        self,
+        max_entries: int = 128,
+        ttl_seconds: Optional[float] = None,
+        max_weight: Optional[int] = None,
+        weigher: Optional[Callable[[Any], int]] = None,
+        on_evict: Optional[Callable[[Hashable, Any], None]] = None
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_weight = max_weight
+        self.weigher = weigher or (lambda value: 1)
+        self.on_evict = on_evict
+        self._entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._expires_at: Dict[Hashable, float] = {}
+        self._weights: Dict[Hashable, int] = {}
+        self._total_weight = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Obtener un valor y marcarlo como usado recientemente"""
+        evicted = []
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            if self._is_expired(key):
+                evicted.append(self._remove(key))
+                self.misses += 1
+                value = default
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                value = self._entries[key]
+        self._notify(evicted)
+        return value
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """Obtener un valor sin alterar el orden LRU ni las estadísticas"""
+        with self._lock:
+            if key not in self._entries or self._is_expired(key):
+                return default
+            return self._entries[key]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """Guardar un valor, recalcular su peso y expulsar lo necesario"""
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                self._total_weight -= self._weights.pop(key, 0)
+                self._entries.pop(key)
+            weight = max(int(self.weigher(value)), 0)
+            self._entries[key] = value
+            self._weights[key] = weight
+            self._total_weight += weight
+            if self.ttl_seconds:
+                self._expires_at[key] = time.monotonic() + self.ttl_seconds
+            evicted.extend(self._enforce_limits(protect=key))
+        self._notify(evicted)
+
+    def reweigh(self, key: Hashable) -> None:
+        """Recalcular el peso de una entrada cuyo contenido creció o disminuyó"""
+        evicted = []
+        with self._lock:
+            if key not in self._entries:
+                return
+            weight = max(int(self.weigher(self._entries[key])), 0)
+            self._total_weight += weight - self._weights.get(key, 0)
+            self._weights[key] = weight
+            evicted.extend(self._enforce_limits(protect=key))
+        self._notify(evicted)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Eliminar una entrada sin invocar el callback de expulsión"""
+        with self._lock:
+            if key not in self._entries:
+                return default
+            _, value = self._remove(key)
+            return value
+
+    def invalidate_where(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Eliminar todas las entradas cuya llave cumpla el predicado"""
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def purge_expired(self) -> int:
+        """Expulsar entradas vencidas"""
+        with self._lock:
+            evicted = [self._remove(key) for key in list(self._entries) if self._is_expired(key)]
+        self._notify(evicted)
+        return len(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._expires_at.clear()
+            self._weights.clear()
+            self._total_weight = 0
+
+    def items(self):
+        with self._lock:
+            return list(self._entries.items())
+
+    def stats(self) -> Dict[str, Any]:
+        """Estadísticas de uso de la caché"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "weight": self._total_weight,
+                "max_entries": self.max_entries,
+                "max_weight": self.max_weight,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "evictions": self.evictions
+            }
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._entries and not self._is_expired(key)
+
+    def _is_expired(self, key: Hashable) -> bool:
+        expires_at = self._expires_at.get(key)
+        return expires_at is not None and expires_at <= time.monotonic()
+
+    def _remove(self, key: Hashable):
+        value = self._entries.pop(key)
+        self._expires_at.pop(key, None)
+        self._total_weight -= self._weights.pop(key, 0)
+        return key, value
+
+    def _enforce_limits(self, protect: Hashable):
+        """Expulsar entradas menos usadas hasta respetar los límites (la protegida queda al final)"""
+        self._entries.move_to_end(protect)
+        evicted = []
+        for key in [k for k in self._entries if self._is_expired(k) and k != protect]:
+            evicted.append(self._remove(key))
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_entries
+            or (self.max_weight is not None and self._total_weight > self.max_weight)
+        ):
+            evicted.append(self._remove(next(iter(self._entries))))
+        self.evictions += len(evicted)
+        return evicted
+
+    def _notify(self, evicted) -> None:
+        """Invocar el callback fuera del lock para no bloquear otros accesos"""
+        if not self.on_evict:
+            return
+        for key, value in evicted:
+            try:
+                self.on_evict(key, value)
+            except Exception:
+                pass
@@ -0,0 +1,103 @@
+"""
+Paginación por cursor (keyset) de transacciones
+Cursores opacos sobre (fecha, id) y el índice equivalente sobre el almacén en memoria,
+para recorrer libros grandes sin transferir ni recorrer lo que no se muestra
+"""
+
+import json
+import base64
+from datetime import date
+from typing import Optional, Tuple, Union
+
+import numpy as np
+
+from app.services.transaction_store import TransactionStore, date_to_day
+
+# Origen de los ids del cursor: ids locales del almacén o transaction_id de Snowflake
+MEMORY_SOURCE = "mem"
+WAREHOUSE_SOURCE = "sf"
+
+_ID_BITS = 32
+
+
+class PageCursor:
+    """Posición (fecha, id) de una transacción dentro del orden fecha DESC, id DESC"""
+
+    def __init__(self, source: str, day: date, transaction_id: Union[int, str]):
+        self.source = source
+        self.day = day
+        self.transaction_id = transaction_id
+
+    def encode(self) -> str:
+        payload = json.dumps({"s": self.source, "d": self.day.isoformat(), "id": self.transaction_id}, separators=(",", ":"))
+        return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+    @classmethod
+    def decode(cls, token: str) -> "PageCursor":
+        """Leer un cursor; ValueError si no es válido"""
+        try:
+            padded = token + "=" * (-len(token) % 4)
+            payload = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+            return cls(payload["s"], date.fromisoformat(payload["d"]), payload["id"])
+        except Exception:
+            raise ValueError("Cursor de paginación no válido")
+
+
+class KeysetIndex:
+    """Llaves compuestas día·2^32 + id sobre el almacén ordenado por (fecha, id)"""
+
+    def __init__(self, store: TransactionStore):
+        self.keys = (store.days.astype(np.int64) << _ID_BITS) | store.ids.astype(np.int64)
+        self.version = store.version
+
+    @staticmethod
+    def key(day: date, transaction_id: int) -> int:
+        return (date_to_day(day) << _ID_BITS) | int(transaction_id)
+
+    def page(
+        self,
+        store: TransactionStore,
+        limit: int,
+        after: Optional[PageCursor] = None,
+        before: Optional[PageCursor] = None,
+        start: Optional[date] = None,
+        end: Optional[date] = None,
+        category_code: Optional[int] = None,
+        type_code: Optional[int] = None
+    ) -> Tuple[np.ndarray, bool, bool]:
+        """Posiciones de la página (más recientes primero) y si hay páginas más antiguas/recientes
+
+        `after` avanza hacia transacciones más antiguas que el cursor; `before` retrocede
+        hacia las más recientes. Los rangos se resuelven con búsqueda binaria y los filtros
+        de categoría/tipo solo se evalúan dentro del rango de fechas.
+        """
+        range_lo = 0 if start is None else int(np.searchsorted(store.days, date_to_day(start), side="left"))
+        range_hi = len(store) if end is None else int(np.searchsorted(store.days, date_to_day(end), side="right"))
+        lo, hi = range_lo, max(range_lo, range_hi)
+        if after is not None:
+            hi = max(lo, min(hi, int(np.searchsorted(self.keys, self.key(after.day, after.transaction_id), side="left"))))
+        if before is not None:
+            lo = min(hi, max(lo, int(np.searchsorted(self.keys, self.key(before.day, before.transaction_id), side="right"))))
+
+        if category_code is None and type_code is None:
+            candidates = np.arange(lo, hi)
+            older_exists = lo > range_lo
+            newer_exists = hi < range_hi
+        else:
+            mask = np.ones(range_hi - range_lo, dtype=bool)
+            if category_code is not None:
+                mask &= store.categories[range_lo:range_hi] == category_code
+            if type_code is not None:
+                mask &= store.types[range_lo:range_hi] == type_code
+            matches = np.flatnonzero(mask) + range_lo
+            candidates = matches[(matches >= lo) & (matches < hi)]
+            older_exists = bool((matches < lo).any())
+            newer_exists = bool((matches >= hi).any())
+
+        if before is not None and after is None:
+            page = candidates[:limit]
+            newer_exists = newer_exists or len(candidates) > limit
+        else:
+            page = candidates[-limit:] if limit else candidates[:0]
+            older_exists = older_exists or len(candidates) > limit
+        return page[::-1], older_exists, newer_exists
@@ -0,0 +1,170 @@
+"""
+Caché de respuestas del LLM
+Indexa cada respuesta por la pregunta normalizada y la huella del contexto financiero con
+el que se generó. Un nivel en memoria (LRU con TTL) y, opcionalmente, uno en disco que
+sobrevive reinicios. Cuando cambia la huella de una empresa sus entradas anteriores se descartan,
+por eso cada tipo debe corresponder a un solo llamador (un mismo armado de contexto).
+"""
+
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+import unicodedata
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from app.services.lru_cache import LRUTTLCache
+
+logger = logging.getLogger(__name__)
+
+# (tipo, empresa, huella del contexto, hash de la pregunta)
+CacheKey = Tuple[str, str, str, str]
+
+_IGNORED_PUNCTUATION = re.compile(r"[¿?¡!]+")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_question(text: str) -> str:
+    """Minúsculas, sin acentos, sin signos de interrogación/exclamación y con espacios colapsados"""
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    stripped = _IGNORED_PUNCTUATION.sub(" ", stripped)
+    return _WHITESPACE.sub(" ", stripped).strip(" .")
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:24]
+
+
+class ResponseCache:
+    """Caché de dos niveles (memoria y disco opcional) para respuestas serializables en JSON"""
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl_seconds: Optional[float] = 3600,
+        cache_dir: Optional[str] = None,
+        enabled: bool = True
+    ):
+        self.enabled = enabled
+        self.ttl_seconds = ttl_seconds or None
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self._memory = LRUTTLCache(max_entries=max_entries, ttl_seconds=self.ttl_seconds)
+        # Última huella vista por (tipo, empresa); al cambiar se invalida lo anterior
+        self._fingerprints: Dict[Tuple[str, str], str] = {}
+        self._lock = threading.Lock()
+        self.disk_hits = 0
+        self.invalidations = 0
+
+    def key(self, kind: str, empresa_id: Optional[str], question: str, context: str) -> CacheKey:
+        return (kind, empresa_id or "default", _digest(context), _digest(normalize_question(question)))
+
+    def get(self, key: CacheKey) -> Optional[Any]:
+        """Buscar en memoria y luego en disco (un acierto en disco se promueve a memoria)"""
+        if not self.enabled:
+            return None
+        self._observe(key)
+        value = self._memory.get(key)
+        if value is not None:
+            return value
+        value = self._read_disk(key)
+        if value is not None:
+            self.disk_hits += 1
+            self._memory.set(key, value)
+        return value
+
+    def set(self, key: CacheKey, value: Any) -> None:
+        if not self.enabled:
+            return
+        self._observe(key)
+        self._memory.set(key, value)
+        self._write_disk(key, value)
+
+    def clear(self) -> None:
+        self._memory.clear()
+        with self._lock:
+            self._fingerprints.clear()
+        if self.cache_dir is not None:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def _observe(self, key: CacheKey) -> None:
+        """Descartar las respuestas de la empresa generadas con otra huella de contexto"""
+        kind, empresa_id, fingerprint, _ = key
+        with self._lock:
+            previous = self._fingerprints.get((kind, empresa_id))
+            if previous == fingerprint:
+                return
+            self._fingerprints[(kind, empresa_id)] = fingerprint
+        if previous is None and self.cache_dir is None:
+            return
+
+        removed = self._memory.invalidate_where(
+            lambda cached: cached[:2] == (kind, empresa_id) and cached[2] != fingerprint
+        )
+        if self.cache_dir is not None:
+            empresa_dir = self._empresa_dir(kind, empresa_id)
+            if empresa_dir.exists():
+                for stale in empresa_dir.iterdir():
+                    if stale.name != fingerprint:
+                        shutil.rmtree(stale, ignore_errors=True)
+                        removed += 1
+        if removed:
+            self.invalidations += 1
+            logger.info(f"♻️ Contexto financiero de {empresa_id} cambió, respuestas '{kind}' en caché descartadas")
+
+    def _empresa_dir(self, kind: str, empresa_id: str) -> Path:
+        return self.cache_dir / kind / hashlib.sha1(empresa_id.encode("utf-8")).hexdigest()[:12]
+
+    def _entry_path(self, key: CacheKey) -> Path:
+        kind, empresa_id, fingerprint, question = key
+        return self._empresa_dir(kind, empresa_id) / fingerprint / f"{question}.json"
+
+    def _read_disk(self, key: CacheKey) -> Optional[Any]:
+        if self.cache_dir is None:
+            return None
+        path = self._entry_path(key)
+        try:
+            if self.ttl_seconds and time.time() - path.stat().st_mtime > self.ttl_seconds:
+                path.unlink(missing_ok=True)
+                return None
+            return json.loads(path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"⚠️ Entrada de caché de respuestas no válida ({path.name}): {e}")
+            return None
+
+    def _write_disk(self, key: CacheKey, value: Any) -> None:
+        if self.cache_dir is None:
+            return
+        path = self._entry_path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(f".tmp-{os.getpid()}")
+            tmp.write_text(json.dumps(value, ensure_ascii=False, default=str), encoding="utf-8")
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning(f"⚠️ No se pudo guardar la respuesta en la caché en disco: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "memory": self._memory.stats(),
+            "disk_dir": str(self.cache_dir) if self.cache_dir else None,
+            "disk_hits": self.disk_hits,
+            "invalidations": self.invalidations
+        }
+
+
+# Instancia global del servicio
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("GEMINI_CACHE_MAX_ENTRIES", "1024")),
+    ttl_seconds=float(os.getenv("GEMINI_CACHE_TTL_SECONDS", "3600")),
+    cache_dir=os.getenv("GEMINI_CACHE_DIR") or None,
+    enabled=os.getenv("GEMINI_CACHE_ENABLED", "true").lower() == "true"
+)
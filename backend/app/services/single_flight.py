@@ -0,0 +1,44 @@
+"""
+Coalescencia single-flight de llamadas idénticas
+Las llamadas concurrentes con la misma llave comparten una sola tarea en curso y reciben
+su mismo resultado (o excepción), así una ráfaga de duplicados cuesta una llamada externa
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """Tareas en curso por llave; se olvidan al terminar (no es una caché)"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """Ejecutar `factory()` una sola vez por llave entre llamadas concurrentes"""
+        self.calls += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done, key=key: self._forget(key, done))
+        else:
+            self.coalesced += 1
+        # shield: si un llamador se cancela (p. ej. cliente desconectado) los demás siguen esperando
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Marcar la excepción como recuperada aunque todos los llamadores se hayan cancelado
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug(f"Llamada single-flight '{self.name}' falló: {task.exception()!r}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"in_flight": len(self._inflight), "calls": self.calls, "coalesced": self.coalesced}
@@ -0,0 +1,167 @@
+"""
+Pool de conexiones a Snowflake
+Conexiones reutilizables con límite de tamaño, verificación de salud de las conexiones
+ociosas y reconexión con backoff exponencial
+"""
+
+import time
+import queue
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class PoolExhaustedError(RuntimeError):
+    """No hubo conexión disponible dentro del tiempo de espera"""
+
+
+class SnowflakeConnectionPool:
+    """Pool acotado de conexiones creadas con `factory` (thread-safe)"""
+
+    def __init__(
+        self,
+        factory: Callable[[], Any],
+        max_size: int = 4,
+        acquire_timeout: float = 30.0,
+        health_check_after: float = 300.0,
+        max_retries: int = 3,
+        backoff_seconds: float = 0.5
+    ):
+        self.factory = factory
+        self.max_size = max(int(max_size), 1)
+        self.acquire_timeout = acquire_timeout
+        self.health_check_after = health_check_after
+        self.max_retries = max(int(max_retries), 1)
+        self.backoff_seconds = backoff_seconds
+        # LIFO: se reutiliza la conexión más reciente y las demás pueden expirar
+        self._idle: "queue.LifoQueue[Tuple[Any, float]]" = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._closed = False
+        self.connections_created = 0
+        self.failed_health_checks = 0
+
+    def _create(self) -> Any:
+        """Crear una conexión reintentando con backoff exponencial"""
+        delay = self.backoff_seconds
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                return self.factory()
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"⚠️ Conexión a Snowflake falló (intento {attempt}/{self.max_retries}): {e}")
+                time.sleep(delay)
+                delay *= 2
+
+    def _is_healthy(self, connection: Any, idle_since: float) -> bool:
+        if connection.is_closed():
+            return False
+        if time.monotonic() - idle_since < self.health_check_after:
+            return True
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, connection: Any) -> None:
+        with self._lock:
+            self._created -= 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def acquire(self, timeout: Optional[float] = None) -> Any:
+        """Tomar una conexión sana del pool, creando una nueva si hay cupo"""
+        if self._closed:
+            raise PoolExhaustedError("El pool de Snowflake está cerrado")
+        deadline = time.monotonic() + (self.acquire_timeout if timeout is None else timeout)
+        while True:
+            try:
+                connection, idle_since = self._idle.get_nowait()
+            except queue.Empty:
+                connection = None
+
+            if connection is not None:
+                if self._is_healthy(connection, idle_since):
+                    return connection
+                self.failed_health_checks += 1
+                self._discard(connection)
+                continue
+
+            with self._lock:
+                can_create = self._created < self.max_size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                try:
+                    connection = self._create()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+                self.connections_created += 1
+                return connection
+
+            # Pool lleno: esperar a que se libere una conexión
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise PoolExhaustedError(f"Sin conexiones disponibles (máximo {self.max_size})")
+            try:
+                # Espera acotada para re-evaluar el cupo si otra conexión se descartó
+                self._idle.put(self._idle.get(timeout=min(remaining, 1.0)))
+            except queue.Empty:
+                continue
+
+    def release(self, connection: Any, broken: bool = False) -> None:
+        """Devolver una conexión al pool (o descartarla si quedó inservible)"""
+        if broken or self._closed or connection.is_closed():
+            self._discard(connection)
+            return
+        self._idle.put((connection, time.monotonic()))
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None) -> Iterator[Any]:
+        """Usar una conexión del pool durante el bloque `with`"""
+        connection = self.acquire(timeout)
+        broken = False
+        try:
+            yield connection
+        except Exception:
+            broken = connection.is_closed()
+            if not broken:
+                # Una transacción explícita abortada no debe pasar al siguiente usuario de la conexión
+                try:
+                    connection.rollback()
+                except Exception as rollback_error:
+                    logger.warning(f"⚠️ ROLLBACK falló, se descarta la conexión: {rollback_error}")
+                    broken = True
+            raise
+        finally:
+            self.release(connection, broken=broken)
+
+    def close(self) -> None:
+        """Cerrar todas las conexiones ociosas; las que estén en uso se cierran al liberarse"""
+        self._closed = True
+        while True:
+            try:
+                connection, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(connection)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_size": self.max_size,
+            "open": self._created,
+            "idle": self._idle.qsize(),
+            "connections_created": self.connections_created,
+            "failed_health_checks": self.failed_health_checks
+        }
@@ -3,20 +3,135 @@ Servicio de integración con Snowflake para análisis financiero avanzado
 """
 
 import os
+import math
+import time
+import asyncio
 import logging
-from typing import Dict, List, Optional, Any
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Any, Set, Tuple
 from datetime import datetime, timedelta
+from pathlib import Path
 import pandas as pd
 from snowflake.connector import connect
+from snowflake.connector.errors import NotSupportedError, ProgrammingError
+from snowflake.connector.errorcode import ER_NO_ARROW_RESULT, ER_NO_PYARROW, ER_NO_PYARROW_SNOWSQL
 from snowflake.connector.pandas_tools import write_pandas
 import json
 from dotenv import load_dotenv
 
+from app.services.ledger_ingestion import (
+    append_warehouse_batch, WAREHOUSE_CATEGORY_ALIASES, WAREHOUSE_DEFAULT_CATEGORY,
+    WAREHOUSE_TYPE_ALIASES, WAREHOUSE_DEFAULT_TYPE
+)
+from app.services.audit_queue import AuditWriteQueue
+from app.services.lru_cache import LRUTTLCache
+from app.services.snowflake_pool import SnowflakeConnectionPool
+from app.services.transaction_store import TransactionStore
+
 # Cargar variables de entorno
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+_MISSING = object()
+
+# Tablas de la cola de auditoría: tipo de registro -> (tabla, [(columna, es_json)])
+_AUDIT_TABLES: Dict[str, Tuple[str, List[Tuple[str, bool]]]] = {
+    "chat": ("chat_conversations", [
+        ("conversation_id", False), ("pyme_id", False), ("user_message", False), ("ai_response", False),
+        ("context_data", True), ("confidence_score", False), ("created_at", False)
+    ]),
+    "simulation": ("simulations", [
+        ("simulation_id", False), ("pyme_id", False), ("scenario_name", False),
+        ("scenario_data", True), ("results", True), ("created_at", False)
+    ]),
+}
+
+
+def _sql_alias_case(expression: str, aliases: Dict[str, Any], default: Any) -> str:
+    """CASE SQL equivalente a un mapa de alias (mismas reglas que la normalización en Python)"""
+    branches = " ".join(
+        "WHEN '{}' THEN '{}'".format(alias.replace("'", "''"), target.value)
+        for alias, target in aliases.items()
+    )
+    return f"CASE {expression} {branches} ELSE '{default.value}' END"
+
+# Materialización incremental de ROW_DATA_EMPRESA con tipos y categorías normalizados: el stream entrega inserciones, borrados y
+# actualizaciones (par DELETE+INSERT con el mismo METADATA$ROW_ID, que es estable por fila);
+# se conserva una acción por fila, prefiriendo la inserción
+_LEDGER_MERGE_SQL = f"""
+    MERGE INTO ledger_transactions t
+    USING (
+        SELECT
+            MD5(METADATA$ROW_ID) as transaction_id,
+            empresa_id,
+            TRY_TO_DATE(fecha, 'DD/MM/YYYY') as transaction_date,
+            TRY_TO_DECIMAL(TO_VARCHAR(monto), 15, 2) as amount,
+            concepto as description,
+            {_sql_alias_case("LOWER(TRIM(categoria))", WAREHOUSE_CATEGORY_ALIASES, WAREHOUSE_DEFAULT_CATEGORY)} as category,
+            {_sql_alias_case("LOWER(TRIM(tipo))", WAREHOUSE_TYPE_ALIASES, WAREHOUSE_DEFAULT_TYPE)} as transaction_type,
+            METADATA$ACTION as action
+        FROM row_data_empresa_stream
+        QUALIFY ROW_NUMBER() OVER (
+            PARTITION BY METADATA$ROW_ID
+            ORDER BY IFF(METADATA$ACTION = 'INSERT', 0, 1)
+        ) = 1
+    ) s
+    ON t.transaction_id = s.transaction_id
+    WHEN MATCHED AND s.action = 'DELETE' THEN DELETE
+    WHEN MATCHED THEN UPDATE SET
+        empresa_id = s.empresa_id,
+        transaction_date = s.transaction_date,
+        amount = s.amount,
+        description = s.description,
+        category = s.category,
+        transaction_type = s.transaction_type,
+        updated_at = CURRENT_TIMESTAMP()
+    WHEN NOT MATCHED AND s.action = 'INSERT' THEN INSERT
+        (transaction_id, empresa_id, transaction_date, amount, description, category, transaction_type)
+    VALUES
+        (s.transaction_id, s.empresa_id, s.transaction_date, s.amount, s.description, s.category, s.transaction_type)
+"""
+
+# Filas vigentes de la tabla materializada. ROW_DATA_EMPRESA no se modifica desde el API: un cambio
+# se guarda en `transactions` con el mismo transaction_id (reemplaza a la fila del ledger) y una baja
+# deja una lápida en ledger_deletions; el stream puede seguir actualizando la fila original
+_LEDGER_VISIBLE_SQL = """(
+    SELECT l.transaction_id, l.empresa_id, l.transaction_date, l.amount, l.description,
+           l.category, l.transaction_type, l.updated_at
+    FROM ledger_transactions l
+    WHERE NOT EXISTS (
+        SELECT 1 FROM transactions t
+        WHERE t.transaction_id = l.transaction_id AND t.pyme_id = l.empresa_id
+    )
+    AND NOT EXISTS (
+        SELECT 1 FROM ledger_deletions d
+        WHERE d.transaction_id = l.transaction_id AND d.empresa_id = l.empresa_id
+    )
+)"""
+_LEDGER_TOMBSTONE_MERGE = """
+    ON target.transaction_id = source.transaction_id AND target.empresa_id = source.empresa_id
+    WHEN NOT MATCHED THEN INSERT (transaction_id, empresa_id) VALUES (source.transaction_id, source.empresa_id)
+"""
+
+class WarehouseLoad:
+    """Transacciones traídas de Snowflake: almacén, ids de origen y marca de agua por tabla tipada"""
+    
+    RAW_TABLE = "ROW_DATA_EMPRESA"
+    LEDGER_TABLE = "ledger_transactions"
+    TRANSACTIONS_TABLE = "transactions"
+    # Columna de empresa de cada tabla tipada (también funciona como lista blanca de tablas)
+    TENANT_COLUMNS = {LEDGER_TABLE: "empresa_id", TRANSACTIONS_TABLE: "pyme_id"}
+    # Expresión FROM de cada tabla tipada (el ledger sin las filas reemplazadas o dadas de baja)
+    SOURCES = {LEDGER_TABLE: _LEDGER_VISIBLE_SQL, TRANSACTIONS_TABLE: TRANSACTIONS_TABLE}
+    
+    def __init__(self, store: TransactionStore, source_ids: Dict[int, str], watermarks: Dict[str, datetime]):
+        self.store = store
+        self.source_ids = source_ids  # id local -> transaction_id en Snowflake (solo tablas tipadas)
+        self.watermarks = watermarks  # tabla tipada -> máximo updated_at visto (o la hora de la lectura)
+
 class SnowflakeService:
     """Servicio para integración con Snowflake Data Cloud"""
     
@@ -27,149 +142,431 @@ class SnowflakeService:
         self.warehouse = os.getenv('SNOWFLAKE_WAREHOUSE', 'COMPUTE_WH')
         self.database = os.getenv('SNOWFLAKE_DATABASE', 'PYME_FINANCIAL')
         self.schema = os.getenv('SNOWFLAKE_SCHEMA', 'PUBLIC')
-        self.connection = None
+        self.pool: Optional[SnowflakeConnectionPool] = None
+        self.pool_size = int(os.getenv('SNOWFLAKE_POOL_SIZE', '4'))
+        self.tables_ready = False
+        self.ledger_ready = False  # Tabla materializada y stream sobre ROW_DATA_EMPRESA creados
+        # Con un horario (p. ej. "5 MINUTE") un TASK de Snowflake refresca la tabla materializada
+        self.ledger_task_schedule = os.getenv('SNOWFLAKE_LEDGER_TASK_SCHEDULE', '').strip()
+        # updated_at es la hora de inicio de la sentencia: una escritura larga puede confirmar filas
+        # con marcas anteriores a la última sincronización, así que se relee este margen
+        self.sync_lookback = timedelta(seconds=float(os.getenv('SNOWFLAKE_SYNC_LOOKBACK_SECONDS', '300')))
+        self._connect_lock = threading.Lock()
+        # Hilos dedicados: las llamadas bloqueantes del conector no ocupan el event loop
+        self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="snowflake")
+        # Resultados de consultas analíticas por (pyme_id, consulta, parámetros); el peso de una
+        # lista de filas es su número de filas, así las cargas completas no desbordan la memoria
+        self.result_cache = LRUTTLCache(
+            max_entries=int(os.getenv('SNOWFLAKE_RESULT_CACHE_MAX_ENTRIES', '512')),
+            ttl_seconds=float(os.getenv('SNOWFLAKE_RESULT_CACHE_TTL_SECONDS', '300')) or None,
+            max_weight=int(os.getenv('SNOWFLAKE_RESULT_CACHE_MAX_ROWS', '200000')),
+            weigher=lambda result: len(result) if isinstance(result, list) else 1
+        )
+        # Generación de resultados por PyME (y global): un cálculo iniciado antes de una
+        # invalidación no se guarda después de ella
+        self._result_lock = threading.Lock()
+        self._result_generations: Dict[str, int] = {}
+        self._result_epoch = 0
+        # Escrituras de auditoría (chat, simulaciones) fuera del camino de la solicitud
+        self.audit_queue = AuditWriteQueue(
+            self.write_audit_records,
+            batch_size=int(os.getenv('SNOWFLAKE_AUDIT_BATCH_SIZE', '500')),
+            flush_interval=float(os.getenv('SNOWFLAKE_AUDIT_FLUSH_SECONDS', '2')),
+            max_depth=int(os.getenv('SNOWFLAKE_AUDIT_MAX_DEPTH', '10000')),
+            spill_path=Path(os.getenv('SNOWFLAKE_AUDIT_SPILL_PATH', 'data/.audit_spill.jsonl'))
+        )
         
+    @property
+    def is_connected(self) -> bool:
+        return self.pool is not None
+    
+    def _open_connection(self):
+        """Abrir una conexión nueva (fábrica del pool)"""
+        return connect(
+            account=self.account,
+            user=self.user,
+            password=self.password,
+            warehouse=self.warehouse,
+            database=self.database,
+            schema=self.schema,
+            client_session_keep_alive=True  # Evita que la sesión expire mientras está ociosa en el pool
+        )
+    
     def connect(self) -> bool:
-        """Establecer conexión con Snowflake"""
+        """Establecer conexión con Snowflake (crea el pool y valida una primera conexión)"""
         try:
-            self.connection = connect(
-                account=self.account,
-                user=self.user,
-                password=self.password,
-                warehouse=self.warehouse,
-                database=self.database,
-                schema=self.schema
+            pool = SnowflakeConnectionPool(
+                self._open_connection,
+                max_size=self.pool_size,
+                acquire_timeout=float(os.getenv('SNOWFLAKE_POOL_TIMEOUT_SECONDS', '30')),
+                health_check_after=float(os.getenv('SNOWFLAKE_HEALTH_CHECK_SECONDS', '300'))
             )
+            pool.release(pool.acquire())
+            self.pool = pool
+            self.audit_queue.start()
             logger.info("✅ Conexión exitosa con Snowflake")
             return True
         except Exception as e:
             logger.error(f"❌ Error conectando con Snowflake: {e}")
             return False
     
+    def ensure_connected(self) -> bool:
+        """Crear el pool y las tablas una sola vez por proceso"""
+        with self._connect_lock:
+            if self.is_connected:
+                return True
+            if not self.connect():
+                return False
+            if not self.tables_ready:
+                self.tables_ready = self.create_tables()
+            return True
+    
     def disconnect(self):
-        """Cerrar conexión con Snowflake"""
-        if self.connection:
-            self.connection.close()
+        """Cerrar las conexiones del pool"""
+        if self.pool:
+            self.audit_queue.stop()  # Escribir (o derramar) lo pendiente antes de cerrar
+            self.pool.close()
+            self.pool = None
             logger.info("🔌 Conexión con Snowflake cerrada")
     
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "connected": self.is_connected,
+            "pool": self.pool.stats() if self.pool else None,
+            "result_cache": self.result_cache.stats(),
+            "audit_queue": self.audit_queue.stats()
+        }
+    
+    def _cached(self, pyme_id: str, query: str, params: Tuple[Any, ...], compute: Callable[[], Any]) -> Any:
+        """Resolver una consulta desde la caché de resultados o ejecutarla y guardarla"""
+        key = (pyme_id, query, params)
+        result = self.result_cache.get(key, _MISSING)
+        if result is not _MISSING:
+            return result
+        generation = self._result_generation(pyme_id)
+        result = compute()
+        if result:  # Los errores devuelven vacío y no se cachean
+            with self._result_lock:
+                # Si hubo una escritura mientras se calculaba el resultado puede estar obsoleto,
+                # y un resultado más pesado que toda la caché no se guarda
+                fits = self.result_cache.max_weight is None or self.result_cache.weigher(result) <= self.result_cache.max_weight
+                if fits and self._result_generation(pyme_id) == generation:
+                    self.result_cache.set(key, result)
+        return result
+    
+    def _result_generation(self, pyme_id: str) -> Tuple[int, int]:
+        return self._result_epoch, self._result_generations.get(pyme_id, 0)
+    
+    def invalidate_results(self, pyme_id: Optional[str] = None) -> int:
+        """Descartar los resultados cacheados de una PyME (o de todas) tras una escritura"""
+        with self._result_lock:
+            if pyme_id is None:
+                self._result_epoch += 1
+            else:
+                self._result_generations[pyme_id] = self._result_generations.get(pyme_id, 0) + 1
+        if pyme_id is None:
+            removed = len(self.result_cache)
+            self.result_cache.clear()
+            return removed
+        return self.result_cache.invalidate_where(lambda key: key[0] == pyme_id)
+    
+    async def _run(self, method: Callable[..., Any], *args, **kwargs) -> Any:
+        """Ejecutar un método bloqueante en el executor dedicado de Snowflake"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(method, *args, **kwargs))
+    
+    # ------------------------------------------------------------------
+    # Versiones awaitables para los handlers async
+    # ------------------------------------------------------------------
+    async def ensure_connected_async(self) -> bool:
+        return await self._run(self.ensure_connected)
+    
+    async def insert_pyme_data_async(self, pyme_data: Dict[str, Any]) -> bool:
+        return await self._run(self.insert_pyme_data, pyme_data)
+    
+    async def get_financial_analysis_async(self, pyme_id: str, period_days: int = 365) -> Dict[str, Any]:
+        return await self._run(self.get_financial_analysis, pyme_id, period_days)
+    
+    async def run_simulation_async(self, pyme_id: str, scenario: Dict[str, Any]) -> Dict[str, Any]:
+        return await self._run(self.run_simulation, pyme_id, scenario)
+    
+    async def run_simulations_async(self, pyme_id: str, scenarios: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return await self._run(self.run_simulations, pyme_id, scenarios)
+    
+    async def get_chat_context_async(self, pyme_id: str) -> Dict[str, Any]:
+        return await self._run(self.get_chat_context, pyme_id)
+    
+    async def log_chat_interaction_async(self, pyme_id: str, user_message: str, ai_response: str, context: Dict[str, Any], confidence: float = 0.9) -> bool:
+        # Solo encola: no necesita el executor
+        return self.log_chat_interaction(pyme_id, user_message, ai_response, context, confidence)
+    
+    async def insert_transaction_async(self, transaction_data: Dict[str, Any]) -> Optional[str]:
+        return await self._run(self.insert_transaction, transaction_data)
+    
+    async def insert_transactions_async(self, pyme_id: str, frame: pd.DataFrame) -> Optional[List[str]]:
+        return await self._run(self.insert_transactions, pyme_id, frame)
+    
+    async def apply_transaction_mutations_async(self, pyme_id: str, upserts: pd.DataFrame, deletes: List[str]) -> Optional[List[str]]:
+        return await self._run(self.apply_transaction_mutations, pyme_id, upserts, deletes)
+    
+    async def delete_transaction_async(self, pyme_id: str, transaction_id: str) -> bool:
+        return await self._run(self.delete_transaction, pyme_id, transaction_id)
+    
+    async def get_transactions_async(self, pyme_id: str = "empresa_001") -> List[Dict[str, Any]]:
+        return await self._run(self.get_transactions, pyme_id)
+    
+    async def list_transactions_page_async(self, pyme_id: str, limit: int, **filters) -> Optional[Tuple[List[Dict[str, Any]], bool]]:
+        return await self._run(self.list_transactions_page, pyme_id, limit, **filters)
+    
+    async def load_transaction_store_async(self, pyme_id: str) -> Optional["WarehouseLoad"]:
+        return await self._run(self.load_transaction_store, pyme_id)
+    
+    async def fetch_transaction_changes_async(self, pyme_id: str, watermarks: Dict[str, datetime]) -> Optional["WarehouseLoad"]:
+        return await self._run(self.fetch_transaction_changes, pyme_id, watermarks)
+    
+    async def fetch_transaction_ids_async(self, pyme_id: str, tables: List[str]) -> Optional[Set[str]]:
+        return await self._run(self.fetch_transaction_ids, pyme_id, tables)
+    
+    async def refresh_ledger_async(self) -> int:
+        return await self._run(self.refresh_ledger)
+    
     def create_tables(self) -> bool:
         """Crear tablas necesarias en Snowflake"""
-        if not self.connection:
+        if not self.is_connected:
             return False
             
         try:
-            cursor = self.connection.cursor()
+            with self.pool.connection() as connection:
+                cursor = connection.cursor()
             
-            # Tabla de PyMEs
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS pymes (
-                    pyme_id VARCHAR(50) PRIMARY KEY,
-                    name VARCHAR(255) NOT NULL,
-                    industry VARCHAR(100),
-                    size_category VARCHAR(50),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP(),
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP()
-                )
-            """)
+                # Tabla de PyMEs
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS pymes (
+                        pyme_id VARCHAR(50) PRIMARY KEY,
+                        name VARCHAR(255) NOT NULL,
+                        industry VARCHAR(100),
+                        size_category VARCHAR(50),
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP(),
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP()
+                    )
+                """)
             
-            # Tabla de transacciones financieras
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS transactions (
-                    transaction_id VARCHAR(50) PRIMARY KEY,
-                    pyme_id VARCHAR(50) REFERENCES pymes(pyme_id),
-                    transaction_type VARCHAR(20) NOT NULL, -- 'income' o 'expense'
-                    category VARCHAR(100) NOT NULL,
-                    amount DECIMAL(15,2) NOT NULL,
-                    description TEXT,
-                    transaction_date DATE NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP(),
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP()
-                )
-            """)
+                # Tabla de transacciones financieras
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS transactions (
+                        transaction_id VARCHAR(50) PRIMARY KEY,
+                        pyme_id VARCHAR(50) REFERENCES pymes(pyme_id),
+                        transaction_type VARCHAR(20) NOT NULL, -- 'income' o 'expense'
+                        category VARCHAR(100) NOT NULL,
+                        amount DECIMAL(15,2) NOT NULL,
+                        description TEXT,
+                        transaction_date DATE NOT NULL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP(),
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP()
+                    )
+                """)
             
-            # Tabla de métricas calculadas
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS financial_metrics (
-                    metric_id VARCHAR(50) PRIMARY KEY,
-                    pyme_id VARCHAR(50) REFERENCES pymes(pyme_id),
-                    metric_name VARCHAR(100) NOT NULL,
-                    metric_value DECIMAL(15,2) NOT NULL,
-                    calculation_date DATE NOT NULL,
-                    period_type VARCHAR(20) NOT NULL, -- 'daily', 'monthly', 'yearly'
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP()
-                )
-            """)
+                # Tabla de métricas calculadas
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS financial_metrics (
+                        metric_id VARCHAR(50) PRIMARY KEY,
+                        pyme_id VARCHAR(50) REFERENCES pymes(pyme_id),
+                        metric_name VARCHAR(100) NOT NULL,
+                        metric_value DECIMAL(15,2) NOT NULL,
+                        calculation_date DATE NOT NULL,
+                        period_type VARCHAR(20) NOT NULL, -- 'daily', 'monthly', 'yearly'
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP()
+                    )
+                """)
             
-            # Tabla de simulaciones
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS simulations (
-                    simulation_id VARCHAR(50) PRIMARY KEY,
-                    pyme_id VARCHAR(50) REFERENCES pymes(pyme_id),
-                    scenario_name VARCHAR(255) NOT NULL,
-                    scenario_data VARIANT NOT NULL,
-                    results VARIANT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP(),
-                    created_by VARCHAR(100)
-                )
-            """)
+                # Tabla de simulaciones
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS simulations (
+                        simulation_id VARCHAR(50) PRIMARY KEY,
+                        pyme_id VARCHAR(50) REFERENCES pymes(pyme_id),
+                        scenario_name VARCHAR(255) NOT NULL,
+                        scenario_data VARIANT NOT NULL,
+                        results VARIANT NOT NULL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP(),
+                        created_by VARCHAR(100)
+                    )
+                """)
             
-            # Tabla de conversaciones con IA
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS chat_conversations (
-                    conversation_id VARCHAR(50) PRIMARY KEY,
-                    pyme_id VARCHAR(50) REFERENCES pymes(pyme_id),
-                    user_message TEXT NOT NULL,
-                    ai_response TEXT NOT NULL,
-                    context_data VARIANT,
-                    confidence_score DECIMAL(3,2),
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP()
-                )
-            """)
+                # Tabla de conversaciones con IA
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS chat_conversations (
+                        conversation_id VARCHAR(50) PRIMARY KEY,
+                        pyme_id VARCHAR(50) REFERENCES pymes(pyme_id),
+                        user_message TEXT NOT NULL,
+                        ai_response TEXT NOT NULL,
+                        context_data VARIANT,
+                        confidence_score DECIMAL(3,2),
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP()
+                    )
+                """)
             
-            cursor.close()
-            logger.info("✅ Tablas creadas exitosamente en Snowflake")
-            return True
+                cursor.close()
+                logger.info("✅ Tablas creadas exitosamente en Snowflake")
             
         except Exception as e:
             logger.error(f"❌ Error creando tablas: {e}")
             return False
+        
+        self.ledger_ready = self.create_ledger_pipeline()
+        if self.ledger_ready:
+            self.refresh_ledger(force=True)  # Carga inicial (el stream incluye las filas existentes)
+        return True
     
-    def insert_pyme_data(self, pyme_data: Dict[str, Any]) -> bool:
-        """Insertar datos de una PyME"""
-        if not self.connection:
+    def create_ledger_pipeline(self) -> bool:
+        """Crear la tabla tipada de ROW_DATA_EMPRESA, su stream y (opcional) el TASK de refresco"""
+        try:
+            with self.pool.connection() as connection:
+                cursor = connection.cursor()
+                
+                # Tipos ya resueltos e ids estables; el clustering por (empresa, fecha) permite
+                # podar micro-particiones en las lecturas por empresa y rango de fechas
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS ledger_transactions (
+                        transaction_id VARCHAR(32) PRIMARY KEY, -- MD5 del METADATA$ROW_ID de la fila cruda
+                        empresa_id VARCHAR(50) NOT NULL,
+                        transaction_date DATE,
+                        amount DECIMAL(15,2),
+                        description TEXT,
+                        category VARCHAR(100),
+                        transaction_type VARCHAR(20),
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP(),
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP()
+                    )
+                    CLUSTER BY (empresa_id, transaction_date)
+                """)
+                # Lápidas de las bajas hechas desde el API sobre filas del ledger
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS ledger_deletions (
+                        transaction_id VARCHAR(32) PRIMARY KEY,
+                        empresa_id VARCHAR(50) NOT NULL,
+                        deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP()
+                    )
+                """)
+                cursor.execute("""
+                    CREATE STREAM IF NOT EXISTS row_data_empresa_stream
+                    ON TABLE ROW_DATA_EMPRESA
+                    SHOW_INITIAL_ROWS = TRUE
+                """)
+                
+                if self.ledger_task_schedule:
+                    cursor.execute(f"""
+                        CREATE OR REPLACE TASK refresh_ledger_transactions
+                        WAREHOUSE = {self.warehouse}
+                        SCHEDULE = '{self.ledger_task_schedule}'
+                        WHEN SYSTEM$STREAM_HAS_DATA('ROW_DATA_EMPRESA_STREAM')
+                        AS {_LEDGER_MERGE_SQL}
+                    """)
+                    cursor.execute("ALTER TASK refresh_ledger_transactions RESUME")
+                
+                cursor.close()
+            logger.info("✅ Tabla materializada ledger_transactions lista")
+            return True
+        
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo crear la tabla materializada (se leerá ROW_DATA_EMPRESA directamente): {e}")
             return False
-            
+    
+    def refresh_ledger(self, force: bool = False) -> int:
+        """Aplicar los cambios pendientes del stream a ledger_transactions; devuelve filas afectadas
+
+        Si un TASK programado se encarga del refresco, solo se ejecuta con `force`.
+        """
+        if not self.is_connected or not self.ledger_ready or (self.ledger_task_schedule and not force):
+            return 0
+        
         try:
-            cursor = self.connection.cursor()
-            
-            # Insertar PyME (usar MERGE en lugar de ON CONFLICT)
-            cursor.execute("""
-                MERGE INTO pymes AS target
-                USING (SELECT %s AS pyme_id, %s AS name, %s AS industry, %s AS size_category) AS source
-                ON target.pyme_id = source.pyme_id
-                WHEN MATCHED THEN
-                    UPDATE SET
-                        name = source.name,
-                        industry = source.industry,
-                        size_category = source.size_category,
-                        updated_at = CURRENT_TIMESTAMP()
-                WHEN NOT MATCHED THEN
-                    INSERT (pyme_id, name, industry, size_category)
-                    VALUES (source.pyme_id, source.name, source.industry, source.size_category)
-            """, (
-                pyme_data['pyme_id'],
-                pyme_data['name'],
-                pyme_data.get('industry', 'Unknown'),
-                pyme_data.get('size_category', 'SME')
-            ))
+            with self.pool.connection() as connection:
+                cursor = connection.cursor()
+                cursor.execute("SELECT SYSTEM$STREAM_HAS_DATA('ROW_DATA_EMPRESA_STREAM')")
+                has_data = cursor.fetchone()[0]
+                if not has_data or str(has_data).lower() == "false":
+                    cursor.close()
+                    return 0
+                # El DML consume el stream (avanza su offset) de forma atómica
+                cursor.execute(_LEDGER_MERGE_SQL)
+                affected = sum(value or 0 for value in (cursor.fetchone() or ()))
+                cursor.close()
             
-            # Insertar transacciones (usar MERGE en lugar de ON CONFLICT)
-            if 'transactions' in pyme_data:
-                for transaction in pyme_data['transactions']:
+            if affected:
+                # Las lecturas cacheadas de cualquier empresa pueden haber cambiado
+                self.invalidate_results()
+                logger.info(f"🔄 {affected} filas de ROW_DATA_EMPRESA materializadas")
+            return affected
+        
+        except Exception as e:
+            logger.error(f"❌ Error refrescando ledger_transactions: {e}")
+            return 0
+    
+    def insert_pyme_data(self, pyme_data: Dict[str, Any]) -> bool:
+        """Insertar datos de una PyME (transacciones en un solo MERGE desde una tabla de staging)"""
+        if not self.is_connected:
+            return False
+        
+        transactions = pd.DataFrame(pyme_data.get('transactions') or [])
+        stage = None
+        if not transactions.empty:
+            stage = pd.DataFrame({
+                "TRANSACTION_ID": transactions['id'].astype(str),
+                "PYME_ID": pyme_data['pyme_id'],
+                "TRANSACTION_TYPE": transactions['type'].astype(str),
+                "CATEGORY": transactions['category'].astype(str),
+                "AMOUNT": pd.to_numeric(transactions['amount']).round(2),
+                "DESCRIPTION": transactions.get('description', pd.Series('', index=transactions.index)).fillna('').astype(str),
+                "TRANSACTION_DATE": pd.to_datetime(transactions['date']).dt.date
+            }).drop_duplicates("TRANSACTION_ID", keep="last")  # MERGE exige una fila por llave
+        
+        def load(connection) -> None:
+            cursor = connection.cursor()
+            try:
+                if stage is not None:
+                    # DDL fuera de la transacción (en Snowflake confirma implícitamente)
+                    cursor.execute("""
+                        CREATE OR REPLACE TEMPORARY TABLE transactions_stage (
+                            transaction_id VARCHAR(50),
+                            pyme_id VARCHAR(50),
+                            transaction_type VARCHAR(20),
+                            category VARCHAR(100),
+                            amount DECIMAL(15,2),
+                            description TEXT,
+                            transaction_date DATE
+                        )
+                    """)
+                    # write_pandas crea un stage temporal (DDL): cargar antes de BEGIN para que
+                    # no confirme la transacción a medias; la tabla temporal vive toda la sesión
+                    write_pandas(connection, stage, "TRANSACTIONS_STAGE")
+                cursor.execute("BEGIN")
+                
+                # Insertar PyME (usar MERGE en lugar de ON CONFLICT)
+                cursor.execute("""
+                    MERGE INTO pymes AS target
+                    USING (SELECT %s AS pyme_id, %s AS name, %s AS industry, %s AS size_category) AS source
+                    ON target.pyme_id = source.pyme_id
+                    WHEN MATCHED THEN
+                        UPDATE SET
+                            name = source.name,
+                            industry = source.industry,
+                            size_category = source.size_category,
+                            updated_at = CURRENT_TIMESTAMP()
+                    WHEN NOT MATCHED THEN
+                        INSERT (pyme_id, name, industry, size_category)
+                        VALUES (source.pyme_id, source.name, source.industry, source.size_category)
+                """, (
+                    pyme_data['pyme_id'],
+                    pyme_data['name'],
+                    pyme_data.get('industry', 'Unknown'),
+                    pyme_data.get('size_category', 'SME')
+                ))
+                
+                if stage is not None:
+                    # Todas las transacciones en un solo COPY y un solo MERGE basado en conjuntos
                     cursor.execute("""
                         MERGE INTO transactions AS target
-                        USING (SELECT %s AS transaction_id, %s AS pyme_id, %s AS transaction_type, 
-                                      %s AS category, %s AS amount, %s AS description, %s AS transaction_date) AS source
+                        USING transactions_stage AS source
                         ON target.transaction_id = source.transaction_id
                         WHEN MATCHED THEN
                             UPDATE SET
@@ -183,178 +580,184 @@ class SnowflakeService:
                             INSERT (transaction_id, pyme_id, transaction_type, category, amount, description, transaction_date)
                             VALUES (source.transaction_id, source.pyme_id, source.transaction_type, 
                                    source.category, source.amount, source.description, source.transaction_date)
-                    """, (
-                        transaction['id'],
-                        pyme_data['pyme_id'],
-                        transaction['type'],
-                        transaction['category'],
-                        transaction['amount'],
-                        transaction.get('description', ''),
-                        transaction['date']
-                    ))
-            
-            cursor.close()
-            logger.info(f"✅ Datos de PyME {pyme_data['pyme_id']} insertados")
+                    """)
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            finally:
+                cursor.close()
+        
+        try:
+            self._with_retry(load, f"carga de PyME {pyme_data['pyme_id']}")
+            self.invalidate_results(pyme_data['pyme_id'])
+            logger.info(f"✅ Datos de PyME {pyme_data['pyme_id']} insertados ({0 if stage is None else len(stage)} transacciones)")
             return True
             
         except Exception as e:
             logger.error(f"❌ Error insertando datos de PyME: {e}")
             return False
     
+    def _with_retry(self, operation: Callable[[Any], Any], description: str) -> Any:
+        """Ejecutar una operación idempotente con una conexión del pool, reintentando con backoff"""
+        attempts = int(os.getenv('SNOWFLAKE_WRITE_RETRIES', '3'))
+        delay = 1.0
+        for attempt in range(1, attempts + 1):
+            try:
+                with self.pool.connection() as connection:
+                    return operation(connection)
+            except Exception as e:
+                if attempt == attempts:
+                    raise
+                logger.warning(f"⚠️ Falló {description} (intento {attempt}/{attempts}), reintentando: {e}")
+                time.sleep(delay)
+                delay *= 2
+    
+    def _transactions_source(self) -> str:
+        """Fuente de todas las lecturas de transacciones en el warehouse (columnas con `pyme_id`)
+
+        `transactions` más, si existe, la tabla materializada de ROW_DATA_EMPRESA: la misma unión
+        que carga el almacén en memoria, así el análisis, la simulación y el listado no divergen.
+        """
+        if not self.ledger_ready:
+            return "transactions"
+        return f"""(
+            SELECT transaction_id, empresa_id as pyme_id, transaction_date, amount, description, category, transaction_type
+            FROM {_LEDGER_VISIBLE_SQL}
+            UNION ALL
+            SELECT transaction_id, pyme_id, transaction_date, amount, description, category, transaction_type
+            FROM transactions
+        )"""
+    
     def get_financial_analysis(self, pyme_id: str, period_days: int = 365) -> Dict[str, Any]:
-        """Obtener análisis financiero avanzado desde Snowflake"""
-        if not self.connection:
+        """Obtener análisis financiero avanzado desde Snowflake (con caché de resultados)"""
+        return self._cached(pyme_id, "financial_analysis", (period_days,), lambda: self._query_financial_analysis(pyme_id, period_days))
+    
+    def _query_financial_analysis(self, pyme_id: str, period_days: int) -> Dict[str, Any]:
+        """Consultar el análisis financiero en Snowflake (sin caché) con un solo recorrido de la tabla"""
+        if not self.is_connected:
             return {}
             
         try:
-            cursor = self.connection.cursor()
-            
-            # Análisis de ingresos por mes
-            cursor.execute("""
-                SELECT 
-                    DATE_TRUNC('MONTH', transaction_date) as month,
-                    SUM(CASE WHEN transaction_type = 'income' THEN amount ELSE 0 END) as total_income,
-                    SUM(CASE WHEN transaction_type = 'expense' THEN amount ELSE 0 END) as total_expenses,
-                    SUM(CASE WHEN transaction_type = 'income' THEN amount ELSE -amount END) as net_income
-                FROM transactions 
-                WHERE pyme_id = %s 
-                AND transaction_date >= DATEADD(day, -%s, CURRENT_DATE())
-                GROUP BY DATE_TRUNC('MONTH', transaction_date)
-                ORDER BY month DESC
-            """, (pyme_id, period_days))
-            
-            monthly_data = cursor.fetchall()
-            
-            # Análisis por categorías
-            cursor.execute("""
-                SELECT 
-                    category,
-                    transaction_type,
-                    SUM(amount) as total_amount,
-                    COUNT(*) as transaction_count,
-                    AVG(amount) as avg_amount
-                FROM transactions 
-                WHERE pyme_id = %s 
-                AND transaction_date >= DATEADD(day, -%s, CURRENT_DATE())
-                GROUP BY category, transaction_type
-                ORDER BY total_amount DESC
-            """, (pyme_id, period_days))
-            
-            category_data = cursor.fetchall()
-            
-            # Métricas de tendencias
-            cursor.execute("""
-                SELECT 
-                    AVG(CASE WHEN transaction_type = 'income' THEN amount ELSE 0 END) as avg_income,
-                    AVG(CASE WHEN transaction_type = 'expense' THEN amount ELSE 0 END) as avg_expense,
-                    STDDEV(CASE WHEN transaction_type = 'income' THEN amount ELSE 0 END) as income_volatility,
-                    STDDEV(CASE WHEN transaction_type = 'expense' THEN amount ELSE 0 END) as expense_volatility
-                FROM transactions 
-                WHERE pyme_id = %s 
-                AND transaction_date >= DATEADD(day, -%s, CURRENT_DATE())
-            """, (pyme_id, period_days))
-            
-            trend_data = cursor.fetchone()
-            
-            cursor.close()
+            with self.pool.connection() as connection:
+                cursor = connection.cursor()
+                
+                # Un solo GROUP BY (mes, categoría, tipo) con conteo, suma y suma de cuadrados:
+                # el análisis mensual, por categoría y de tendencias se arma a partir de él
+                cursor.execute(f"""
+                    SELECT 
+                        DATE_TRUNC('MONTH', transaction_date) as month,
+                        category,
+                        transaction_type,
+                        COUNT(*) as transaction_count,
+                        SUM(amount) as total_amount,
+                        SUM(amount * amount) as total_squared
+                    FROM {self._transactions_source()}
+                    WHERE pyme_id = %s 
+                    AND transaction_date >= DATEADD(day, -%s, CURRENT_DATE())
+                    GROUP BY DATE_TRUNC('MONTH', transaction_date), category, transaction_type
+                """, (pyme_id, period_days))
+                
+                grouped_rows = cursor.fetchall()
+                cursor.close()
             
-            return {
-                'monthly_analysis': [
-                    {
-                        'month': row[0].strftime('%Y-%m'),
-                        'total_income': float(row[1]),
-                        'total_expenses': float(row[2]),
-                        'net_income': float(row[3])
-                    } for row in monthly_data
-                ],
-                'category_analysis': [
-                    {
-                        'category': row[0],
-                        'type': row[1],
-                        'total_amount': float(row[2]),
-                        'transaction_count': row[3],
-                        'avg_amount': float(row[4])
-                    } for row in category_data
-                ],
-                'trend_metrics': {
-                    'avg_income': float(trend_data[0]) if trend_data[0] else 0,
-                    'avg_expense': float(trend_data[1]) if trend_data[1] else 0,
-                    'income_volatility': float(trend_data[2]) if trend_data[2] else 0,
-                    'expense_volatility': float(trend_data[3]) if trend_data[3] else 0
-                }
-            }
+            return _assemble_financial_analysis(grouped_rows)
             
         except Exception as e:
             logger.error(f"❌ Error en análisis financiero: {e}")
             return {}
     
-    def run_simulation(self, pyme_id: str, scenario: Dict[str, Any]) -> Dict[str, Any]:
-        """Ejecutar simulación financiera usando Snowflake"""
-        if not self.connection:
+    def get_simulation_baseline(self, pyme_id: str, period_days: int = 365) -> Dict[str, Any]:
+        """Línea base histórica de simulación (mensual y por categoría) con caché de resultados"""
+        return self._cached(pyme_id, "simulation_baseline", (period_days,), lambda: self._query_simulation_baseline(pyme_id, period_days))
+    
+    def _query_simulation_baseline(self, pyme_id: str, period_days: int) -> Dict[str, Any]:
+        """Agregar el historial en el warehouse; solo viajan filas (mes, categoría, tipo)"""
+        if not self.is_connected:
             return {}
-            
+        
         try:
-            cursor = self.connection.cursor()
-            
-            # Obtener datos históricos
-            cursor.execute("""
-                SELECT 
-                    transaction_type,
-                    category,
-                    amount,
-                    transaction_date
-                FROM transactions 
-                WHERE pyme_id = %s 
-                AND transaction_date >= DATEADD(day, -365, CURRENT_DATE())
-                ORDER BY transaction_date
-            """, (pyme_id,))
-            
-            historical_data = cursor.fetchall()
-            
-            # Procesar simulación (lógica simplificada)
-            simulation_results = self._process_simulation(historical_data, scenario)
-            
-            # Guardar resultados
-            simulation_id = f"sim_{pyme_id}_{int(datetime.now().timestamp())}"
-            cursor.execute("""
-                INSERT INTO simulations (simulation_id, pyme_id, scenario_name, scenario_data, results)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (
-                simulation_id,
-                pyme_id,
-                scenario.get('name', 'Simulación'),
-                json.dumps(scenario),
-                json.dumps(simulation_results)
-            ))
-            
-            cursor.close()
-            
-            return {
-                'simulation_id': simulation_id,
-                'scenario': scenario,
-                'results': simulation_results,
-                'created_at': datetime.now().isoformat()
-            }
+            with self.pool.connection() as connection:
+                cursor = connection.cursor()
+                cursor.execute(f"""
+                    SELECT 
+                        DATE_TRUNC('MONTH', transaction_date) as month,
+                        category,
+                        transaction_type,
+                        COUNT(*) as transaction_count,
+                        SUM(amount) as total_amount
+                    FROM {self._transactions_source()}
+                    WHERE pyme_id = %s 
+                    AND transaction_date >= DATEADD(day, -%s, CURRENT_DATE())
+                    GROUP BY DATE_TRUNC('MONTH', transaction_date), category, transaction_type
+                """, (pyme_id, period_days))
+                grouped_rows = cursor.fetchall()
+                cursor.close()
             
+            return _assemble_simulation_baseline(grouped_rows, period_days)
+        
         except Exception as e:
-            logger.error(f"❌ Error en simulación: {e}")
+            logger.error(f"❌ Error obteniendo línea base de simulación: {e}")
             return {}
     
-    def _process_simulation(self, historical_data: List, scenario: Dict[str, Any]) -> Dict[str, Any]:
-        """Procesar lógica de simulación"""
-        # Implementar lógica de simulación basada en datos históricos
-        # y parámetros del escenario
+    def run_simulation(self, pyme_id: str, scenario: Dict[str, Any]) -> Dict[str, Any]:
+        """Ejecutar simulación financiera usando Snowflake"""
+        results = self.run_simulations(pyme_id, [scenario])
+        return results[0] if results else {}
+    
+    def run_simulations(self, pyme_id: str, scenarios: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Proyectar varios escenarios sobre una sola línea base; se guardan en lote en segundo plano"""
+        if not self.is_connected or not scenarios:
+            return []
+        
+        baseline = self.get_simulation_baseline(pyme_id)
+        if not baseline:
+            return []
         
-        total_income = sum(row[2] for row in historical_data if row[0] == 'income')
-        total_expenses = sum(row[2] for row in historical_data if row[0] == 'expense')
+        created_at = datetime.now()
+        results = []
+        for index, scenario in enumerate(scenarios):
+            results.append({
+                'simulation_id': f"sim_{pyme_id}_{int(created_at.timestamp())}_{index}",
+                'scenario': scenario,
+                'results': self._process_simulation(baseline, scenario),
+                'created_at': created_at.isoformat()
+            })
+        
+        # El guardado va a la cola write-behind: no suma latencia a la respuesta
+        for result in results:
+            self.audit_queue.enqueue("simulation", {
+                'simulation_id': result['simulation_id'],
+                'pyme_id': pyme_id,
+                'scenario_name': result['scenario'].get('name', 'Simulación'),
+                'scenario_data': json.dumps(result['scenario']),
+                'results': json.dumps(result['results']),
+                'created_at': result['created_at']
+            })
+        return results
+    
+    def _process_simulation(self, baseline: Dict[str, Any], scenario: Dict[str, Any]) -> Dict[str, Any]:
+        """Proyectar un escenario sobre la línea base agregada
+
+        `income_change`/`expense_change` son multiplicadores globales; `category_changes`
+        ({categoría: multiplicador}) los reemplaza para categorías puntuales.
+        """
+        total_income = baseline['total_income']
+        total_expenses = baseline['total_expenses']
         
         # Aplicar cambios del escenario
         income_multiplier = scenario.get('income_change', 1.0)
         expense_multiplier = scenario.get('expense_change', 1.0)
+        category_changes = scenario.get('category_changes') or {}
         
-        projected_income = total_income * income_multiplier
-        projected_expenses = total_expenses * expense_multiplier
+        projected_income = projected_expenses = 0.0
+        for row in baseline['categories']:
+            if row['transaction_type'] == 'income':
+                projected_income += row['total_amount'] * category_changes.get(row['category'], income_multiplier)
+            elif row['transaction_type'] == 'expense':
+                projected_expenses += row['total_amount'] * category_changes.get(row['category'], expense_multiplier)
         projected_net = projected_income - projected_expenses
+        months = max(len(baseline['monthly']), 1)
         
         return {
             'current_income': total_income,
@@ -363,13 +766,19 @@ class SnowflakeService:
             'projected_income': projected_income,
             'projected_expenses': projected_expenses,
             'projected_net': projected_net,
+            'projected_monthly_net': projected_net / months,
+            'months_observed': len(baseline['monthly']),
             'income_change_percent': (income_multiplier - 1) * 100,
             'expense_change_percent': (expense_multiplier - 1) * 100,
             'net_change_percent': ((projected_net / (total_income - total_expenses)) - 1) * 100 if (total_income - total_expenses) != 0 else 0
         }
     
     def get_chat_context(self, pyme_id: str) -> Dict[str, Any]:
-        """Obtener contexto financiero para el chat con IA"""
+        """Obtener contexto financiero para el chat con IA (con caché de resultados)"""
+        return self._cached(pyme_id, "chat_context", (), lambda: self._build_chat_context(pyme_id))
+    
+    def _build_chat_context(self, pyme_id: str) -> Dict[str, Any]:
+        """Construir el contexto del chat a partir del análisis de los últimos 90 días"""
         analysis = self.get_financial_analysis(pyme_id, 90)  # Últimos 90 días
         
         if not analysis:
@@ -397,102 +806,319 @@ class SnowflakeService:
         }
     
     def log_chat_interaction(self, pyme_id: str, user_message: str, ai_response: str, context: Dict[str, Any], confidence: float = 0.9) -> bool:
-        """Registrar interacción del chat en Snowflake"""
-        if not self.connection:
+        """Registrar interacción del chat en Snowflake (encolada; se escribe en lote en segundo plano)"""
+        if not self.is_connected:
             return False
-            
-        try:
-            cursor = self.connection.cursor()
-            
-            conversation_id = f"chat_{pyme_id}_{int(datetime.now().timestamp())}"
-            cursor.execute("""
-                INSERT INTO chat_conversations 
-                (conversation_id, pyme_id, user_message, ai_response, context_data, confidence_score)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """, (
-                conversation_id,
-                pyme_id,
-                user_message,
-                ai_response,
-                json.dumps(context),
-                confidence
-            ))
-            
+        
+        import uuid
+        return self.audit_queue.enqueue("chat", {
+            'conversation_id': f"chat_{pyme_id}_{int(datetime.now().timestamp())}_{uuid.uuid4().hex[:6]}",
+            'pyme_id': pyme_id,
+            'user_message': user_message,
+            'ai_response': ai_response,
+            'context_data': json.dumps(context, default=str),
+            'confidence_score': confidence,
+            'created_at': datetime.now().isoformat()
+        })
+    
+    def write_audit_records(self, kind: str, records: List[Dict[str, Any]]) -> None:
+        """Escribir un lote de la cola de auditoría con un solo INSERT ... SELECT (lanza si falla)"""
+        if not self.is_connected:
+            raise RuntimeError("Snowflake no está conectado")
+        table, columns = _AUDIT_TABLES[kind]
+        # PARSE_JSON no se admite en VALUES: una fila SELECT por registro unidas con UNION ALL
+        select = "SELECT " + ", ".join("PARSE_JSON(%s)" if is_json else "%s" for _, is_json in columns)
+        params = [record.get(column) for record in records for column, _ in columns]
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                f"INSERT INTO {table} ({', '.join(column for column, _ in columns)}) "
+                + " UNION ALL ".join([select] * len(records)),
+                params
+            )
             cursor.close()
-            return True
-            
-        except Exception as e:
-            logger.error(f"❌ Error registrando chat: {e}")
-            return False
     
-    def insert_transaction(self, transaction_data: Dict[str, Any]) -> bool:
-        """Insertar una nueva transacción en Snowflake"""
-        if not self.connection:
-            return False
+    def insert_transaction(self, transaction_data: Dict[str, Any]) -> Optional[str]:
+        """Insertar una nueva transacción en Snowflake y devolver su transaction_id"""
+        if not self.is_connected:
+            return None
         
         try:
             import uuid
-            cursor = self.connection.cursor()
+            with self.pool.connection() as connection:
+                cursor = connection.cursor()
             
-            # Generar un transaction_id único
-            transaction_id = f"txn_{uuid.uuid4().hex[:12]}"
+                # Generar un transaction_id único
+                transaction_id = f"txn_{uuid.uuid4().hex[:12]}"
             
-            cursor.execute("""
-                INSERT INTO transactions (
+                cursor.execute("""
+                    INSERT INTO transactions (
+                        transaction_id,
+                        pyme_id,
+                        transaction_date,
+                        amount,
+                        description,
+                        category,
+                        transaction_type
+                    ) VALUES (%s, %s, %s, %s, %s, %s, %s)
+                """, (
                     transaction_id,
-                    pyme_id,
-                    transaction_date,
-                    amount,
-                    description,
-                    category,
-                    transaction_type
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s)
-            """, (
-                transaction_id,
-                transaction_data.get('pyme_id', 'E001'),
-                transaction_data.get('date'),
-                transaction_data.get('amount'),
-                transaction_data.get('description'),
-                transaction_data.get('category'),
-                transaction_data.get('transaction_type')
-            ))
+                    transaction_data.get('pyme_id', 'E001'),
+                    transaction_data.get('date'),
+                    transaction_data.get('amount'),
+                    transaction_data.get('description'),
+                    transaction_data.get('category'),
+                    transaction_data.get('transaction_type')
+                ))
             
-            cursor.close()
-            logger.info(f"✅ Transacción {transaction_id} insertada en Snowflake")
-            return True
+                cursor.close()
+                self.invalidate_results(transaction_data.get('pyme_id', 'E001'))
+                logger.info(f"✅ Transacción {transaction_id} insertada en Snowflake")
+                return transaction_id
             
         except Exception as e:
             logger.error(f"❌ Error insertando transacción: {e}")
+            return None
+    
+    def insert_transactions(self, pyme_id: str, frame: pd.DataFrame) -> Optional[List[str]]:
+        """Cargar un lote de transacciones con write_pandas (un solo COPY); devuelve los transaction_id"""
+        if not self.is_connected or frame.empty:
+            return None
+
+        try:
+            import uuid
+            transaction_ids = [f"txn_{uuid.uuid4().hex[:12]}" for _ in range(len(frame))]
+            upload = pd.DataFrame({
+                "TRANSACTION_ID": transaction_ids,
+                "PYME_ID": pyme_id,
+                "TRANSACTION_TYPE": frame["transaction_type"].astype(str).to_numpy(),
+                "CATEGORY": frame["category"].astype(str).to_numpy(),
+                "AMOUNT": frame["amount"].round(2).to_numpy(),
+                "DESCRIPTION": frame["description"].astype(str).to_numpy(),
+                "TRANSACTION_DATE": pd.to_datetime(frame["date"]).dt.date.to_numpy()
+            })
+            with self.pool.connection() as connection:
+                success, _, rows, _ = write_pandas(connection, upload, "TRANSACTIONS")
+            if not success:
+                logger.error(f"❌ write_pandas no completó la carga de {len(upload)} transacciones")
+                return None
+            self.invalidate_results(pyme_id)
+            logger.info(f"✅ {rows} transacciones cargadas en Snowflake para {pyme_id}")
+            return transaction_ids
+
+        except Exception as e:
+            logger.error(f"❌ Error cargando lote de transacciones: {e}")
+            return None
+
+    def apply_transaction_mutations(self, pyme_id: str, upserts: pd.DataFrame, deletes: List[str]) -> Optional[List[str]]:
+        """Aplicar altas/cambios y bajas en un solo MERGE desde una tabla de staging
+
+        `upserts` trae el esquema de TransactionStore.to_frame() más `transaction_id`
+        (None para filas nuevas, que reciben un id generado). Devuelve los transaction_id
+        de las altas/cambios en el mismo orden, o None si la operación falló.
+        Las filas de ledger_transactions no se tocan: un cambio inserta en `transactions` una
+        fila con su mismo id que la reemplaza en las lecturas, y una baja deja una lápida.
+        """
+        if not self.is_connected or (upserts.empty and not deletes):
+            return None
+        
+        import uuid
+        transaction_ids = [
+            str(transaction_id) if transaction_id is not None and not pd.isna(transaction_id) else f"txn_{uuid.uuid4().hex[:12]}"
+            for transaction_id in (upserts["transaction_id"] if not upserts.empty else [])
+        ]
+        parts = []
+        if not upserts.empty:
+            parts.append(pd.DataFrame({
+                "TRANSACTION_ID": transaction_ids,
+                "PYME_ID": pyme_id,
+                "OPERATION": "U",
+                "TRANSACTION_TYPE": upserts["transaction_type"].astype(str).to_numpy(),
+                "CATEGORY": upserts["category"].astype(str).to_numpy(),
+                "AMOUNT": pd.array(upserts["amount"].round(2).to_numpy(), dtype="Float64"),
+                "DESCRIPTION": upserts["description"].astype(str).to_numpy(),
+                "TRANSACTION_DATE": pd.to_datetime(upserts["date"]).dt.date.to_numpy()
+            }))
+        if deletes:
+            # Una solicitud solo de bajas trae `upserts` sin columnas
+            parts.append(pd.DataFrame({
+                "TRANSACTION_ID": [str(transaction_id) for transaction_id in deletes],
+                "PYME_ID": pyme_id,
+                "OPERATION": "D",
+                "TRANSACTION_TYPE": None,
+                "CATEGORY": None,
+                "AMOUNT": pd.array([None] * len(deletes), dtype="Float64"),
+                "DESCRIPTION": None,
+                "TRANSACTION_DATE": None
+            }))
+        stage = pd.concat(parts, ignore_index=True).drop_duplicates("TRANSACTION_ID", keep="last")  # MERGE exige una fila por llave
+        
+        def apply(connection) -> Tuple[int, ...]:
+            cursor = connection.cursor()
+            try:
+                # DDL fuera de la transacción (en Snowflake confirma implícitamente)
+                cursor.execute("""
+                    CREATE OR REPLACE TEMPORARY TABLE transaction_mutations_stage (
+                        transaction_id VARCHAR(50),
+                        pyme_id VARCHAR(50),
+                        operation VARCHAR(1), -- 'U' alta/cambio, 'D' baja
+                        transaction_type VARCHAR(20),
+                        category VARCHAR(100),
+                        amount DECIMAL(15,2),
+                        description TEXT,
+                        transaction_date DATE
+                    )
+                """)
+                # write_pandas crea un stage temporal (DDL, confirma implícitamente): se carga antes
+                # de BEGIN y dentro de la transacción queda solo el MERGE
+                write_pandas(connection, stage, "TRANSACTION_MUTATIONS_STAGE")
+                cursor.execute("BEGIN")
+                cursor.execute("""
+                    MERGE INTO transactions AS target
+                    USING transaction_mutations_stage AS source
+                    ON target.transaction_id = source.transaction_id
+                    AND target.pyme_id = source.pyme_id
+                    WHEN MATCHED AND source.operation = 'D' THEN DELETE
+                    WHEN MATCHED THEN
+                        UPDATE SET
+                            transaction_type = source.transaction_type,
+                            category = source.category,
+                            amount = source.amount,
+                            description = source.description,
+                            transaction_date = source.transaction_date,
+                            updated_at = CURRENT_TIMESTAMP()
+                    WHEN NOT MATCHED AND source.operation = 'U' THEN
+                        INSERT (transaction_id, pyme_id, transaction_type, category, amount, description, transaction_date)
+                        VALUES (source.transaction_id, source.pyme_id, source.transaction_type, 
+                               source.category, source.amount, source.description, source.transaction_date)
+                """)
+                counts = tuple(cursor.fetchone() or ())
+                if self.ledger_ready:
+                    cursor.execute(f"""
+                        MERGE INTO ledger_deletions AS target
+                        USING (
+                            SELECT l.transaction_id, l.empresa_id
+                            FROM ledger_transactions l
+                            JOIN transaction_mutations_stage s
+                            ON s.transaction_id = l.transaction_id AND s.pyme_id = l.empresa_id
+                            WHERE s.operation = 'D'
+                        ) AS source
+                        {_LEDGER_TOMBSTONE_MERGE}
+                    """)
+                cursor.execute("COMMIT")
+                return counts
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            finally:
+                cursor.close()
+        
+        try:
+            counts = self._with_retry(apply, f"mutaciones de {pyme_id}")
+            self.invalidate_results(pyme_id)
+            logger.info(f"✅ Mutaciones aplicadas en Snowflake para {pyme_id} (altas/cambios/bajas: {counts})")
+            return transaction_ids
+        
+        except Exception as e:
+            logger.error(f"❌ Error aplicando mutaciones de transacciones: {e}")
+            return None
+    
+    def delete_transaction(self, pyme_id: str, transaction_id: str) -> bool:
+        """Eliminar una transacción de una PyME (o dejar una lápida si viene del ledger)"""
+        if not self.is_connected:
+            return False
+        
+        try:
+            with self.pool.connection() as connection:
+                cursor = connection.cursor()
+                try:
+                    cursor.execute("BEGIN")
+                    cursor.execute("""
+                        DELETE FROM transactions 
+                        WHERE transaction_id = %s AND pyme_id = %s
+                    """, (transaction_id, pyme_id))
+                    if self.ledger_ready:
+                        cursor.execute(f"""
+                            MERGE INTO ledger_deletions AS target
+                            USING (
+                                SELECT transaction_id, empresa_id
+                                FROM ledger_transactions
+                                WHERE transaction_id = %s AND empresa_id = %s
+                            ) AS source
+                            {_LEDGER_TOMBSTONE_MERGE}
+                        """, (transaction_id, pyme_id))
+                    cursor.execute("COMMIT")
+                except Exception:
+                    cursor.execute("ROLLBACK")
+                    raise
+                finally:
+                    cursor.close()
+            self.invalidate_results(pyme_id)
+            logger.info(f"✅ Transacción {transaction_id} eliminada de Snowflake")
+            return True
+        
+        except Exception as e:
+            logger.error(f"❌ Error eliminando de Snowflake: {e}")
             return False
     
     def get_transactions(self, pyme_id: str = "empresa_001") -> List[Dict[str, Any]]:
-        """Obtener todas las transacciones de una PyME"""
-        if not self.connection:
-            return []
-            
+        """Obtener todas las transacciones de una PyME, más recientes primero (con caché; no mutar la lista)"""
+        def compute() -> List[Dict[str, Any]]:
+            loaded = self.load_transaction_store(pyme_id)
+            if loaded is None:
+                return []
+            return [transaction.dict() for transaction in reversed(list(loaded.store))]
+        return self._cached(pyme_id, "transactions", (), compute)
+    
+    def list_transactions_page(
+        self,
+        pyme_id: str,
+        limit: int,
+        after: Optional[Tuple[Any, str]] = None,
+        before: Optional[Tuple[Any, str]] = None,
+        start: Optional[Any] = None,
+        end: Optional[Any] = None,
+        category: Optional[str] = None,
+        transaction_type: Optional[str] = None
+    ) -> Optional[Tuple[List[Dict[str, Any]], bool]]:
+        """Una página de transacciones en orden fecha DESC, transaction_id DESC (keyset + LIMIT)
+
+        Lee `transactions` y, si existe, la tabla materializada de ROW_DATA_EMPRESA; los filtros
+        se empujan a cada rama de la unión. `after`/`before` son pares (fecha, transaction_id) del borde de la página anterior.
+        Se pide una fila de más para saber si hay otra página en la dirección recorrida;
+        devuelve (filas, hay_más) o None si no hay conexión o la consulta falla.
+        """
+        if not self.is_connected:
+            return None
+        
+        conditions = ["pyme_id = %s"]
+        params: List[Any] = [pyme_id]
+        if start is not None:
+            conditions.append("transaction_date >= %s")
+            params.append(start)
+        if end is not None:
+            conditions.append("transaction_date <= %s")
+            params.append(end)
+        if category is not None:
+            conditions.append("category = %s")
+            params.append(category)
+        if transaction_type is not None:
+            conditions.append("transaction_type = %s")
+            params.append(transaction_type)
+        # Predicado de fila expandido: lo aprovecha el pruning por transaction_date
+        if after is not None:
+            conditions.append("(transaction_date < %s OR (transaction_date = %s AND transaction_id < %s))")
+            params.extend([after[0], after[0], after[1]])
+        if before is not None:
+            conditions.append("(transaction_date > %s OR (transaction_date = %s AND transaction_id > %s))")
+            params.extend([before[0], before[0], before[1]])
+        # Hacia atrás se recorre en orden ascendente y se invierte al final
+        direction = "ASC" if before is not None and after is None else "DESC"
+        
         try:
-            cursor = self.connection.cursor()
-            
-            # Primero intentar desde ROW_DATA_EMPRESA (datos reales del Excel)
-            cursor.execute("""
-                SELECT 
-                    ROW_NUMBER() OVER (ORDER BY fecha DESC) as transaction_id,
-                    TO_DATE(fecha, 'DD/MM/YYYY') as transaction_date,
-                    monto as amount,
-                    concepto as description,
-                    categoria as category,
-                    LOWER(tipo) as transaction_type
-                FROM ROW_DATA_EMPRESA
-                WHERE empresa_id = %s
-                ORDER BY TO_DATE(fecha, 'DD/MM/YYYY') DESC
-                LIMIT 10000
-            """, (pyme_id,))
-            
-            row_data = cursor.fetchall()
-            
-            # Si no hay datos en ROW_DATA_EMPRESA, intentar en transactions
-            if not row_data:
-                cursor.execute("""
+            with self.pool.connection() as connection:
+                cursor = connection.cursor()
+                cursor.execute(f"""
                     SELECT 
                         transaction_id,
                         transaction_date,
@@ -500,61 +1126,313 @@ class SnowflakeService:
                         description,
                         category,
                         transaction_type
-                    FROM transactions
-                    WHERE pyme_id = %s
-                    ORDER BY transaction_date DESC
-                """, (pyme_id,))
-                row_data = cursor.fetchall()
+                    FROM {self._transactions_source()}
+                    WHERE {" AND ".join(conditions)}
+                    ORDER BY transaction_date {direction}, transaction_id {direction}
+                    LIMIT %s
+                """, (*params, limit + 1))
+                rows = cursor.fetchall()
+                cursor.close()
             
-            cursor.close()
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+            if direction == "ASC":
+                rows.reverse()
+            return [{
+                "id": row[0],
+                "date": row[1].isoformat() if hasattr(row[1], 'isoformat') else str(row[1]),
+                "amount": float(row[2]) if row[2] is not None else 0.0,
+                "description": row[3] or '',
+                "category": row[4],
+                "transaction_type": row[5]
+            } for row in rows], has_more
             
-            # Convertir a formato esperado por FinancialTransaction
-            result = []
-            for row in row_data:
-                # Mapear categoría a formato esperado
-                categoria = row[4].lower() if row[4] else ''
-                categoria_mapped = 'operating_expenses'  # default
+        except Exception as e:
+            logger.error(f"❌ Error paginando transacciones: {e}")
+            return None
+    
+    def load_transaction_store(self, pyme_id: str) -> Optional["WarehouseLoad"]:
+        """Cargar todas las transacciones de una PyME por lotes directo al almacén columnar
+
+        Sin límite de filas: el volumen en memoria es columnar. Se leen la tabla materializada
+        de ROW_DATA_EMPRESA y `transactions` (donde escriben los endpoints), las mismas que une
+        `list_transactions_page`; ninguna ordena en el warehouse (el almacén se ordena localmente).
+        Cada tabla tipada deja su marca de agua para las sincronizaciones incrementales.
+        """
+        if not self.is_connected:
+            return None
+            
+        try:
+            with self.pool.connection() as connection:
+                cursor = connection.cursor()
+                store = TransactionStore(capacity=1024)
+                source_ids: Dict[int, str] = {}
+                watermarks: Dict[str, datetime] = {}
+                dropped = 0
                 
-                if categoria in ['venta', 'ventas', 'sales']:
-                    categoria_mapped = 'sales'
-                elif categoria in ['personal', 'nomina', 'nómina', 'personnel']:
-                    categoria_mapped = 'personnel'
-                elif categoria in ['marketing', 'publicidad', 'promocion']:
-                    categoria_mapped = 'marketing'
-                elif categoria in ['equipo', 'inventario', 'equipment', 'maquinaria']:
-                    categoria_mapped = 'equipment'
-                elif categoria in ['servicios', 'utilities', 'publicos', 'luz', 'agua']:
-                    categoria_mapped = 'utilities'
-                elif categoria in ['costos', 'gastos operativos', 'operating', 'infraestructur']:
-                    categoria_mapped = 'operating_expenses'
+                tables = [WarehouseLoad.TRANSACTIONS_TABLE]
+                if self.ledger_ready:
+                    tables.insert(0, WarehouseLoad.LEDGER_TABLE)
                 else:
-                    categoria_mapped = 'operating_expenses'
-                
-                # Mapear tipo de transacción
-                tipo = row[5].lower() if row[5] else ''
-                tipo_mapped = 'expense'  # default
+                    # Sin tabla materializada (p. ej. sin privilegios para crear el stream): la tabla
+                    # cruda no tiene ids estables, así que sus filas no llevan id de origen ni se sincronizan
+                    cursor.execute("""
+                        SELECT 
+                            TO_VARCHAR(ROW_NUMBER() OVER (ORDER BY fecha DESC)) as transaction_id,
+                            TO_DATE(fecha, 'DD/MM/YYYY') as transaction_date,
+                            monto as amount,
+                            concepto as description,
+                            categoria as category,
+                            LOWER(tipo) as transaction_type
+                        FROM ROW_DATA_EMPRESA
+                        WHERE empresa_id = %s
+                    """, (pyme_id,))
+                    dropped, _ = self._fetch_into_store(cursor, store)
                 
-                if tipo in ['ingreso', 'income', 'i']:
-                    tipo_mapped = 'income'
-                elif tipo in ['gasto', 'expense', 'e']:
-                    tipo_mapped = 'expense'
-                elif tipo in ['inversion', 'investment']:
-                    tipo_mapped = 'investment'
+                for table in tables:
+                    # Si la tabla aún no tiene filas de la empresa, la marca inicial es la hora de la lectura
+                    read_at = self._current_timestamp(cursor)
+                    table_dropped, watermark = self._select_into_store(cursor, table, pyme_id, store=store, source_ids=source_ids)
+                    dropped += table_dropped
+                    watermarks[table] = watermark or read_at
                 
-                result.append({
-                    'id': int(row[0].split('_')[-1]) if '_' in str(row[0]) else 0,
-                    'date': row[1].isoformat() if isinstance(row[1], datetime) else str(row[1]),
-                    'amount': float(row[2]),
-                    'description': row[3] or '',
-                    'category': categoria_mapped,
-                    'transaction_type': tipo_mapped
-                })
+                cursor.close()
             
-            return result
+            if dropped:
+                logger.warning(f"⚠️ {dropped} transacciones de {pyme_id} descartadas por monto o fecha inválidos")
+            store.sort_by_date()
+            return WarehouseLoad(store, source_ids, watermarks)
             
         except Exception as e:
             logger.error(f"❌ Error obteniendo transacciones: {e}")
-            return []
+            return None
+    
+    def fetch_transaction_changes(self, pyme_id: str, watermarks: Dict[str, datetime]) -> Optional["WarehouseLoad"]:
+        """Traer solo las filas creadas o modificadas desde la marca de agua de cada tabla tipada
+
+        Relee desde la marca menos `sync_lookback` (inclusive): updated_at se fija al iniciar la
+        sentencia y un MERGE largo puede confirmar después de la lectura anterior con marcas más
+        viejas. Volver a aplicar una fila ya vista es idempotente porque se reemplaza por su transaction_id.
+        Las bajas no dejan fila: las detecta `fetch_transaction_ids`.
+        """
+        if not self.is_connected or not set(watermarks) <= set(WarehouseLoad.TENANT_COLUMNS):
+            return None
+        
+        try:
+            store = TransactionStore(capacity=1024)
+            source_ids: Dict[int, str] = {}
+            advanced: Dict[str, datetime] = {}
+            dropped = 0
+            with self.pool.connection() as connection:
+                cursor = connection.cursor()
+                for table, since in watermarks.items():
+                    table_dropped, watermark = self._select_into_store(
+                        cursor, table, pyme_id, since - self.sync_lookback, store, source_ids
+                    )
+                    dropped += table_dropped
+                    advanced[table] = max(watermark, since) if watermark else since
+                cursor.close()
+            
+            if dropped:
+                logger.warning(f"⚠️ {dropped} cambios de {pyme_id} descartados por monto o fecha inválidos")
+            return WarehouseLoad(store, source_ids, advanced)
+        
+        except Exception as e:
+            logger.error(f"❌ Error sincronizando transacciones: {e}")
+            return None
+    
+    def fetch_transaction_ids(self, pyme_id: str, tables: List[str]) -> Optional[Set[str]]:
+        """transaction_id vigentes de una empresa en las tablas tipadas (para reconciliar bajas)
+
+        Cubre cualquier origen de la baja: DELETE de otra réplica, el MERGE de mutaciones o el
+        stream de ROW_DATA_EMPRESA. Solo viaja una columna, leída por lotes.
+        """
+        if not self.is_connected or not tables or not set(tables) <= set(WarehouseLoad.TENANT_COLUMNS):
+            return None
+        
+        query = " UNION ALL ".join(
+            f"SELECT transaction_id FROM {WarehouseLoad.SOURCES[table]} WHERE {WarehouseLoad.TENANT_COLUMNS[table]} = %s"
+            for table in tables
+        )
+        try:
+            ids: Set[str] = set()
+            with self.pool.connection() as connection:
+                cursor = connection.cursor()
+                cursor.execute(query, (pyme_id,) * len(tables))
+                for batch in _iter_result_batches(cursor):
+                    if not batch.empty:
+                        ids.update(batch.iloc[:, 0].astype(str))
+                cursor.close()
+            return ids
+        
+        except Exception as e:
+            logger.error(f"❌ Error reconciliando bajas de {pyme_id}: {e}")
+            return None
+    
+    def _select_into_store(
+        self,
+        cursor,
+        table: str,
+        pyme_id: str,
+        since: Optional[datetime] = None,
+        store: Optional[TransactionStore] = None,
+        source_ids: Optional[Dict[int, str]] = None
+    ) -> Tuple[int, Optional[datetime]]:
+        """Leer una tabla tipada de una empresa (opcionalmente desde una marca de agua) hacia `store`
+
+        Devuelve (filas descartadas, máximo updated_at visto).
+        """
+        tenant_column = WarehouseLoad.TENANT_COLUMNS[table]
+        params: Tuple[Any, ...] = (pyme_id,) if since is None else (pyme_id, since)
+        cursor.execute(f"""
+            SELECT 
+                transaction_id,
+                transaction_date,
+                amount,
+                description,
+                category,
+                transaction_type,
+                updated_at
+            FROM {WarehouseLoad.SOURCES[table]}
+            WHERE {tenant_column} = %s
+            {"" if since is None else "AND updated_at >= %s"}
+        """, params)
+        return self._fetch_into_store(cursor, store, source_ids)
+    
+    @staticmethod
+    def _current_timestamp(cursor) -> datetime:
+        """Hora del warehouse en el mismo tipo que updated_at (TIMESTAMP_NTZ)"""
+        cursor.execute("SELECT CURRENT_TIMESTAMP()::TIMESTAMP_NTZ")
+        return cursor.fetchone()[0]
+    
+    def _fetch_into_store(
+        self,
+        cursor,
+        store: Optional[TransactionStore] = None,
+        source_ids: Optional[Dict[int, str]] = None
+    ) -> Tuple[int, Optional[datetime]]:
+        """Volcar el resultado del cursor al almacén lote a lote (sin objetos por fila)
+
+        Registra los transaction_id de origen en `source_ids` si se indica. Devuelve las filas
+        descartadas y el máximo updated_at visto, si la consulta lo incluye.
+        """
+        store = store if store is not None else TransactionStore(capacity=1024)
+        dropped = 0
+        watermark = None
+        for batch in _iter_result_batches(cursor):
+            if batch.empty:
+                continue
+            ids, batch_source_ids, batch_dropped = append_warehouse_batch(batch, store)
+            if source_ids is not None:
+                source_ids.update(zip(ids.tolist(), batch_source_ids.tolist()))
+            dropped += batch_dropped
+            if "UPDATED_AT" in batch.columns:
+                batch_max = pd.to_datetime(batch["UPDATED_AT"]).max()
+                if pd.notna(batch_max) and (watermark is None or batch_max > watermark):
+                    watermark = batch_max
+        return dropped, (watermark.to_pydatetime() if watermark is not None else None)
+
+def _assemble_financial_analysis(grouped_rows: List[Tuple]) -> Dict[str, Any]:
+    """Armar el análisis mensual, por categoría y de tendencias desde filas (mes, categoría, tipo, n, suma, suma²)"""
+    monthly: Dict[Any, Dict[str, float]] = {}
+    categories: Dict[Tuple[str, str], List[float]] = {}
+    total_count = 0
+    sums = {'income': 0.0, 'expense': 0.0}
+    squares = {'income': 0.0, 'expense': 0.0}
+    
+    for month, category, transaction_type, count, total, total_squared in grouped_rows:
+        count, total, total_squared = int(count), float(total or 0), float(total_squared or 0)
+        month_totals = monthly.setdefault(month, {'income': 0.0, 'expense': 0.0, 'net': 0.0})
+        if transaction_type in sums:
+            month_totals[transaction_type] += total
+            sums[transaction_type] += total
+            squares[transaction_type] += total_squared
+        month_totals['net'] += total if transaction_type == 'income' else -total
+        category_totals = categories.setdefault((category, transaction_type), [0.0, 0])
+        category_totals[0] += total
+        category_totals[1] += count
+        total_count += count
+    
+    def average(transaction_type: str) -> float:
+        # AVG(CASE WHEN tipo THEN amount ELSE 0 END) sobre todas las filas
+        return sums[transaction_type] / total_count if total_count else 0
+    
+    def volatility(transaction_type: str) -> float:
+        # STDDEV muestral de la misma columna (ceros en las filas de otro tipo)
+        if total_count < 2:
+            return 0
+        variance = (squares[transaction_type] - sums[transaction_type] ** 2 / total_count) / (total_count - 1)
+        return math.sqrt(max(variance, 0.0))
+    
+    return {
+        'monthly_analysis': [
+            {
+                'month': month.strftime('%Y-%m'),
+                'total_income': totals['income'],
+                'total_expenses': totals['expense'],
+                'net_income': totals['net']
+            } for month, totals in sorted(monthly.items(), key=lambda item: item[0], reverse=True)
+        ],
+        'category_analysis': [
+            {
+                'category': category,
+                'type': transaction_type,
+                'total_amount': total,
+                'transaction_count': count,
+                'avg_amount': total / count if count else 0
+            } for (category, transaction_type), (total, count) in sorted(categories.items(), key=lambda item: item[1][0], reverse=True)
+        ],
+        'trend_metrics': {
+            'avg_income': average('income'),
+            'avg_expense': average('expense'),
+            'income_volatility': volatility('income'),
+            'expense_volatility': volatility('expense')
+        }
+    }
+
+
+def _assemble_simulation_baseline(grouped_rows: List[Tuple], period_days: int) -> Dict[str, Any]:
+    """Resumen compacto desde filas (mes, categoría, tipo, n, suma): totales, meses y categorías"""
+    monthly: Dict[Any, Dict[str, Any]] = {}
+    categories: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for month, category, transaction_type, count, total in grouped_rows:
+        total = float(total or 0)
+        month_entry = monthly.setdefault(month, {'month': month.isoformat() if hasattr(month, 'isoformat') else str(month), 'income': 0.0, 'expenses': 0.0, 'transaction_count': 0})
+        month_entry['transaction_count'] += int(count)
+        if transaction_type == 'income':
+            month_entry['income'] += total
+        elif transaction_type == 'expense':
+            month_entry['expenses'] += total
+        category_entry = categories.setdefault((category, transaction_type), {'category': category, 'transaction_type': transaction_type, 'total_amount': 0.0, 'transaction_count': 0})
+        category_entry['total_amount'] += total
+        category_entry['transaction_count'] += int(count)
+    
+    return {
+        'period_days': period_days,
+        'total_income': sum(entry['income'] for entry in monthly.values()),
+        'total_expenses': sum(entry['expenses'] for entry in monthly.values()),
+        'monthly': [monthly[month] for month in sorted(monthly)],
+        'categories': list(categories.values())
+    }
+
+# Errores del conector cuando el resultado no puede leerse en Arrow (p. ej. sin pyarrow instalado)
+_NO_ARROW_ERRNOS = {ER_NO_PYARROW, ER_NO_ARROW_RESULT, ER_NO_PYARROW_SNOWSQL}
+
+
+def _iter_result_batches(cursor, batch_size: int = 10000) -> Iterator[pd.DataFrame]:
+    """Lotes Arrow del resultado como DataFrames; fetchmany si el resultado no viene en Arrow o falta pyarrow"""
+    try:
+        yield from cursor.fetch_pandas_batches()
+    except (NotSupportedError, ProgrammingError) as e:
+        if isinstance(e, ProgrammingError) and e.errno not in _NO_ARROW_ERRNOS:
+            raise
+        columns = [column[0] for column in cursor.description]
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield pd.DataFrame.from_records(rows, columns=columns)
+
 
 # Instancia global del servicio
 snowflake_service = SnowflakeService()
@@ -0,0 +1,304 @@
+"""
+Almacén columnar de transacciones financieras
+Guarda cada empresa en arreglos NumPy compactos (fechas como días int32, montos float64,
+categoría y tipo como códigos uint8 y descripciones internadas) en lugar de objetos pydantic
+"""
+
+from datetime import date, datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+
+from app.models.financial_models import FinancialTransaction, TransactionType, CategoryType
+
+EPOCH = date(1970, 1, 1)
+
+# Códigos estables para las columnas categóricas (el orden de los enums define el código)
+CATEGORIES: List[CategoryType] = list(CategoryType)
+TRANSACTION_TYPES: List[TransactionType] = list(TransactionType)
+CATEGORY_CODES: Dict[str, int] = {category.value: code for code, category in enumerate(CATEGORIES)}
+TYPE_CODES: Dict[str, int] = {transaction_type.value: code for code, transaction_type in enumerate(TRANSACTION_TYPES)}
+
+_COLUMNS = {
+    "ids": np.int64,
+    "days": np.int32,
+    "amounts": np.float64,
+    "categories": np.uint8,
+    "types": np.uint8,
+    "descriptions": np.int32,
+}
+
+
+def date_to_day(value: Union[date, datetime]) -> int:
+    """Convertir una fecha a número de día desde 1970-01-01"""
+    if isinstance(value, datetime):
+        value = value.date()
+    return (value - EPOCH).days
+
+
+def day_to_date(day: int) -> date:
+    """Convertir un número de día a fecha"""
+    return date.fromordinal(EPOCH.toordinal() + int(day))
+
+
+def days_from_datetimes(values) -> np.ndarray:
+    """Convertir fechas vectorizadas (Series/array datetime64) a números de día int32"""
+    return np.asarray(pd.to_datetime(values).values.astype("datetime64[D]").astype(np.int64), dtype=np.int32)
+
+
+class TransactionStore:
+    """Almacén columnar con anexado amortizado O(1) y vistas sin copia"""
+
+    def __init__(self, capacity: int = 64):
+        capacity = max(int(capacity), 1)
+        for name, dtype in _COLUMNS.items():
+            setattr(self, f"_{name}", np.empty(capacity, dtype=dtype))
+        self._size = 0
+        self._vocabulary: List[str] = []
+        self._vocabulary_index: Dict[str, int] = {}
+        self._next_id = 1
+        self.version = 0  # Se incrementa en cada mutación para invalidar índices derivados
+
+    @classmethod
+    def from_transactions(cls, transactions: Iterable[FinancialTransaction]) -> "TransactionStore":
+        transactions = list(transactions)
+        store = cls(capacity=len(transactions))
+        store.extend(transactions)
+        return store
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, np.ndarray], vocabulary: List[str]) -> "TransactionStore":
+        """Envolver columnas existentes (p. ej. memoria mapeada) sin copiarlas
+
+        Las columnas deben ser escribibles o copy-on-write; el primer anexado que exceda
+        su tamaño las copia a memoria propia.
+        """
+        store = cls.__new__(cls)
+        for name, dtype in _COLUMNS.items():
+            setattr(store, f"_{name}", columns[name].astype(dtype, copy=False))
+        store._size = len(columns["ids"])
+        store._vocabulary = list(vocabulary)
+        store._vocabulary_index = {text: code for code, text in enumerate(store._vocabulary)}
+        store._next_id = int(store._ids.max()) + 1 if store._size else 1
+        store.version = 0
+        return store
+
+    def column_arrays(self) -> Dict[str, np.ndarray]:
+        """Columnas con su nombre interno (vistas del tamaño actual)"""
+        return {name: getattr(self, f"_{name}")[:self._size] for name in _COLUMNS}
+
+    # ------------------------------------------------------------------
+    # Vistas de columnas (sin copia)
+    # ------------------------------------------------------------------
+    @property
+    def ids(self) -> np.ndarray:
+        return self._ids[:self._size]
+
+    @property
+    def days(self) -> np.ndarray:
+        return self._days[:self._size]
+
+    @property
+    def amounts(self) -> np.ndarray:
+        return self._amounts[:self._size]
+
+    @property
+    def categories(self) -> np.ndarray:
+        return self._categories[:self._size]
+
+    @property
+    def types(self) -> np.ndarray:
+        return self._types[:self._size]
+
+    @property
+    def description_codes(self) -> np.ndarray:
+        return self._descriptions[:self._size]
+
+    @property
+    def vocabulary(self) -> List[str]:
+        return self._vocabulary
+
+    @property
+    def nbytes(self) -> int:
+        """Memoria aproximada ocupada por las columnas y el vocabulario"""
+        columns = sum(getattr(self, f"_{name}").nbytes for name in _COLUMNS)
+        return columns + sum(len(text) + 49 for text in self._vocabulary)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __bool__(self) -> bool:
+        return self._size > 0
+
+    # ------------------------------------------------------------------
+    # Escritura
+    # ------------------------------------------------------------------
+    def intern(self, description: str) -> int:
+        """Obtener el código de una descripción, agregándola al vocabulario si es nueva"""
+        code = self._vocabulary_index.get(description)
+        if code is None:
+            code = len(self._vocabulary)
+            self._vocabulary.append(description)
+            self._vocabulary_index[description] = code
+        return code
+
+    def intern_many(self, descriptions: Sequence[str]) -> np.ndarray:
+        """Internar un lote de descripciones de forma vectorizada"""
+        codes, uniques = pd.factorize(pd.Series(descriptions, dtype=object).fillna("").astype(str), sort=False)
+        mapping = np.fromiter((self.intern(text) for text in uniques), dtype=np.int32, count=len(uniques))
+        return mapping[codes] if len(codes) else np.empty(0, dtype=np.int32)
+
+    def append(self, transaction: FinancialTransaction) -> int:
+        """Agregar una transacción y devolver su id"""
+        transaction_id = transaction.id if transaction.id is not None else self._next_id
+        self._reserve(self._size + 1)
+        index = self._size
+        self._ids[index] = transaction_id
+        self._days[index] = date_to_day(transaction.date)
+        self._amounts[index] = transaction.amount
+        self._categories[index] = CATEGORY_CODES[CategoryType(transaction.category).value]
+        self._types[index] = TYPE_CODES[TransactionType(transaction.transaction_type).value]
+        self._descriptions[index] = self.intern(transaction.description)
+        self._size += 1
+        self._next_id = max(self._next_id, int(transaction_id) + 1)
+        self.version += 1
+        return int(transaction_id)
+
+    def insert_sorted(self, transaction: FinancialTransaction) -> int:
+        """Agregar una transacción manteniendo el orden por fecha; devuelve su id"""
+        transaction_id = self.append(transaction)
+        last = self._size - 1
+        position = int(np.searchsorted(self._days[:last], self._days[last], side="right"))
+        if position < last:
+            # Desplazar la cola una posición (memmove) y colocar la fila nueva en su lugar
+            for name in _COLUMNS:
+                column = getattr(self, f"_{name}")
+                row = column[last]
+                column[position + 1:last + 1] = column[position:last].copy()
+                column[position] = row
+            self.version += 1
+        return transaction_id
+
+    def extend(self, transactions: Iterable[FinancialTransaction]) -> None:
+        for transaction in transactions:
+            self.append(transaction)
+
+    def extend_columns(
+        self,
+        days: np.ndarray,
+        amounts: np.ndarray,
+        categories: np.ndarray,
+        types: np.ndarray,
+        descriptions: Sequence[str],
+        ids: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """Agregar un lote completo de columnas ya normalizadas; devuelve los ids asignados"""
+        count = len(amounts)
+        if count == 0:
+            return np.empty(0, dtype=np.int64)
+        if ids is None:
+            ids = np.arange(self._next_id, self._next_id + count, dtype=np.int64)
+        self._reserve(self._size + count)
+        window = slice(self._size, self._size + count)
+        self._ids[window] = ids
+        self._days[window] = days
+        self._amounts[window] = amounts
+        self._categories[window] = categories
+        self._types[window] = types
+        self._descriptions[window] = self.intern_many(descriptions)
+        self._size += count
+        self._next_id = max(self._next_id, int(np.max(ids)) + 1)
+        self.version += 1
+        return np.asarray(ids, dtype=np.int64)
+
+    def extend_from(self, other: "TransactionStore", mask: Optional[np.ndarray] = None) -> np.ndarray:
+        """Anexar las filas de otro almacén (opcionalmente filtradas por máscara) con ids nuevos"""
+        rows = np.flatnonzero(mask) if mask is not None else np.arange(len(other))
+        vocabulary = np.asarray(other.vocabulary, dtype=object)
+        return self.extend_columns(
+            days=other.days[rows],
+            amounts=other.amounts[rows],
+            categories=other.categories[rows],
+            types=other.types[rows],
+            descriptions=vocabulary[other.description_codes[rows]] if len(rows) else []
+        )
+
+    def sort_by_date(self) -> None:
+        """Ordenar por (fecha, id); el orden por id desempata y sostiene la paginación por cursor"""
+        order = np.lexsort((self.ids, self.days))
+        if np.all(order[1:] > order[:-1]):
+            return
+        for name in _COLUMNS:
+            column = getattr(self, f"_{name}")
+            column[:self._size] = column[:self._size][order]
+        self.version += 1
+
+    def index_of(self, transaction_id: int) -> Optional[int]:
+        """Posición de una transacción por id, o None si no existe"""
+        matches = np.flatnonzero(self.ids == transaction_id)
+        return int(matches[0]) if len(matches) else None
+
+    def remove(self, transaction_ids: Iterable[int]) -> int:
+        """Eliminar transacciones por id; devuelve cuántas se eliminaron"""
+        mask = np.isin(self.ids, np.fromiter(transaction_ids, dtype=np.int64))
+        removed = int(mask.sum())
+        if removed:
+            keep = ~mask
+            remaining = self._size - removed
+            for name in _COLUMNS:
+                column = getattr(self, f"_{name}")
+                column[:remaining] = column[:self._size][keep]
+            self._size = remaining
+            self.version += 1
+        return removed
+
+    def _reserve(self, required: int) -> None:
+        """Crecer las columnas de forma geométrica para anexar en O(1) amortizado"""
+        capacity = len(self._ids)
+        if required <= capacity:
+            return
+        new_capacity = max(required, capacity * 2)
+        for name in _COLUMNS:
+            column = getattr(self, f"_{name}")
+            grown = np.empty(new_capacity, dtype=column.dtype)
+            grown[:self._size] = column[:self._size]
+            setattr(self, f"_{name}", grown)
+
+    # ------------------------------------------------------------------
+    # Lectura
+    # ------------------------------------------------------------------
+    def to_frame(self) -> pd.DataFrame:
+        """DataFrame sobre las columnas del almacén (los numéricos no se copian)"""
+        return pd.DataFrame({
+            "id": self.ids,
+            "date": pd.to_datetime(self.days, unit="D"),
+            "amount": self.amounts,
+            "category": pd.Categorical.from_codes(self.categories, categories=[c.value for c in CATEGORIES]),
+            "transaction_type": pd.Categorical.from_codes(self.types, categories=[t.value for t in TRANSACTION_TYPES]),
+            "description": pd.Categorical.from_codes(self.description_codes, categories=pd.Index(self._vocabulary, dtype=object)) if self._vocabulary else pd.Categorical([]),
+        }, copy=False)
+
+    def materialize(self, index: int) -> FinancialTransaction:
+        """Construir el modelo pydantic de una sola fila"""
+        return FinancialTransaction(
+            id=int(self._ids[index]),
+            date=day_to_date(self._days[index]),
+            amount=float(self._amounts[index]),
+            description=self._vocabulary[self._descriptions[index]],
+            category=CATEGORIES[self._categories[index]],
+            transaction_type=TRANSACTION_TYPES[self._types[index]]
+        )
+
+    def __iter__(self) -> Iterator[FinancialTransaction]:
+        for index in range(self._size):
+            yield self.materialize(index)
+
+    def __getitem__(self, key: Union[int, slice]) -> Union[FinancialTransaction, List[FinancialTransaction]]:
+        if isinstance(key, slice):
+            return [self.materialize(index) for index in range(*key.indices(self._size))]
+        if key < 0:
+            key += self._size
+        if not 0 <= key < self._size:
+            raise IndexError("índice de transacción fuera de rango")
+        return self.materialize(key)